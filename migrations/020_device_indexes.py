@@ -0,0 +1,8 @@
+# 020_device_indexes.py
+
+def migrate(migrator, database, fake=False, **kwargs):
+    # devices.mac is already indexed by its UNIQUE constraint
+    migrator.sql("""CREATE INDEX IF NOT EXISTS devices_ip_idx ON devices(ip)""")
+
+def rollback(migrator, database, fake=False, **kwargs):
+    migrator.sql("""DROP INDEX IF EXISTS devices_ip_idx""")
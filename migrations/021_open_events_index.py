@@ -0,0 +1,12 @@
+# 021_open_events_index.py
+
+def migrate(migrator, database, fake=False, **kwargs):
+    # open events are looked up by device/type/src/detail/level before
+    # every insert and loaded by src at data puller start, fixed events
+    # (the bulk of the table) never are
+    migrator.sql("""CREATE INDEX IF NOT EXISTS events_open_idx ON events(devid, eventtype, src, detail, level) WHERE status = false""")
+    migrator.sql("""CREATE INDEX IF NOT EXISTS events_open_src_idx ON events(src) WHERE status = false""")
+
+def rollback(migrator, database, fake=False, **kwargs):
+    migrator.sql("""DROP INDEX IF EXISTS events_open_src_idx""")
+    migrator.sql("""DROP INDEX IF EXISTS events_open_idx""")
@@ -0,0 +1,108 @@
+# 022_log_partitions.py
+
+# auth, account and events become monthly range partitioned tables on their
+# time column (partitions named <table>_yYYYYmMM plus <table>_default), the
+# maintenance mule creates the coming months and drops expired ones
+# (libs/db/db_partitions.py). The primary key of a partitioned table has to
+# include the partition key, so it becomes (id, time column).
+
+TABLES = (
+    # table, time column, id sequence
+    ('auth', 'created', 'auth_id_seq'),
+    ('account', 'created', 'account_id_seq'),
+    ('events', 'eventtime', 'events_id_seq'),
+)
+
+INDEXES = (
+    # filters of api_logs.py and the dashboard: time range + device/type
+    "CREATE INDEX auth_created_idx ON auth(created)",
+    "CREATE INDEX auth_devid_created_idx ON auth(devid, created)",
+    "CREATE INDEX auth_ltype_created_idx ON auth(ltype, created)",
+    # radius/syslog correlation lookup (db_AA.Auth.add_log)
+    "CREATE INDEX auth_login_idx ON auth(devid, ltype, username, started)",
+    "CREATE INDEX account_created_idx ON account(created)",
+    "CREATE INDEX account_devid_created_idx ON account(devid, created)",
+    "CREATE INDEX account_section_created_idx ON account(section, created)",
+    "CREATE INDEX events_eventtime_idx ON events(eventtime)",
+    "CREATE INDEX events_devid_eventtime_idx ON events(devid, eventtime)",
+    "CREATE INDEX events_eventtype_eventtime_idx ON events(eventtype, eventtime)",
+    # 021_open_events_index.py, the old table is gone
+    "CREATE INDEX events_open_idx ON events(devid, eventtype, src, detail, level) WHERE status = false",
+    "CREATE INDEX events_open_src_idx ON events(src) WHERE status = false",
+    # .contains() filters are ILIKE '%x%', only trigram indexes serve them
+    "CREATE INDEX auth_ip_trgm_idx ON auth USING gin (ip gin_trgm_ops)",
+    "CREATE INDEX auth_username_trgm_idx ON auth USING gin (username gin_trgm_ops)",
+    "CREATE INDEX account_username_trgm_idx ON account USING gin (username gin_trgm_ops)",
+    "CREATE INDEX account_action_trgm_idx ON account USING gin (action gin_trgm_ops)",
+    "CREATE INDEX account_section_trgm_idx ON account USING gin (section gin_trgm_ops)",
+    "CREATE INDEX account_message_trgm_idx ON account USING gin (message gin_trgm_ops)",
+    "CREATE INDEX account_config_trgm_idx ON account USING gin (config gin_trgm_ops)",
+    "CREATE INDEX events_detail_trgm_idx ON events USING gin (detail gin_trgm_ops)",
+    "CREATE INDEX events_comment_trgm_idx ON events USING gin (comment gin_trgm_ops)",
+)
+
+# indexes and keys of the tables before this migration, restored by rollback
+ORIGINAL_INDEXES = (
+    # 007_events.py, 009_authorization.py, 010_account.py
+    "ALTER TABLE auth ADD CONSTRAINT auth_pkey PRIMARY KEY (id)",
+    "ALTER TABLE account ADD CONSTRAINT account_pkey PRIMARY KEY (id)",
+    "ALTER TABLE events ADD CONSTRAINT events_pkey PRIMARY KEY (id)",
+    "ALTER TABLE auth ADD CONSTRAINT auth_devid_fkey FOREIGN KEY (devid) REFERENCES devices(id)",
+    "ALTER TABLE account ADD CONSTRAINT account_devid_fkey FOREIGN KEY (devid) REFERENCES devices(id)",
+    "ALTER TABLE events ADD CONSTRAINT events_devid_fkey FOREIGN KEY (devid) REFERENCES devices(id)",
+    # 021_open_events_index.py
+    "CREATE INDEX events_open_idx ON events(devid, eventtype, src, detail, level) WHERE status = false",
+    "CREATE INDEX events_open_src_idx ON events(src) WHERE status = false",
+)
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+
+    migrator.sql("""CREATE EXTENSION IF NOT EXISTS pg_trgm""")
+
+    for table, column, seq in TABLES:
+        migrator.sql("""ALTER TABLE {0} RENAME TO {0}_old""".format(table))
+        # keep the id sequence when the old table is dropped
+        migrator.sql("""ALTER SEQUENCE {} OWNED BY NONE""".format(seq))
+        migrator.sql("""CREATE TABLE {0} (LIKE {0}_old INCLUDING DEFAULTS)
+            PARTITION BY RANGE ({1})""".format(table, column))
+        migrator.sql("""CREATE TABLE {0}_default PARTITION OF {0} DEFAULT""".format(table))
+        # one partition per month of the existing rows up to two months ahead
+        migrator.sql("""DO $$
+            DECLARE
+                m date;
+            BEGIN
+                FOR m IN SELECT generate_series(
+                        date_trunc('month', COALESCE((SELECT min({1}) FROM {0}_old), now())),
+                        date_trunc('month', now()) + interval '2 month',
+                        interval '1 month')::date
+                LOOP
+                    EXECUTE 'CREATE TABLE ' || quote_ident('{0}_y' || to_char(m, 'YYYY') || 'm' || to_char(m, 'MM'))
+                        || ' PARTITION OF {0} FOR VALUES FROM (' || quote_literal(m)
+                        || ') TO (' || quote_literal((m + interval '1 month')::date) || ')';
+                END LOOP;
+            END $$""".format(table, column))
+        migrator.sql("""INSERT INTO {0} SELECT * FROM {0}_old""".format(table))
+        migrator.sql("""DROP TABLE {}_old""".format(table))
+        # the {table}_pkey index name is free only once the old table is gone
+        migrator.sql("""ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY (id, {1})""".format(table, column))
+        migrator.sql("""ALTER TABLE {0} ADD CONSTRAINT {0}_devid_fkey FOREIGN KEY (devid) REFERENCES devices(id)""".format(table))
+        migrator.sql("""ALTER SEQUENCE {} OWNED BY {}.id""".format(seq, table))
+
+    for sql in INDEXES:
+        migrator.sql(sql)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+
+    for table, column, seq in TABLES:
+        migrator.sql("""ALTER TABLE {0} RENAME TO {0}_parted""".format(table))
+        migrator.sql("""ALTER SEQUENCE {} OWNED BY NONE""".format(seq))
+        migrator.sql("""CREATE TABLE {0} (LIKE {0}_parted INCLUDING DEFAULTS)""".format(table))
+        migrator.sql("""INSERT INTO {0} SELECT * FROM {0}_parted""".format(table))
+        # takes the partitions and every index of INDEXES with it
+        migrator.sql("""DROP TABLE {}_parted""".format(table))
+        migrator.sql("""ALTER SEQUENCE {} OWNED BY {}.id""".format(seq, table))
+
+    for sql in ORIGINAL_INDEXES:
+        migrator.sql(sql)
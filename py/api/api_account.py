@@ -13,6 +13,7 @@ from libs.db import db,db_permissions,db_user_group_perm,db_groups,db_sysconfig,
 import json
 from libs import utilpro, webutil,account
 from libs.webutil import app, login_required, get_myself , buildResponse
+from libs.response_cache import cached,invalidate
 from libs.mschap3.mschap import nt_password_hash
 
 import logging
@@ -112,6 +113,7 @@ def create_user():
     account.new_signup_steps(u)
     for perm in userperms:
         db_user_group_perm.DevUserGroupPermRel.create_user_group_perm(u.id, int(perm['group_id']), int(perm['perm_id']))
+    invalidate('perms')
     db_syslog.add_syslog_event(webutil.get_myself(), "User Managment","Create", webutil.get_ip(),webutil.get_agent(),json.dumps(input))
     return buildResponse(u, 200)
 
@@ -134,6 +136,8 @@ def user_delete():
         return buildResponse(resp, 200)
 
     u.delete_instance(recursive=True)
+    db_groups.scope_changed()
+    invalidate('perms')
     db_syslog.add_syslog_event(webutil.get_myself(), "User Managment", "Delete", webutil.get_ip(), webutil.get_agent(), json.dumps(input))
     return buildResponse({}, 200)
 
@@ -284,6 +288,7 @@ def users():
 
 @app.route('/api/perms/list' ,methods=['POST'])
 @login_required(role='admin',perm={'permissions':'read'})
+@cached('perms')
 def perms():
     """Search list of perms. """
 
@@ -314,6 +319,7 @@ def perms_create():
             return buildResponse({"status":"failed", "err":"Invalid permission"}, 200)
     perms=json.dumps(perms)
     db_permissions.create_perm(name, perms)
+    invalidate('perms')
 
 
     # reply = db_permissions.query_perms(page, size, search)
@@ -346,6 +352,7 @@ def perms_edit():
     perm.name=name
     perm.perms=perms
     perm.save()
+    invalidate('perms')
 
     # reply = db_permissions.query_perms(page, size, search)
     db_syslog.add_syslog_event(webutil.get_myself(), "Perms Managment","Edit", webutil.get_ip(),webutil.get_agent(),json.dumps(input))
@@ -398,6 +405,7 @@ def userperms_create():
         return buildResponse({"status":"failed", "err":"Permission not exists"}, 200)
 
     db_user_group_perm.DevUserGroupPermRel.create_user_group_perm(uid, gid, pid)
+    invalidate('perms')
 
     # reply = db_permissions.query_perms(page, size, search)
     db_syslog.add_syslog_event(webutil.get_myself(), "UserPerms Managment","Create", webutil.get_ip(),webutil.get_agent(),json.dumps(input))
@@ -418,6 +426,7 @@ def userperms_delete():
     if not perm:
         return buildResponse({"status":"failed", "err":"Permission not exists"}, 200)
     db_user_group_perm.DevUserGroupPermRel.delete_user_group_perm(id)
+    invalidate('perms')
     db_syslog.add_syslog_event(webutil.get_myself(), "UserPerms Managment", "Delete", webutil.get_ip(), webutil.get_agent(), json.dumps(input))
     return buildResponse({'status':'success'}, 200)
 
@@ -439,6 +448,7 @@ def perms_delete():
     res=db_permissions.delete_perm(id)
     if not res:
         return buildResponse({"status":"failed", "err":"Unable to Delete Permission"}, 200)
+    invalidate('perms')
     # reply = db_permissions.query_perms(page, size, search)
     db_syslog.add_syslog_event(webutil.get_myself(), "Perms Managment","Delete", webutil.get_ip(),webutil.get_agent(),json.dumps(input))
     return buildResponse({'status':'success'}, 200)
\ No newline at end of file
@@ -53,8 +53,7 @@ def backup_list():
     search = input.get('search')
     uid = session.get("userid") or False
     if not devid:
-        devs=list(db_user_group_perm.DevUserGroupPermRel.get_user_devices(uid))
-        dev_ids=[dev.id for dev in devs]
+        dev_ids=db_user_group_perm.DevUserGroupPermRel.get_user_device_ids(uid)
     else:
         dev=db_device.get_device(devid)
         if not dev:
@@ -63,7 +62,9 @@ def backup_list():
     backups = db_backups.Backups
     log.error("1")
     clauses = []
-    clauses.append(backups.devid << dev_ids)
+    # None: the user may access all devices
+    if dev_ids is not None:
+        clauses.append(backups.devid << dev_ids)
     if event_start_time:
         event_start_time=event_start_time.split(".000Z")[0]
         event_start_time=datetime.datetime.strptime(event_start_time, "%Y-%m-%dT%H:%M:%S")
@@ -14,6 +14,8 @@ import re
 from libs.red import RedisDB
 from libs.webutil import app,buildResponse,login_required,get_myself,get_ip,get_agent
 from libs import util
+from libs import chart
+from libs.response_cache import cached,invalidate
 from libs.db import db_device,db_groups,db_user_group_perm,db_user_tasks,db_sysconfig,db_syslog
 import logging
 import json
@@ -35,6 +37,7 @@ def index():
 
 @app.route('/api/dev/list', methods = ['POST'])
 @login_required(role='admin',perm={'device':'read'})
+@cached('devices','groups','perms',ttl=15,scope='user')
 def list_devs():
     """Return devs list of assigned to user , all for admin"""
     input = request.json
@@ -118,6 +121,7 @@ def save_editform():
 
 @app.route('/api/devgroup/list', methods = ['POST'])
 @login_required(role='admin',perm={'device_group':'read'})
+@cached('groups','devices')
 def list_devgroups():
     """return dev groups"""
     
@@ -137,6 +141,7 @@ def delete_group():
     gid = input.get('gid', False)
     try:
         if db_user_group_perm.DevUserGroupPermRel.delete_group(gid):
+            invalidate('groups','perms')
             db_syslog.add_syslog_event(get_myself(), "Device Group","Delete", get_ip(),get_agent(),json.dumps(input))
             return buildResponse({"result":"success"}, 200)
         else:
@@ -179,6 +184,7 @@ def update_save_group():
                 db_syslog.add_syslog_event(get_myself(), "Device Group","Create", get_ip(),get_agent(),json.dumps(input))
                 gid=group.id
                 db_groups.add_devices_to_group(gid,devids)
+                invalidate('groups')
             else:
                 return buildResponse({'result':'failed','err':"Group not created"}, 200)
             return buildResponse({"result":"success"}, 200)
@@ -196,6 +202,7 @@ def update_save_group():
                 ids.append(dev.id)
             dev_to_remove=list(set(ids)-set(devids))
             db_groups.delete_from_group(dev_to_remove)
+            invalidate('groups')
             db_syslog.add_syslog_event(get_myself(), "Device Group","Update", get_ip(),get_agent(),json.dumps(input))
             return buildResponse({"result":"success"}, 200)
         except Exception as e:
@@ -230,6 +237,7 @@ def search_groups():
 
 @app.route('/api/search/devices', methods = ['POST'])
 @login_required(role='admin',perm={'device':'read'})
+@cached('devices',ttl=15)
 def search_devices():
     """search in groups"""
     input = request.json
@@ -237,18 +245,20 @@ def search_devices():
     # build HTML of the method list
     device=db_device.Devices
     searchstr=input.get('searchstr',False)
+    # never send (or cache) the device credentials
+    fields=[f for f in device._meta.sorted_fields if f.name not in ('user_name','password')]
     devs = []
     try:
         if searchstr and searchstr!="":
             # find devices that contains searchstr in the name
             devs = (device
-                    .select()
+                    .select(*fields)
                     .where(device.name.contains(searchstr))
                     .dicts())
         else:
             # return first 10 ordered alphabeticaly
             devs = (device
-                    .select()
+                    .select(*fields)
                     .order_by(device.name)
                     .limit(10)
                     .dicts())
@@ -291,13 +301,20 @@ def dev_info():
     res=db_device.get_device(devid)
     options=util.build_api_options(db_device.get_devices_by_id([res['id'],])[0])
     network_info=[]
+    router=None
+    broken=False
     try:
-        if util.check_port(options['host'],options['port']):
-            router=util.RouterOSCheckResource(options)
-            network_info=util.get_network_data(router)
-            del network_info['total']
-    except:
-        pass
+        # no port probe, an unreachable device fails the connect
+        router=util.router_pool.acquire(res['id'],options)
+        network_info=util.get_network_data(router)
+        del network_info['total']
+    except Exception as e:
+        kind=util.classify_api_error(e,connecting=router is None)
+        log.warning("{} port {}: {} ({})".format(options['host'],options['port'],kind,e))
+        broken=kind in util.UNREACHABLE_ERRORS
+        network_info=[]
+    finally:
+        util.router_pool.release(res['id'],router,broken)
     interfaces=[]
     for iface in network_info:
         interfaces.append(network_info[iface])
@@ -327,6 +344,7 @@ def dev_sensors():
     devid=input.get('devid',False)
     total=input.get('total','bps')
     delta=input.get('delta',"5m")
+    epoch=input.get('epoch',False)
     if delta not in ["5m","1h","daily","live"]:
         return buildResponse({'status': 'failed'},200,error="Wrong Data")
     if not devid or not isinstance(devid, int):
@@ -372,38 +390,22 @@ def dev_sensors():
                     continue
                 if total!='bps' and 'rxp/txp-total' in res['sensors'] and 'rxp/txp-total' in res['sensors']:
                     continue
-                temp=[]
                 ids=['yA','yB']
                 colors=['#17522f','#171951']
 
-                datasets=[]
-                lables=[]
                 data_keys=['tx-total','rx-total']
                 if total!='bps':
                     data_keys=['txp-total','rxp-total']
-                for idx, val in enumerate(data_keys)  :
-                    for d in data[val]:
-                        if len(lables) <= len(data[val]):
-                            edatetime=datetime.datetime.fromtimestamp(d[0]/1000)
-                            lables.append(util.utc2local(edatetime,tz=tz).strftime("%m/%d/%Y, %H:%M:%S %Z"))
-                        temp.append(round(d[1],1))
-                    datasets.append({'borderColor': colors[idx],'type': 'line','yAxisID': ids[idx],'data':temp,'unit':val.split("-")[0],'backgroundColor': colors[idx],'pointHoverBackgroundColor': '#fff'})
-                    temp=[]
-                
+                styles=[{'borderColor': colors[idx],'type': 'line','yAxisID': ids[idx],'unit':val.split("-")[0],'backgroundColor': colors[idx],'pointHoverBackgroundColor': '#fff'} for idx, val in enumerate(data_keys)]
                 if total=='bps':
-                    res["rx/tx-total"]={'labels':lables,'datasets':datasets}
+                    res["rx/tx-total"]=chart.build(data,data_keys,styles,tz=tz,epoch=epoch)
                     res['sensors'].append("rx/tx-total")
                 else:
-                    res["rxp/txp-total"]={'labels':lables,'datasets':datasets}
+                    res["rxp/txp-total"]=chart.build(data,data_keys,styles,tz=tz,epoch=epoch)
                     res['sensors'].append("rxp/txp-total")
 
             else:
-                temp={"labels":[],"data":[]}
-                for d in data[key]:
-                    edatetime=datetime.datetime.fromtimestamp(d[0]/1000)
-                    temp["labels"].append(util.utc2local(edatetime,tz=tz).strftime("%m/%d/%Y, %H:%M:%S %Z"))
-                    temp["data"].append(round(d[1],1))
-                res[key]={'labels':temp["labels"],'datasets':[{'data':temp['data'],'backgroundColor': 'rgba(77,189,116,.2)','borderColor': '#fff','pointHoverBackgroundColor': '#fff'}]}
+                res[key]=chart.build(data,[key],[{'backgroundColor': 'rgba(77,189,116,.2)','borderColor': '#fff','pointHoverBackgroundColor': '#fff'}],tz=tz,epoch=epoch)
             if 'rxp-total' in res['sensors']:
                 res['sensors'].remove('txp-total')
                 res['sensors'].remove('rxp-total')
@@ -427,6 +429,7 @@ def dev_ifstat():
     chart_type=input.get('type','bps')
     delta=input.get('delta',"5m")
     interface=input.get('interface',False)
+    epoch=input.get('epoch',False)
     if delta not in ["5m","1h","daily","live"]:
         return buildResponse({'status': 'failed'},200,error="Wrong Data")
     if not devid or not isinstance(devid, int):
@@ -466,27 +469,17 @@ def dev_ifstat():
         reddb=RedisDB(redopts)
         data=reddb.get_dev_data_keys()
 
-        temp=[]
         ids=['yA','yB']
         colors=['#17522f','#171951']
 
-        datasets=[]
-        lables=[]
         tz=db_sysconfig.get_sysconfig('timezone')
         data_keys=['tx-{}'.format(interface),'rx-{}'.format(interface)]
         if chart_type=='bps':
             data_keys=['tx-{}'.format(interface),'rx-{}'.format(interface)]
         elif chart_type=='pps':
             data_keys=['txp-{}'.format(interface),'rxp-{}'.format(interface)]
-        for idx, val in enumerate(data_keys):
-            for d in data[val]:
-                if len(lables) <= len(data[val]):
-                    edatetime=datetime.datetime.fromtimestamp(d[0]/1000)
-                    lables.append(util.utc2local(edatetime,tz=tz).strftime("%m/%d/%Y, %H:%M:%S %Z"))
-                temp.append(round(d[1],1))
-            datasets.append({'label':val,'borderColor': colors[idx],'type': 'line','yAxisID': ids[idx],'data':temp,'unit':val.split("-")[0],'backgroundColor': colors[idx],'pointHoverBackgroundColor': '#fff'})
-            temp=[]
-        res["data"]={'labels':lables,'datasets':datasets}
+        styles=[{'label':val,'borderColor': colors[idx],'type': 'line','yAxisID': ids[idx],'unit':val.split("-")[0],'backgroundColor': colors[idx],'pointHoverBackgroundColor': '#fff'} for idx, val in enumerate(data_keys)]
+        res["data"]=chart.build(data,data_keys,styles,tz=tz,epoch=epoch)
         
     except Exception as e:
         log.error(e)
@@ -11,6 +11,7 @@ import datetime
 from libs.db import db_tasks,db_sysconfig,db_device,db_firmware,db_syslog
 from libs import util
 from libs.webutil import app, login_required, get_myself,buildResponse,get_myself,get_ip,get_agent
+from libs.response_cache import cached,invalidate
 import bgtasks
 import re
 import logging
@@ -64,6 +65,7 @@ def update_device():
 
 @app.route('/api/firmware/get_firms', methods = ['POST'])
 @login_required(role='admin',perm={'settings':'full'})
+@cached('firmware')
 def get_firms():
     """get list of of downloaded firmwares in local repo"""
     input = request.json or {}
@@ -116,6 +118,7 @@ def update_firmware_settings():
     db_sysconfig.update_sysconfig("old_firmware_action", updateBehavior)
     db_sysconfig.update_sysconfig("latest_version", firmwaretoinstall)
     db_sysconfig.update_sysconfig("old_version", firmwaretoinstallv6)
+    invalidate('firmware')
     db_syslog.add_syslog_event(get_myself(), "Firmware","settings", get_ip(),get_agent(),json.dumps(input))
     return buildResponse({'status': True}, 200)
 
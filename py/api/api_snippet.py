@@ -9,6 +9,7 @@ from flask import request,session
 
 from libs.db import db_user_tasks,db_syslog,db_tasks,db_sysconfig
 from libs.webutil import app, login_required,buildResponse,get_myself,get_ip,get_agent
+from libs.response_cache import cached,invalidate
 from functools import reduce
 import bgtasks
 import operator
@@ -19,6 +20,7 @@ log = logging.getLogger("api.snippet")
 
 @app.route('/api/snippet/list', methods = ['POST'])
 @login_required(role='admin',perm={'snippet':'read'})
+@cached('snippets')
 def user_snippet_list():
     """return snippets list """
     input = request.json
@@ -72,6 +74,7 @@ def user_snippet_save():
             return buildResponse({"result":"failed","err":"Snippet already exists"}, 200)
         snippet=db_user_tasks.create_snippet(name,description,content)
         if snippet:
+            invalidate('snippets')
             db_syslog.add_syslog_event(get_myself(), "Snippet","Create", get_ip(),get_agent(),json.dumps(input))
             return buildResponse({"result":"success"}, 200)
         else:
@@ -81,6 +84,7 @@ def user_snippet_save():
         if snippet:
             db_syslog.add_syslog_event(get_myself(), "Snippet","Update", get_ip(),get_agent(),json.dumps(input))
             snippet=db_user_tasks.update_snippet(id, name, description, content)
+            invalidate('snippets')
             return buildResponse({"result":"success"}, 200)
         else:
             return buildResponse({"result":"failed","err":"Snippet not found"}, 200)
@@ -94,6 +98,7 @@ def user_snippet_delete():
     if snippet:
         db_syslog.add_syslog_event(get_myself(), "Snippet","Delete", get_ip(),get_agent(),json.dumps(input))
         snippet=db_user_tasks.delete_snippet(id)
+        invalidate('snippets')
         return buildResponse({"result":"success"}, 200)
     else:
         return buildResponse({"result":"failed","err":"Failed to delete snippet"}, 200)
@@ -9,6 +9,7 @@ from flask import request
 
 from libs.db import db_sysconfig,db_syslog
 from libs import util
+from libs import red
 from libs.webutil import app, login_required,buildResponse,get_myself,get_ip,get_agent
 import time
 import logging
@@ -49,3 +50,18 @@ def sysconfig_save_all():
     db_sysconfig.save_all(data)
     
     return buildResponse({"status":"success"})
+
+
+@app.route('/api/sysconfig/stats', methods = ['POST'])
+@login_required(role='admin',perm={'settings':'read'})
+def sysconfig_stats():
+    """get runtime stats of background workers (data grabber, ...)"""
+
+    input = request.json or {}
+    name = input.get('name', None)
+    try:
+        stats = red.get_stats(name)
+    except Exception as e:
+        log.error(e)
+        return buildResponse({"status":"failed", "err":str(e)})
+    return buildResponse({"stats":stats})
@@ -8,6 +8,7 @@
 from uwsgidecorators import spool
 from playhouse.shortcuts import model_to_dict
 from libs import util
+from libs import aiorouteros
 import time
 from libs.db import db_tasks,db_device,db_events,db_user_group_perm,db_device
 from threading import Thread
@@ -250,6 +251,7 @@ def scan_with_mac(timer=2):
         database.execute_sql("SELECT setval('devices_id_seq', MAX(id), true) FROM devices")
         # update device list
         Devices.insert_many(data).on_conflict(conflict_target=Devices.mac,update={Devices.ip:EXCLUDED.ip,Devices.uptime:EXCLUDED.uptime,Devices.name:EXCLUDED.name,Devices.interface:EXCLUDED.interface,Devices.details:EXCLUDED.details}).execute()
+        db_device.devices_changed()
     return True
 
 
@@ -288,12 +290,12 @@ def scan_with_ip(*args, **kwargs):
 
  
         
-        for ip_int in range(int(start_ip), int(end_ip)):
-            ip=str(ipaddress.IPv4Address(ip_int))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(0.2)
-            result = sock.connect_ex((ip,int(scan_port)))
-            if result == 0:
+        # probe api port of the whole range concurrently, then talk to the ones listening
+        ip_list=[str(ipaddress.IPv4Address(ip_int)) for ip_int in range(int(start_ip), int(end_ip))]
+        probed=aiorouteros.probe_ports(ip_list,scan_port,timeout=0.5)
+        for ip in ip_list:
+            src_ip=probed.get(ip,False)
+            if src_ip:
                 scan_results.append({})
                 scan_results[dev_number]['ip']=ip
                 dev={
@@ -307,7 +309,7 @@ def scan_with_ip(*args, **kwargs):
                     'port':scan_port,
                     'ssl':False
                 }
-                router=RouterOSCheckResource(options)
+                router=util.connect_router(options)
                 try:
                     call = router.api.path(
                     "/system/resource"
@@ -365,7 +367,6 @@ def scan_with_ip(*args, **kwargs):
                         if inter['name']==current_interface:
                             result['interface']=inter
                             break
-                    src_ip=sock.getsockname()[0]
                     device={}
                     device['ip']=ip
                     device['update_availble']=is_availbe
@@ -408,7 +409,6 @@ def scan_with_ip(*args, **kwargs):
                 scan_results[dev_number]['added']=False
                 scan_results[dev_number]['faileres']="Not MikroTik or Device/Api Port not accessible"
                 dev_number+=1
-            sock.close()
         try:
             db_tasks.add_task_result('ip-scan', json.dumps(scan_results),json.dumps(info,default=serialize_datetime))
         except:
@@ -422,6 +422,7 @@ def scan_with_ip(*args, **kwargs):
                                                             Devices.name:EXCLUDED.name,
                                                             Devices.interface:EXCLUDED.interface,
                                                             Devices.details:EXCLUDED.details}).execute()
+            db_device.devices_changed()
         except Exception as e:
             log.error(e)
             task.status=0
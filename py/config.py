@@ -67,6 +67,76 @@ PYSRV_LOG_SQL = srvconf.get('PYSRV_LOG_SQL')
 # allow API access to this domain
 CORS_ALLOW_ORIGIN = srvconf.get('PYSRV_CORS_ALLOW_ORIGIN', '*')
 
+# data grabber mule: max concurrent device polls, poll interval (seconds)
+# and +/- jitter applied to every device's next due time (fraction of interval)
+GRABBER_WORKERS = int(srvconf.get('PYSRV_GRABBER_WORKERS', 50))
+GRABBER_INTERVAL = int(srvconf.get('PYSRV_GRABBER_INTERVAL', 60))
+GRABBER_JITTER = float(srvconf.get('PYSRV_GRABBER_JITTER', 0.1))
+# unreachable devices are retried after interval*2^(failures-1) seconds, capped at this
+GRABBER_MAX_BACKOFF = int(srvconf.get('PYSRV_GRABBER_MAX_BACKOFF', 900))
+# seconds between batched time series writes of the polled devices
+GRABBER_FLUSH_INTERVAL = float(srvconf.get('PYSRV_GRABBER_FLUSH_INTERVAL', 5))
+
+# syslog mule: kernel receive buffer (bytes), parse threads, max datagrams
+# waiting to be parsed and how often parsed rows are written (ms)
+SYSLOG_RCVBUF = int(srvconf.get('PYSRV_SYSLOG_RCVBUF', 8*1024*1024))
+SYSLOG_WORKERS = int(srvconf.get('PYSRV_SYSLOG_WORKERS', 4))
+SYSLOG_QUEUE = int(srvconf.get('PYSRV_SYSLOG_QUEUE', 50000))
+SYSLOG_FLUSH_MS = int(srvconf.get('PYSRV_SYSLOG_FLUSH_MS', 200))
+
+# radius mule: worker processes sharing the radius ports (SO_REUSEPORT),
+# threads per worker doing its database and router work
+RADIUS_WORKERS = int(srvconf.get('PYSRV_RADIUS_WORKERS', 1))
+RADIUS_THREADS = int(srvconf.get('PYSRV_RADIUS_THREADS', 16))
+
+# RouterOS API client used for polling: "asyncio" (libs/aiorouteros) or "librouteros"
+ROUTEROS_API_BACKEND = srvconf.get('PYSRV_ROUTEROS_API_BACKEND', 'asyncio')
+
+# pooled RouterOS API connections: max connections per process, seconds a
+# connection may stay idle / stay open at all, idle seconds after which a
+# connection is health checked before reuse
+ROUTEROS_POOL_SIZE = int(srvconf.get('PYSRV_ROUTEROS_POOL_SIZE', 1000))
+ROUTEROS_POOL_IDLE = int(srvconf.get('PYSRV_ROUTEROS_POOL_IDLE', 180))
+ROUTEROS_POOL_MAX_AGE = int(srvconf.get('PYSRV_ROUTEROS_POOL_MAX_AGE', 3600))
+ROUTEROS_POOL_HEALTH = int(srvconf.get('PYSRV_ROUTEROS_POOL_HEALTH', 120))
+
+# seconds a process serves cached sysconfig rows (libs/db/db_sysconfig.py)
+# without a change notification
+SYSCONFIG_CACHE_TTL = int(srvconf.get('PYSRV_SYSCONFIG_CACHE_TTL', 30))
+
+# seconds the API options (decrypted credentials) of a device are kept in
+# process memory, device edits drop them right away
+API_OPTIONS_TTL = int(srvconf.get('PYSRV_API_OPTIONS_TTL', 60))
+
+# seconds the cached local user list of a device is trusted when the
+# poller stops refreshing it
+LOCAL_USERS_TTL = int(srvconf.get('PYSRV_LOCAL_USERS_TTL', 3600))
+
+# seconds a permission group applied to a device by a radius login is
+# trusted to be still in place
+PERM_SYNC_TTL = int(srvconf.get('PYSRV_PERM_SYNC_TTL', 3600))
+
+# log list endpoints: default and max rows per page
+LOGS_PAGE_SIZE = int(srvconf.get('PYSRV_LOGS_PAGE_SIZE', 100))
+LOGS_PAGE_MAX = int(srvconf.get('PYSRV_LOGS_PAGE_MAX', 5000))
+
+# months of auth, account and events history kept by the maintenance mule
+# (whole monthly partitions are dropped), 0 keeps everything
+LOGS_RETENTION_MONTHS = int(srvconf.get('PYSRV_LOGS_RETENTION_MONTHS', 0))
+# seconds between maintenance runs
+MAINTENANCE_INTERVAL = int(srvconf.get('PYSRV_MAINTENANCE_INTERVAL', 3600))
+# seconds between dashboard snapshots and between license/news fetches
+DASHBOARD_REFRESH = int(srvconf.get('PYSRV_DASHBOARD_REFRESH', 60))
+DASHBOARD_NEWS_REFRESH = int(srvconf.get('PYSRV_DASHBOARD_NEWS_REFRESH', 3600))
+
+# seconds a cached API response (libs/response_cache.py) may be served when
+# none of its tags was invalidated
+RESPONSE_CACHE_TTL = int(srvconf.get('PYSRV_RESPONSE_CACHE_TTL', 300))
+
+# seconds the device set a user may access (db_user_group_perm) is cached,
+# group and permission changes drop it right away
+DEVICE_SCOPE_TTL = int(srvconf.get('PYSRV_DEVICE_SCOPE_TTL', 3600))
+
 START_TIME = int(time.time())
 
 
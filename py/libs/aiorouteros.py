@@ -0,0 +1,305 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# aiorouteros.py: asyncio implementation of the RouterOS API protocol
+#   - login (post 6.43 plain and pre 6.43 challenge), tagged commands
+#   - many device conversations multiplexed on one event loop thread
+#   - SyncApi: librouteros compatible facade, so .path()/select()/add()
+#     and the routeros_check resources keep working on top of it
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import asyncio
+import os
+import ssl
+import threading
+from typing import Any, Dict, List, Optional
+
+from librouteros.api import Api
+from librouteros.login import encode_password
+from librouteros.protocol import Encoder, Decoder, compose_word, parse_word
+from librouteros.exceptions import ConnectionClosed, FatalError, TrapError, MultiTrapError
+from libs.check_routeros.routeros_check.resource import RouterOSCheckResource
+
+import logging
+log = logging.getLogger("aiorouteros")
+
+
+# --------------------------------------------------------------------------
+# shared event loop, one per process
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    """Return the process wide event loop running in a daemon thread."""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            try:
+                import uvloop
+                _loop = uvloop.new_event_loop()
+            except ImportError:
+                _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            t = threading.Thread(target=_loop.run_forever, name="routeros-loop", daemon=True)
+            t.start()
+    return _loop
+
+def run_sync(coro, timeout=None):
+    """Run coroutine on the shared loop and wait for the result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+# --------------------------------------------------------------------------
+# protocol
+
+class _Pending(object):
+    def __init__(self, future):
+        self.future = future
+        self.rows = []
+        self.traps = []
+
+    def finish(self):
+        if self.future.done():
+            return
+        if len(self.traps) > 1:
+            self.future.set_exception(MultiTrapError(*self.traps))
+        elif self.traps:
+            self.future.set_exception(self.traps[0])
+        else:
+            self.future.set_result(self.rows)
+
+
+class AsyncApi(Encoder, Decoder):
+    """One API session. Every command is sent with its own .tag so any
+    number of commands can be in flight, replies are demultiplexed by tag."""
+
+    def __init__(self, reader, writer, timeout=10, encoding='ASCII'):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.encoding = encoding
+        self.pending: Dict[str, _Pending] = {}
+        self.tag_seq = 0
+        self.closed = False
+        self.reader_task = None
+
+    @classmethod
+    async def connect(cls, host, username, password, port=8728, timeout=10, ssl_ctx=None, server_hostname=None):
+        kwargs = {}
+        if ssl_ctx:
+            kwargs['ssl'] = ssl_ctx
+            kwargs['server_hostname'] = server_hostname or host
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port), **kwargs), timeout)
+        api = cls(reader, writer, timeout=timeout)
+        api.reader_task = asyncio.ensure_future(api._read_loop())
+        try:
+            await api.login(username, password)
+        except Exception:
+            api.close()
+            raise
+        return api
+
+    async def login(self, username, password):
+        res = await self.call('/login', name=username, password=password)
+        if res and 'ret' in res[0]:
+            # pre 6.43 device, answer the md5 challenge
+            await self.call('/login', name=username, response=encode_password(res[0]['ret'], password))
+
+    def send(self, cmd: str, *words: str, **kwargs: Any) -> asyncio.Future:
+        """Write one tagged sentence, return future of its reply rows."""
+        if self.closed:
+            raise ConnectionClosed('Connection closed.')
+        self.tag_seq += 1
+        tag = str(self.tag_seq)
+        sentence = [cmd]
+        sentence.extend(compose_word(key, value) for key, value in kwargs.items())
+        sentence.extend(words)
+        sentence.append('.tag=' + tag)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[tag] = _Pending(future)
+        self.writer.write(self.encodeSentence(*sentence))
+        future.add_done_callback(lambda f: self.pending.pop(tag, None))
+        return future
+
+    async def call(self, cmd: str, *words: str, **kwargs: Any) -> List[Dict[str, Any]]:
+        return await asyncio.wait_for(self.send(cmd, *words, **kwargs), self.timeout)
+
+    async def print(self, path: str, proplist: Optional[List[str]] = None, *query: str, **kwargs: Any) -> List[Dict[str, Any]]:
+        """/print of path, optionally restricted to proplist columns."""
+        words = list(query)
+        if proplist:
+            words.insert(0, '=.proplist=' + ','.join(proplist))
+        return await self.call(path.rstrip('/') + '/print', *words, **kwargs)
+
+    async def _read_sentence(self) -> List[str]:
+        words = []
+        while True:
+            byte = await self.reader.readexactly(1)
+            if byte == b'\x00':
+                return words
+            to_read = self.determineLength(byte)
+            if to_read:
+                byte += await self.reader.readexactly(to_read)
+            length = self.decodeLength(byte)
+            word = await self.reader.readexactly(length)
+            words.append(word.decode(encoding=self.encoding, errors='ignore'))
+
+    async def _read_loop(self):
+        try:
+            while True:
+                words = await self._read_sentence()
+                if not words:
+                    continue
+                reply_word = words[0]
+                if reply_word == '!fatal':
+                    raise FatalError(words[1] if len(words) > 1 else 'fatal')
+                tag = None
+                row = {}
+                for word in words[1:]:
+                    if word.startswith('.tag='):
+                        tag = word[5:]
+                    elif word.startswith('='):
+                        key, value = parse_word(word)
+                        row[key] = value
+                pending = self.pending.get(tag)
+                if pending is None:
+                    continue
+                if reply_word == '!trap':
+                    pending.traps.append(TrapError(message=str(row.get('message', '')), category=row.get('category')))
+                elif reply_word in ('!re', '!done') and row:
+                    pending.rows.append(row)
+                if reply_word == '!done':
+                    pending.finish()
+        except asyncio.IncompleteReadError:
+            self._fail(ConnectionClosed('Connection unexpectedly closed.'))
+        except asyncio.CancelledError:
+            self._fail(ConnectionClosed('Connection closed.'))
+        except Exception as e:
+            self._fail(e)
+
+    def _fail(self, exc):
+        self.closed = True
+        for pending in list(self.pending.values()):
+            if not pending.future.done():
+                pending.future.set_exception(exc)
+        self.pending.clear()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+    def close(self):
+        if self.reader_task and not self.reader_task.done():
+            self.reader_task.cancel()
+        self._fail(ConnectionClosed('Connection closed.'))
+
+
+# --------------------------------------------------------------------------
+# blocking facade
+
+class SyncApi(Api):
+    """librouteros Api compatible wrapper of AsyncApi.
+    Commands run on the shared loop, the calling thread only waits."""
+
+    def __init__(self, aapi: AsyncApi):
+        self.aapi = aapi
+        self.protocol = None
+
+    def _run(self, coro):
+        # loop side timeout is aapi.timeout, this is only a safety net
+        return run_sync(coro, self.aapi.timeout + 5)
+
+    def __call__(self, cmd: str, **kwargs: Any):
+        return iter(self._run(self.aapi.call(cmd, **kwargs)))
+
+    def rawCmd(self, cmd: str, *words: str):
+        return iter(self._run(self.aapi.call(cmd, *words)))
+
+    def pipeline(self, commands):
+        """Send [(cmd, word, ...), ...] without waiting in between, replies
+        are matched by tag. Returns rows per command, or its exception."""
+        async def run():
+            futures = [self.aapi.send(*cmd) for cmd in commands]
+            return await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), self.aapi.timeout)
+        return self._run(run())
+
+    def close(self) -> None:
+        if not self.aapi.closed:
+            get_loop().call_soon_threadsafe(self.aapi.close)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def connect_sync(host, username, password, port=8728, timeout=10, ssl_ctx=None, server_hostname=None) -> SyncApi:
+    aapi = run_sync(AsyncApi.connect(host, username, password, port=port, timeout=timeout, ssl_ctx=ssl_ctx, server_hostname=server_hostname), timeout * 3)
+    return SyncApi(aapi)
+
+
+class AsyncApiMixin(object):
+    """Mix into any RouterOSCheckResource (or check) to connect via AsyncApi."""
+
+    def _ssl_context(self):
+        opts = self._cmd_options
+        context_kwargs = {}
+        if opts.get("ssl_cafile"):
+            context_kwargs["cafile"] = opts["ssl_cafile"]
+        if opts.get("ssl_capath"):
+            context_kwargs["capath"] = opts["ssl_capath"]
+        ssl_ctx = ssl.create_default_context(**context_kwargs)
+        if opts.get("ssl_force_no_certificate"):
+            ssl_ctx.check_hostname = False
+            ssl_ctx.set_ciphers("ADH:@SECLEVEL=0")
+        elif not opts.get("ssl_verify"):
+            ssl_ctx.check_hostname = False
+            ssl_ctx.verify_mode = ssl.CERT_NONE
+        elif not opts.get("ssl_verify_hostname"):
+            ssl_ctx.check_hostname = False
+        return ssl_ctx
+
+    def _connect_api(self) -> SyncApi:
+        opts = self._cmd_options
+        ssl_ctx = None
+        port = opts.get("port")
+        if opts.get("ssl"):
+            ssl_ctx = self._ssl_context()
+            port = port or 8729
+        return connect_sync(
+            opts["host"],
+            opts["username"],
+            opts["password"],
+            port=port or 8728,
+            timeout=opts.get("timeout", 5),
+            ssl_ctx=ssl_ctx,
+            server_hostname=opts.get("hostname"),
+        )
+
+class AsyncRouterOSCheckResource(AsyncApiMixin, RouterOSCheckResource):
+    pass
+
+
+# --------------------------------------------------------------------------
+# helpers
+
+async def _probe(host, port, timeout, sem):
+    async with sem:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+        except Exception:
+            return host, False
+        src = writer.get_extra_info('sockname')[0]
+        writer.close()
+        return host, src
+
+def probe_ports(hosts, port, timeout=0.5, limit=256):
+    """TCP connect to port of all hosts concurrently.
+    Returns {host: local address used to reach it or False}"""
+    async def run():
+        sem = asyncio.Semaphore(limit)
+        return await asyncio.gather(*[_probe(host, port, timeout, sem) for host in hosts])
+    return dict(run_sync(run()))
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# auth_correlator.py: match radius auth rows with the syslog lines of the
+#   same login (the device logs 'via winbox/ssh/...' only to syslog)
+#   - radius mule publishes every row it inserts on the 'auth' channel
+#   - syslog mule keeps both sides in memory per (device, type, user)
+#     and completes the radius row as soon as both arrived
+#   - reconciler thread writes matches and gives up on lines waiting
+#     longer than WAIT, those fall back to one db lookup (add_log)
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import threading
+import time
+
+from libs import red
+from libs.db import db_AA
+
+import logging
+log = logging.getLogger("auth_correlator")
+
+# max seconds between the radius row and the syslog line of one login
+WINDOW = 2
+# seconds a syslog line waits for its radius row
+WAIT = 10
+
+
+def publish(event):
+    """Announce a radius Auth row to the correlators, never raises."""
+    if not event:
+        return
+    red.publish('auth', {
+        'id': event.id,
+        'devid': int(event.devid_id),
+        'ltype': event.ltype,
+        'username': event.username,
+        'ts': event.started,
+    })
+
+
+class AuthCorrelator(object):
+
+    def __init__(self, window=WINDOW, wait=WAIT, stats=None):
+        self.window = window
+        self.wait = wait
+        self.stats = stats
+        self.lock = threading.Lock()
+        # (devid, ltype, username) -> [(ts, row id, arrived)]
+        self.radius = {}
+        # (devid, ltype, username) -> [syslog line dicts]
+        self.syslog = {}
+        # [(syslog line, [row ids])] waiting to be written
+        self.ready = []
+
+    def _incr(self, key):
+        if self.stats:
+            self.stats.incr(key)
+
+    def start(self):
+        red.subscribe('auth', self.radius_record)
+        threading.Thread(target=self.run, name="auth-correlator", daemon=True).start()
+
+    def radius_record(self, message):
+        """'auth' channel callback, message is None after a reconnect (the
+        fallback lookup of expired lines covers what we missed)."""
+        if not message or not message.get('ts'):
+            return
+        key = (message['devid'], message['ltype'], message['username'])
+        with self.lock:
+            lines = self.syslog.get(key, [])
+            for idx, line in enumerate(lines):
+                if abs(line['timestamp'] - message['ts']) <= self.window:
+                    del lines[idx]
+                    self.ready.append((line, [message['id']]))
+                    return
+            self.radius.setdefault(key, []).append((message['ts'], message['id'], time.time()))
+
+    def syslog_record(self, devid, type, username, ip, by, timestamp=False, message='radius'):
+        """Syslog side of a radius login, returns at once."""
+        line = {'devid': devid, 'type': type, 'username': username.strip(), 'ip': ip,
+                'by': by, 'timestamp': timestamp, 'message': message}
+        key = (devid, type, line['username'])
+        with self.lock:
+            rows = self.radius.get(key, [])
+            ids = [row[1] for row in rows if abs(row[0] - timestamp) <= self.window]
+            if ids:
+                self.radius[key] = [row for row in rows if row[1] not in ids]
+                self.ready.append((line, ids))
+                return
+            line['deadline'] = time.time() + self.wait
+            self.syslog.setdefault(key, []).append(line)
+
+    def reconcile(self):
+        now = time.time()
+        expired = []
+        with self.lock:
+            ready, self.ready = self.ready, []
+            for key in list(self.syslog):
+                lines = self.syslog[key]
+                expired.extend(line for line in lines if line['deadline'] <= now)
+                lines = [line for line in lines if line['deadline'] > now]
+                if lines:
+                    self.syslog[key] = lines
+                else:
+                    del self.syslog[key]
+            keep = self.wait + self.window
+            for key in list(self.radius):
+                rows = [row for row in self.radius[key] if now - row[2] < keep]
+                if rows:
+                    self.radius[key] = rows
+                else:
+                    del self.radius[key]
+        for line, ids in ready:
+            try:
+                db_AA.Auth.attach_syslog(ids, line['type'], line['by'], line['timestamp'], line['message'])
+                self._incr("auth_matched")
+            except Exception as e:
+                log.error(e)
+        for line in expired:
+            # radius row was missed or never written, one last look in the db
+            try:
+                db_AA.Auth.add_log(line['devid'], line['type'], line['username'], line['ip'], line['by'],
+                                   timestamp=line['timestamp'], message=line['message'])
+                self._incr("auth_unmatched")
+            except Exception as e:
+                log.error(e)
+
+    def run(self):
+        while True:
+            time.sleep(0.5)
+            try:
+                self.reconcile()
+            except Exception as e:
+                log.error(e)
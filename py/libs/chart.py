@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# chart.py: chart payloads (labels + datasets) from redis (ts, value) series
+#   - one shared label axis for all datasets of a chart
+#   - timezone offset resolved once per chart, not per point
+#   - optional epoch ms labels + tz offset, formatted by the frontend
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import datetime
+import time
+import pytz
+
+import logging
+log = logging.getLogger("chart")
+
+LABEL_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+
+def tz_offset(tz, ts_ms):
+    """(utc offset in seconds, abbreviation) of timezone tz at epoch ms ts_ms."""
+    if type(tz) is str:
+        tz = pytz.timezone(tz)
+    local = datetime.datetime.fromtimestamp(ts_ms / 1000, tz)
+    return int(local.utcoffset().total_seconds()), local.strftime("%Z")
+
+def axis(series):
+    """Sorted union of the timestamps of all series."""
+    if len(series) == 1:
+        return [p[0] for p in series[0]]
+    stamps = set()
+    for points in series:
+        stamps.update(p[0] for p in points)
+    return sorted(stamps)
+
+def values_on_axis(ax, points, ndigits=1):
+    """Values of points at every axis timestamp, None where missing."""
+    if len(points) == len(ax) and (not ax or (points[0][0] == ax[0] and points[-1][0] == ax[-1])):
+        return [round(p[1], ndigits) for p in points]
+    values = {p[0]: round(p[1], ndigits) for p in points}
+    return [values.get(ts) for ts in ax]
+
+def format_labels(ax, tz, fmt=LABEL_FORMAT):
+    """Local time strings of axis timestamps."""
+    if not ax:
+        return []
+    first, first_abbr = tz_offset(tz, ax[0])
+    last, last_abbr = tz_offset(tz, ax[-1])
+    if first == last:
+        suffix = " " + first_abbr
+        gmtime = time.gmtime
+        strftime = time.strftime
+        return [strftime(fmt, gmtime(ts // 1000 + first)) + suffix for ts in ax]
+    # the window crosses a DST change, offset per point
+    zone = pytz.timezone(tz) if type(tz) is str else tz
+    fmt_tz = fmt + " %Z"
+    return [datetime.datetime.fromtimestamp(ts / 1000, zone).strftime(fmt_tz) for ts in ax]
+
+def build(data, keys, styles, tz="UTC", epoch=False, labels=None):
+    """{'labels': [...], 'datasets': [...]} of the series data[key] for keys,
+    styles[i] holds the chart options of dataset i.
+    epoch: labels are epoch ms, 'tz' and 'tz_offset' (seconds) are added.
+    labels: optional callable building labels from the axis instead."""
+    series = [data.get(key) or [] for key in keys]
+    ax = axis(series)
+    datasets = []
+    for points, style in zip(series, styles):
+        dataset = dict(style)
+        dataset['data'] = values_on_axis(ax, points)
+        datasets.append(dataset)
+    res = {'datasets': datasets}
+    if epoch:
+        res['labels'] = ax
+        res['tz'] = str(tz)
+        res['tz_offset'] = tz_offset(tz, ax[-1] if ax else int(time.time() * 1000))[0]
+    elif labels:
+        res['labels'] = labels(ax)
+    else:
+        res['labels'] = format_labels(ax, tz)
+    return res
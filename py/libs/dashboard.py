@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# dashboard.py: precomputed dashboard stats
+#   - rows written to auth, account and events are counted in redis as
+#     they are written: 5 minute buckets for the last 24h + totals
+#   - the maintenance mule turns the counters, serial, license and news
+#     into one snapshot, /api/dashboard/stats only reads it
+#   - buckets missing in redis are seeded from the database once a day
+#     and totals are re-counted every TOTALS_REFRESH seconds
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import datetime
+import json
+import time
+
+from libs import red
+import config
+
+import logging
+log = logging.getLogger("dashboard")
+
+PREFIX = "mikrowizard::dashboard::"
+SNAPSHOT_KEY = PREFIX + "snapshot"
+VERSIONCHECK_KEY = PREFIX + "versioncheck"
+SEEDED_KEY = PREFIX + "seeded"
+SEED_LOCK_KEY = PREFIX + "seed_lock"
+BUCKET = 300
+WINDOW = 86400
+TOTALS_REFRESH = 3600
+
+# snapshot field -> counter of the last 24h
+RECENT = {
+    'FailedLogins': 'auth_failed',
+    'SuccessfulLogins': 'auth_loggedin',
+    'Critical': 'events_Critical',
+    'Warning': 'events_Warning',
+    'Info': 'events_info',
+}
+# snapshot field -> running total
+TOTALS = {
+    'Events': 'events',
+    'Auth': 'auth',
+    'Acc': 'account',
+}
+
+FEED_URL = "https://mikrowizard.com/tag/Blog/feed/?orderby=latest"
+UPDATE_URL = "https://mikrowizard.com/wp-json/mikrowizard/v1/get_update"
+TEST_URL = "https://google.com"
+NO_CONNECTION = {
+    "content": "Unable to connect to mikrowizard.com! please check server connection",
+    "media_content": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAJYAAACWCAMAAAAL34HQAAAC7lBMVEUAAADZ5+zY5+10g45ic3x6jJjO3uTG0tfa6e7Z5+zN2t1jdYADvtcCwtt4iZXT4ebX5ux5i5f+ZG/T4eYDvtcDuNBxgYwDt83sZm//ZG8DvtcDvtgDvtdcbHZgcXsCvtgDvtcCtcz/ZG8DuM4DuM5zi5b/ZG97jJkDvdcDu9UDutUCtc3rWGV2iJMDu9QDudIDudEDtMwCt83Y5+x6jJh4iZUCvNYDvNUDvNX/Ym0EuNDX5uwCt9DrY2xeb3r/Y24Dvtj/Y27/ZG7X4+j+Y24DudJ5ipb6ZG77Ym1kdX/4YGsCts4Ctcz4Y232Y2z3ZW5UZm4CscddcHrZ6O1fcXvS4OT6fIba5ep6jJhGWmH/ZG9gdH5idX/Y5+0DvddidH9idX9FWWB+jpcCtcrtYmvtpq7iztRfcXza5+xbbnd5i5Z3iZV5i5b/Y27X5Op5ipZGWWB3iJNwgo3Q3ePwYmzU4eNGWmFrfYlSZm1GWmFGWWD/Y216jJhfcnz9Y253iJT3YWtUZ2/U4uSHmaSDlKBiz+DymaFxg47Q3+XY5+zovcRGyd3/Y25hc33T4ec4xdrO3eFHWmLR3+N3ipN2ipPN2t4Dvtd6jJjI7/4BvtdZbHb+ZG/Z5+yZ5vwAvdcRvNRGWmHF7/4Ivtd7i5fE7v4+yd9FzOSE3e9dmqgXwdlOobOm5veW5vt01OkRwdkIv9lXnrDK8P8YudIPudFVgpDC7v4bwtq97f0vxd0kxN0zx98rxNwNv9ghwdp8i5e66/ub4/VMzONj1e1f0+u/7f2s5/mK4vmC3/Z83fSP3vFW0Oc5yeFzhZCb5/2T5fto1+9v1elp1Oli0uda0Oc+yuJSZW216vuy6vqA2+562u1y2OxhdH+p5vdv2fFSzeM1yeJGyeAfxNyJ3vE2xd2p6f2v6Pmj5fZ12/L9ZG9HW2KP4/pS0Ohaz+VbbniU4vRa1Ov9anWg4/VtgIuj6P1p0eMft84jts6KmqZskZ5afouUMHeQAAAAlnRSTlMA+OQOCamEC8nUM778BcWKYtj+i+JmFw0K9e/p9RsS2tEr7R0SBtzXwpyWTxH9ink7NBX9+sewqaOMcWFZFvjRysnApJKCe3pwUklGQUA3LyMZ5dtvT/318PDp3NS9ubackCcjIf788u3k4Lqwno6KWlgyIhsY+eTd0LKioIyCalw/D/jr5eDc2NHDsa+nl5R3aGY3NjFlHZE5AAAKt0lEQVR42u2Zd1wbZRjHr9YtcVQoCFhAaGVoKVSB1larta5Wbd1777333nv7mMcmp8QQPJsmRg0JJDGEPZRVZAnILLXU1rr9z+eSuxAMIzSeiR/v+0dy97kEvp/3ee537/uGkZGRkZGRkZGRkZGRkZHZZaJTsrOjFUwYkbw6KjM9LS83Ny991dKMpLBwuzoqLTUhNgIE4iNX5KxaFGIzxaK0xDj4O/EJl0WlMKGCpHLjImAiImJXhEpMkbyQpNDIcUDY+w0INgcQBgcdQvxla6KZCZk/e56b2VOy+y7eeRmJvFSxrrzVCFA02liCmo7CAkAs6Wru40gsdlUy48/ua8+5/JKLL774kptv2WMKHrn9zqvmz9xqXWYcGRSPjmytM9J7o7qatAq1lb2IWFDZ3tkHJJaT5fe9eeec9T7x7U/vTcvhj8+d8f2XRkMFuh69vsyAaOv5eqi0gNUU5ivbN5Ftb5tyeKMVERIz/m716A9uq6/eC4Cjbp89M6ukXLIqKqtS60eKEftH1EPmDR4tZds2RE2z2WQudVFxE5YpxlXwnGMDtyKvk2aWnzkAaGzUq9VV9Swae/TtZpOopax0IToGTEpldwHwXowPh178Pg9VMDAOuooJnOycCCDqa/QNOxCwvKFdq1QKWkTpIEJfpamtyQG812pmjFPdVj8cGajWBTMYLkV6PGjsGoDiHTVFiK1VQ2Tlo5XfxYG9qdTFIRjsCKlJYzW8wq317R8fT4+ninsErhVFuV5SVm9HsBcBciNDZqWPFmHp0yDn0CBYu5qNCGnZXq3L3Vp//vbBtPz68Ue81/4BW2Ul0jj1qKtGixAAWF11m3K8ltnZaQAANPSV5ju3IUREKUSt/dxaX3wG04GffzozrWiKBkO5Wq1uaKy3AwCl587KNougZXYOdw+4+JTHwSbet7KAhYQk6bWWUYzqGtTE1z1UQ4JFa+/G2k4ralpqO1oK7CyLiMA2VSgJba2DyqjYVa2jA033XAqsarVbq9wAhmLkLVgCQXin12Ibsts8xXW2IMQuklorI5YSQe/WamgFrN9e2lSCnvEBQLdYf13t5kIWuQ1uLRPlRUSuxEXMTgMsrla7qbGhfYdFaWnvHmjWWYsAaOxa6zp3Dju1yuF+ZAvNbi9tM0DkImm1kuKALW/w1LDMAI5qJY+5wmIprUdNp9NSYc53l24by9Y5heGyYvxCSbUUUYCGGrWHUYTBYSXhGxACZqpicbvnWNsLsCJFSq2UHAqqKo9VVSsaXWY/LYHNiLhBOO4sgsgMKbWSKR0a9UJrWdHeqJxMq7KEZQu1nuNuK8SvklJrNf+w+VotpBZyA5NqtfeybLMwlvl9ALkKCQMik0K9Wi10vBEdlZNqWZpY1FUIJy12SE2WUCsNWFeVqIVgs0yqlU89XyJe7uAgcZGERUwFdpNe7aGchRLzpFqmWroVRa1Svucl1EqgiFfr3TTUsdBaoRXJ30xaHWbvubIWkXMKJ5UOiIuSUCuSMv47gSIETjdGPYdg9TkvAYBW4bhVA7FSasXCrhK/VFotZAVQOPY5Z33xvYykJW0R6zd5qLMiFDdt9NJSjODaOEYvgka83GygIkoYEInjW76+Il9EaHnvKd/yRU7hhG/5ZRJqXQZs3cQBYQplQKQDqwssTrUdLH4nXqYlR2KWhFpLAa01glajER0bJtVyNrPoEh8+m4z08JFQa1EEGkYErZ5+5KoDelRrCwDyGAm11kUCWyZObErQXjapVrcV2QGtMPeyQWymlMvX6DxgW4Xm2tqHoLNMprUTEbuF7u/iIHKN72L/40+m5dM/ZrDYVywDtIuT5jpE69D4O1FpEifN1PHWNmGO40JIjR63NfLRlx8RXxKTvs9oayQpgSJiq3ArcuioyScjk8m5odS9fN2+uV1r4tWcLpbd5BSiwobxmcJG0lkz20i66a4Al/oLhdUrUW1FY53FZCntbNrWN1hsBOCsBb2/bKylpcUwh2ytp7UqWhAik8RtN89m4JH/9LbbmkjAUc+KTK8DLKnp6h3kEMXlK2G09bUMdFKYelrLtN2GEeni5sjcK2bi9UjAm6cp6YCc0F1lHNgdvBNoDBynATBwBjvwZg4Hsi2e1qJNS4ijwRK9Hr3es0350bRDdcFJZBUoqxMAvnN3l37EAQAInK2grmugowQ1zbUd5X2DDiMCANtpcWdWoREjFip8duXvuuKSs2688az7nz/Iw01HfiVw5EFjHH3LSTPaAFcsjAD7qJ4CoqyYtypq7drs3Q3kD9oHNg1qANDYUkmnO60IicnMFLx54fcCF65ldp2k1Ago6mmo1iHBx5jFL7e6DICIrG27ZbiXhVjabZ6CKz/0cgcTBBnU9bbyehZYQwmiofHnir9pDRcA2gqQrjW1IEQsjGam4NCHxrSunB+EliIzHhDJqr6nph/Zkuoh8zgtbbMBua4NzRwSADnJzFQ8+eCY1oO7M0GQQu1FjFar9Y0I6NpKXj5aFJ/oajM5B6xApGYxU3LHhWNa1FzBkJ0OALiD4qtKx6Jxh35o7OcCUymVz1bKBxavlbiGmZLdqbW83HcHE5wXjRdyuiq9uqYYkWvU/1whanW7ELgurbKicNAOEbSYnpq1D/lqXckER8qqeACjrbFBTzskUERe2wuQtMgK6JFUYe7exgHE008FkzN/3tpTTz3ngW98eODtd+46NJgGi45KoAaz149UlZMXV77V/cNdxWaqoNFVWdnUDwCxeclTNvsl9CDyT/wLbp/LBMGanFgAhPqyVj47dWU21DR19CNgf0dLEYtUwKVT5tVcmqry/OD3c9nj84PxWrd0BQ0YiwYjkJjBgNCPyOc+khREpk9zC55Kk5yJH9s3z2aCIitzBW8EPIg+RySVEc1Mo3XjZFq3kFZQKJKi8uLAjxWr1qQw0zGbJvYTTgqPupOKGKxYdlZUHnW/l7jLMldfHc0EwNpXrz+W5/r7b3r699+fOVzg5juFwQrWLHrd1aujXn/2l19eXrosa10KOQXGvEMFrnph1qw95831MG8+8w+y796LFx+4i39xr31Uqj0ZKSAtlepARtYKXOsYWeu/X0RZS9Yi/k9aYRoQYaoVpkWUtWQt4v+kNWFAHBHje7Y8Jjy0Tn/41jMZkZhTXjl5eTgU8fTjt2w5wet18mFbDlmyPPRaZxw3Z/36OcefKVqtX7/+kCVHhFprOW/l9XqMrHivU2JCrHXNIaQheMXQWHlYEhPilo9ZInqdcIbXasEZ/2IR352wt444UfS6SLQ67jT/lj9bMq27L1WpbmP8WE7jJSJa+X/3BtWsNxhJeGqlSnX2uROk6RIaJi9zJrK697bFqt3oq5Lw1g3ktfLgAw4++ADiYML9fsDK534c0zrvpdsOGHedXl+79HyV6tJ7GUmg4ZqlUqlm+XP+tT96ra473//6YpVKusGiWqw8n/6DP4t9tSb8wCyqvnTsde7KF3fz4wayEvnxvOv8P3D2pXvezfzbiCnqzS8mHIg55aL1vmwJCy+v1ZzDDgkfr5hTvNn+hJj3/DwnxFwjjtWC05jlXq/HYpjQcs8Cwep0n+fjFprYhJjTFohWXq85t97DhBzyEqwErzkPX8OEAU8cf/zpPs/tBbeGhRVNbY4Y120h7ysZGRkZGRkZGRkZGZnw5y+SNQaey9oeNQAAAABJRU5ErkJggg==",
+    "summery": "Unable to connect mikrowizard.com to get latest News! <a  target=\"_blank\" href=\"https://mikrowizard.com/plan-your-project-with-your-software/\">Read More</a>",
+    "title": "Connection Error"
+}
+
+
+# --------------------------------------------------------------------------
+# counting, called by the db models for every row they insert
+
+def _bucket(ts=None):
+    return int(ts if ts is not None else time.time()) // BUCKET
+
+def _recent_key(name, bucket):
+    return "{}{}::{}".format(PREFIX, name, bucket)
+
+def _total_key(name):
+    return "{}total::{}".format(PREFIX, name)
+
+def count(total, rows=1, recent=()):
+    """rows more rows in the running total total, recent holds the 24h
+    counter of every one of them (if any). Never raises."""
+    try:
+        bucket = _bucket()
+        pipe = red.get_connection().pipeline(transaction=False)
+        for name in set(recent):
+            key = _recent_key(name, bucket)
+            pipe.incrby(key, recent.count(name))
+            pipe.expire(key, WINDOW + BUCKET)
+        pipe.incrby(_total_key(total), rows)
+        pipe.execute()
+    except Exception as e:
+        log.error(e)
+
+def count_auth(ltypes):
+    count('auth', len(ltypes), ["auth_" + str(t) for t in ltypes])
+
+def count_account(rows=1):
+    count('account', rows)
+
+def count_events(levels):
+    count('events', len(levels), ["events_" + str(l) for l in levels])
+
+
+# --------------------------------------------------------------------------
+# reading, the endpoint only calls get_snapshot()
+
+def recent_counts():
+    """{counter: rows of the last 24h} of the RECENT counters."""
+    now = _bucket()
+    buckets = range(now - WINDOW // BUCKET + 1, now + 1)
+    names = list(RECENT.values())
+    keys = [_recent_key(name, b) for name in names for b in buckets]
+    values = red.get_connection().mget(keys)
+    per = len(buckets)
+    return {name: sum(int(v) for v in values[i * per:(i + 1) * per] if v) for i, name in enumerate(names)}
+
+def total_counts():
+    names = list(TOTALS.values())
+    values = red.get_connection().mget([_total_key(name) for name in names])
+    return {name: int(v) if v else 0 for name, v in zip(names, values)}
+
+def get_snapshot():
+    data = red.get_connection().get(SNAPSHOT_KEY)
+    return json.loads(data) if data else None
+
+def request_versioncheck():
+    """Ask the refresher to send versioncheck with its next update query."""
+    red.get_connection().set(VERSIONCHECK_KEY, 1, ex=config.DASHBOARD_NEWS_REFRESH)
+
+
+# --------------------------------------------------------------------------
+# seeding from the database (maintenance mule)
+
+def _epoch(dt):
+    # timestamps are naive local time like datetime.now(), text on sqlite
+    if isinstance(dt, str):
+        dt = datetime.datetime.fromisoformat(dt)
+    return time.mktime(dt.timetuple())
+
+def _minute(field):
+    from peewee import fn
+    if config.IS_SQLITE:
+        return fn.strftime('%Y-%m-%d %H:%M:00', field)
+    return fn.date_trunc('minute', field)
+
+def seed_recent():
+    """Buckets of the last 24h missing in redis counted again from the
+    database. Buckets the save() hooks already count are left alone."""
+    from peewee import fn
+    from libs.db import db_AA, db_events
+    r = red.get_connection()
+    if not r.set(SEED_LOCK_KEY, 1, nx=True, ex=BUCKET):
+        return
+    try:
+        auth = db_AA.Auth
+        event = db_events.Events
+        since = datetime.datetime.now() - datetime.timedelta(seconds=WINDOW)
+        counts = {}
+        minute = _minute(auth.created)
+        query = auth.select(minute, auth.ltype, fn.COUNT(auth.id)).where(auth.created > since).group_by(minute, auth.ltype)
+        for ts, ltype, n in query.tuples():
+            key = ("auth_" + str(ltype), _bucket(_epoch(ts)))
+            counts[key] = counts.get(key, 0) + n
+        minute = _minute(event.eventtime)
+        query = event.select(minute, event.level, fn.COUNT(event.id)).where(event.eventtime > since).group_by(minute, event.level)
+        for ts, level, n in query.tuples():
+            key = ("events_" + str(level), _bucket(_epoch(ts)))
+            counts[key] = counts.get(key, 0) + n
+        now = time.time()
+        pipe = r.pipeline(transaction=False)
+        for (name, bucket), n in counts.items():
+            # kept as long as count() keeps a bucket, nx: never overwrite
+            # what the hooks counted meanwhile
+            pipe.set(_recent_key(name, bucket), n, nx=True, ex=max(int((bucket + 1) * BUCKET + WINDOW - now), 1))
+        # seeded again once every bucket seeded now has expired
+        pipe.set(SEEDED_KEY, int(now), ex=WINDOW + BUCKET)
+        pipe.execute()
+    finally:
+        r.delete(SEED_LOCK_KEY)
+
+def seed_totals():
+    from libs.db import db_AA, db_events
+    pipe = red.get_connection().pipeline(transaction=False)
+    pipe.set(_total_key('auth'), db_AA.Auth.select().count())
+    pipe.set(_total_key('account'), db_AA.Account.select().count())
+    pipe.set(_total_key('events'), db_events.Events.select().count())
+    pipe.execute()
+
+
+# --------------------------------------------------------------------------
+# refresher (maintenance mule)
+
+def get_serial():
+    from libs import util
+    from libs.db import db_sysconfig
+    hwid = util.generate_serial_number(util.get_ethernet_wifi_interfaces())
+    install_date = False
+    try:
+        install_date = db_sysconfig.get_sysconfig('install_date')
+    except:
+        pass
+    if not install_date or install_date == '':
+        install_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        db_sysconfig.set_sysconfig('install_date', install_date)
+    return hwid + "-" + datetime.datetime.strptime(install_date, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d")
+
+def fetch_external(serial, version, versioncheck=False):
+    """(license, username, blog entries) from mikrowizard.com, slow and
+    may fail, never called by a request."""
+    import requests
+    import feedparser
+    from libs.db import db_sysconfig
+    license = False
+    username = False
+    blog = []
+    internet_connection = True
+    try:
+        req = requests.get(TEST_URL, timeout=(0.5, 1))
+        req.raise_for_status()
+    except Exception as e:
+        log.error(e)
+        internet_connection = False
+    try:
+        username = db_sysconfig.get_sysconfig('username')
+        params = {
+            "serial_number": serial,
+            "username": username.strip(),
+            "version": version
+        }
+        if versioncheck:
+            params['versioncheck'] = True
+        if internet_connection:
+            response = requests.post(UPDATE_URL, json=params, timeout=(2, 10))
+            license = response.json().get('license', False)
+    except Exception as e:
+        log.error(e)
+    try:
+        feed = []
+        if internet_connection:
+            # feedparser has no timeout of its own, a hanging feed would stall the mule
+            resp = requests.get(FEED_URL, timeout=(2, 10))
+            resp.raise_for_status()
+            feed = feedparser.parse(resp.content)['entries']
+        for f in feed:
+            tmp = {}
+            tmp['title'] = f['title']
+            tmp['content'] = f['content'][0]['value']
+            tmp['summery'] = f['summary'][0:100] + " ... " + '<a  target="_blank" href="' + f['link'] + '">Read More</a>'
+            tmp['media_content'] = f['media_content'][0]['url']
+            blog.append(tmp)
+    except Exception as e:
+        log.error(e)
+        blog = []
+    return license, username, blog or [NO_CONNECTION]
+
+def build(external=None):
+    """Dashboard stats from the counters, external is the last
+    (license, username, blog) of fetch_external or None."""
+    from _version import __version__
+    from libs.db import db, db_device
+    res = {'version': __version__}
+    recent = recent_counts()
+    for field, name in RECENT.items():
+        res[field] = recent[name]
+    totals = total_counts()
+    for field, name in TOTALS.items():
+        res[field] = totals[name]
+    res['Users'] = db.User.select().count() - 1
+    res['Devices'] = db_device.Devices.select().count()
+    res['Registred'] = False
+    license, username, blog = external or (False, False, [NO_CONNECTION])
+    res['license'] = license
+    if username:
+        res['username'] = username
+    res['blog'] = blog
+    return res
+
+
+class Refresher(object):
+    """Keeps the dashboard snapshot up to date, run() is called by the
+    maintenance mule every config.DASHBOARD_REFRESH seconds."""
+
+    def __init__(self):
+        self.serial = False
+        self.external = None
+        self.last_external = 0
+        self.last_totals = 0
+
+    def run(self):
+        from _version import __version__
+        r = red.get_connection()
+        now = time.time()
+        if not r.exists(SEEDED_KEY):
+            seed_recent()
+        if now - self.last_totals >= TOTALS_REFRESH:
+            seed_totals()
+            self.last_totals = now
+        versioncheck = bool(r.delete(VERSIONCHECK_KEY))
+        if versioncheck or now - self.last_external >= config.DASHBOARD_NEWS_REFRESH:
+            try:
+                self.serial = get_serial()
+            except Exception as e:
+                log.error(e)
+            self.external = fetch_external(self.serial, __version__, versioncheck)
+            self.last_external = now
+        res = build(self.external)
+        res['serial'] = self.serial
+        res['updated'] = int(now)
+        r.set(SNAPSHOT_KEY, json.dumps(res), ex=max(config.DASHBOARD_REFRESH * 5, 300))
+        return res
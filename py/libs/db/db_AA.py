@@ -12,6 +12,7 @@ from peewee import *
 
 from libs.db.db_device import Devices
 from libs.db.db import User,BaseModel
+from libs import dashboard
 import time
 import logging
 log = logging.getLogger("db_AA")
@@ -41,16 +42,20 @@ class Auth(BaseModel):
         # whether the index is unique or not.
         db_table = 'auth'
 
+    def save(self, *args, **kwargs):
+        new = self._pk is None
+        res = super(Auth, self).save(*args, **kwargs)
+        if new:
+            dashboard.count_auth([self.ltype])
+        return res
+
     def add_log(devid,type,username,ip,by,sessionid=False,timestamp=False,message=None):
         if type=='failed':
             rand=''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8))
             auth=Auth.select().where(Auth.ltype==type, Auth.username==username.strip())
             if message=='radius':
-                count=0
-                while(len(list(auth))<1 and count<33):
-                    auth=auth.where(Auth.started > timestamp-2,Auth.started < timestamp+2)
-                    time.sleep(0.3)
-                    count+=1
+                # rows of radius arriving later are matched by libs.auth_correlator
+                auth=list(auth.where(Auth.started > timestamp-2,Auth.started < timestamp+2))
             else:
                 auth=False
             if auth:
@@ -66,6 +71,7 @@ class Auth(BaseModel):
                     by=by.strip()
                 event=Auth(devid=int(devid), ltype=type, username=username.strip(), ip=ip.strip(), by=by,started=timestamp, ended=timestamp, message=message)
                 event.save()
+                return event
         elif type=='loggedin':
             auth=Auth.select().where(Auth.devid==devid, Auth.ltype==type, Auth.username==username.strip())
             if sessionid:
@@ -73,11 +79,6 @@ class Auth(BaseModel):
             else:
                 if message=='radius':
                     auth=auth.where(Auth.started > timestamp-2,Auth.started < timestamp+2)
-                    count=0
-                    while(len(list(auth))<1 and count<33):
-                        auth=auth.where(Auth.started > timestamp-2,Auth.started < timestamp+2)
-                        time.sleep(0.3)
-                        count+=1
                 else:
                     auth=False
             if auth and len(list(auth))>0:
@@ -97,6 +98,7 @@ class Auth(BaseModel):
                     by=by.strip()
                 event=Auth(devid=devid,ltype=type,username=username.strip(),ip=ip.strip(),by=by,started=timestamp,sessionid=sessionid,message=message)
                 event.save()
+                return event
         else:
             if sessionid:
                 Auth.update(ended = timestamp).where(Auth.sessionid==sessionid).execute()
@@ -108,6 +110,44 @@ class Auth(BaseModel):
                     event=Auth(devid=devid, ltype=type, username=username.strip(), ip=ip.strip(), by=by.strip(), ended=timestamp,message=message)
                     event.save()
 
+    def attach_syslog(ids,type,by,timestamp,message=None):
+        """Complete the radius rows ids with what the syslog line of the
+        same login tells, what add_log does when it finds them."""
+        by=by.strip() if by else by
+        if type=='failed':
+            rand=''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+            for count, id in enumerate(sorted(ids), start=1):
+                if by:
+                    Auth.update(by=by, sessionid=str(timestamp+count)+rand).where(Auth.id==id).execute()
+        else:
+            fields={'message':message}
+            if by:
+                fields['by']=by
+            Auth.update(**fields).where(Auth.id << ids).execute()
+
+    def log_row(devid,type,username,ip,by,timestamp=False,message=None):
+        """Row add_log would insert for a local user without session id,
+        None when the log needs the radius correlation of add_log."""
+        if message=='radius':
+            return None
+        by=by.strip() if by else by
+        row={'devid':int(devid),'ltype':type,'username':username.strip(),'ip':ip.strip(),'by':by,
+             'sessionid':None,'started':None,'ended':None,'message':message}
+        if type=='failed':
+            row['started']=timestamp
+            row['ended']=timestamp
+        elif type=='loggedin':
+            row['started']=timestamp
+        else:
+            row['ended']=timestamp
+        return row
+
+    def add_logs(rows):
+        """Bulk insert rows made by log_row."""
+        if rows:
+            Auth.insert_many(rows).execute()
+            dashboard.count_auth([row['ltype'] for row in rows])
+
 class Account(BaseModel):
     devid = ForeignKeyField(db_column='devid', null=True, model=Devices, to_field='id')
     username  = TextField()
@@ -124,11 +164,28 @@ class Account(BaseModel):
         # whether the index is unique or not.
         db_table = 'account'
 
+    def save(self, *args, **kwargs):
+        new = self._pk is None
+        res = super(Account, self).save(*args, **kwargs)
+        if new:
+            dashboard.count_account()
+        return res
+
     def add_log(devid,section,action,username,message,ctype="unknown",address="unknown",config="unknown"):
         event=Account(devid=devid,section=section.strip(),action=action.strip(),message=message.strip(),username=username.strip(),ctype=ctype.strip(),address=address.strip(),config=config.strip())
         # print(event.query())
         event.save()
 
+    def log_row(devid,section,action,username,message,ctype="unknown",address="unknown",config="unknown"):
+        """Row add_log would insert."""
+        return {'devid':devid,'section':section.strip(),'action':action.strip(),'message':message.strip(),'username':username.strip(),'ctype':ctype.strip(),'address':address.strip(),'config':config.strip()}
+
+    def add_logs(rows):
+        """Bulk insert rows made by log_row."""
+        if rows:
+            Account.insert_many(rows).execute()
+            dashboard.count_account(len(rows))
+
 # --------------------------------------------------------------------------
 
 if __name__ == '__main__':
@@ -7,6 +7,11 @@
 
 from peewee import *
 from libs.db.db import User,BaseModel,database
+from libs import red
+from libs import response_cache
+import threading
+import time
+import os
 
 import logging
 from playhouse.postgres_ext import  BooleanField
@@ -57,7 +62,7 @@ def get_devices(ids):
 def query_device_by_mac(mac):
     q=Devices.select()
     try:
-        q=q.where(Devices.serial == mac).get()
+        q=q.where(Devices.mac == mac).get()
     except:
         q=False
 
@@ -142,8 +147,148 @@ def update_device(devid, user_name, password, ip, peer_ip, name):
         query.execute()
     except:
         return False
+    devices_changed([devid])
     return True
 
+# --------------------------------------------------------------------------
+# changed columns of polled devices, written by the data grabber per cycle
+
+class DeviceBatcher(object):
+    """Collects the columns polls changed, flush() writes them in one
+    transaction with one UPDATE per set of changed columns."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # devid -> {column name: value}
+        self.changes = {}
+
+    def add(self, dev, before):
+        """Queue columns of dev which differ from before (dict of __data__)."""
+        changed = {}
+        for name, value in dev.__data__.items():
+            field = Devices._meta.fields.get(name)
+            if field is None or field.primary_key:
+                continue
+            if field.db_value(value) != field.db_value(before.get(name)):
+                changed[name] = value
+        dev._dirty.clear()
+        if not changed:
+            return False
+        with self.lock:
+            self.changes.setdefault(dev.id, {}).update(changed)
+        return True
+
+    def pending(self):
+        return len(self.changes)
+
+    def flush(self):
+        """Write queued changes, returns (devices, statements)"""
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        if not changes:
+            return 0, 0
+        groups = {}
+        for devid, values in changes.items():
+            groups.setdefault(tuple(sorted(values)), []).append(devid)
+        field_types = database.get_context_options()['field_types']
+        statements = 0
+        try:
+            with database.atomic():
+                for names, devids in groups.items():
+                    update = {}
+                    for name in names:
+                        field = Devices._meta.fields[name]
+                        # parameters of a CASE are untyped for postgres
+                        cast = field_types.get(field.field_type, field.field_type)
+                        update[field] = Case(Devices.id, [(devid, Cast(Value(field.db_value(changes[devid][name])), cast)) for devid in devids])
+                    Devices.update(update).where(Devices.id << devids).execute()
+                    statements += 1
+        except Exception:
+            # keep them for the next flush, newer changes win
+            with self.lock:
+                for devid, values in changes.items():
+                    values.update(self.changes.get(devid, {}))
+                    self.changes[devid] = values
+            raise
+        firmware = [devid for devid, values in changes.items() if 'current_firmware' in values]
+        if firmware:
+            devices_changed(firmware)
+        return len(changes), statements
+
+# --------------------------------------------------------------------------
+# process local ip -> device index for the syslog and radius mules
+#   holds only the columns needed to identify a device and talk to it,
+#   updated on the 'devices' redis channel and fully reloaded every INDEX_TTL
+
+INDEX_TTL = 300
+INDEX_FIELDS = (Devices.id, Devices.name, Devices.ip, Devices.mac, Devices.peer_ip,
+                Devices.user_name, Devices.password, Devices.port, Devices.current_firmware)
+
+_index = {}
+_index_ids = {}
+_index_loaded = 0
+_index_lock = threading.Lock()
+_index_pid = None
+
+def _index_reload():
+    global _index, _index_ids, _index_loaded
+    by_ip = {}
+    by_id = {}
+    for dev in Devices.select(*INDEX_FIELDS):
+        by_id[dev.id] = dev
+        if dev.ip:
+            by_ip[dev.ip] = dev
+    with _index_lock:
+        _index, _index_ids = by_ip, by_id
+        _index_loaded = time.time()
+
+def _index_update(devids):
+    global _index, _index_ids
+    devs = {dev.id: dev for dev in Devices.select(*INDEX_FIELDS).where(Devices.id << devids)}
+    with _index_lock:
+        by_ip = dict(_index)
+        by_id = dict(_index_ids)
+        for devid in devids:
+            old = by_id.pop(devid, None)
+            if old is not None and by_ip.get(old.ip) is old:
+                del by_ip[old.ip]
+            dev = devs.get(devid)
+            if dev is not None:
+                by_id[devid] = dev
+                if dev.ip:
+                    by_ip[dev.ip] = dev
+        _index, _index_ids = by_ip, by_id
+
+def _index_changed(devids):
+    global _index_loaded
+    if devids:
+        try:
+            _index_update([int(devid) for devid in devids])
+            return
+        except Exception as e:
+            log.error(e)
+    # everything may have changed (or we missed messages), reload on next lookup
+    _index_loaded = 0
+
+def devices_changed(devids=None):
+    """Tell every process that devids (or any device) were added, edited or removed."""
+    red.publish('devices', devids)
+    response_cache.invalidate('devices')
+
+def get_indexed_device(ip):
+    """Compact Devices row of the device with ip, False if unknown."""
+    global _index_pid
+    if _index_pid != os.getpid():
+        _index_pid = os.getpid()
+        red.subscribe('devices', _index_changed)
+    if time.time() - _index_loaded > INDEX_TTL:
+        try:
+            _index_reload()
+        except Exception as e:
+            log.error(e)
+            return query_device_by_ip(ip)
+    return _index.get(ip, False)
+
 # --------------------------------------------------------------------------
 
 if __name__ == '__main__':
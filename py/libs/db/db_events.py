@@ -8,7 +8,10 @@
 from peewee import *
  
 from libs.db.db_device import Devices
-from libs.db.db import BaseModel
+from libs.db.db import BaseModel,database
+from libs import dashboard
+import datetime
+import threading
 
 import logging
 log = logging.getLogger("db_events")
@@ -31,92 +34,204 @@ class Events(BaseModel):
         # whether the index is unique or not.
         db_table = 'events'
 
+    def save(self, *args, **kwargs):
+        new = self._pk is None
+        res = super(Events, self).save(*args, **kwargs)
+        if new:
+            dashboard.count_events([self.level])
+        return res
+
 def get_events_by_src_and_status(src, status,devid):
     return Events.select().where(Events.src==src, Events.status==status, Events.devid==devid)
 
 def fix_event(id):
-    event=Events.get(Events.id==id)
-    event.update(status=1,fixtime='NOW').where(Events.id==event.id).execute()
-
-def connection_event(devid,src,detail,level,status=0,comment=""):
-    #check if we have same event for device before adding new one
-        event=Events.select().where(
-            Events.devid==devid, 
-            Events.eventtype=="connection", 
-            Events.src==src, 
-            Events.detail==detail, 
-            Events.level==level, 
-            Events.status==False)
-        if not event and not status:
-            event=Events(devid=devid, eventtype="connection", detail=detail, level=level, src=src, status=status ,comment=comment)
-            event.save()
-        elif event and status:
-            list(event)[0].update(status=status).execute()
-
-def config_event(devid,src,detail,level,status=0,comment=""):
-    #check if we have same event for device before adding new one
-    event=Events.select().where(
-        Events.devid==devid, 
-        Events.eventtype=="config", 
-        Events.src==src, 
-        Events.detail==detail, 
+    Events.update(status=True,fixtime=datetime.datetime.now()).where(Events.id==id).execute()
+
+def _event(eventtype,devid,src,detail,level,status=0,comment="",record_fixed=False):
+    """Open the event (status 0) unless the same one is open already, or fix
+    the open one (status 1), in one statement served by the partial open
+    events index instead of a select before each write. record_fixed: a
+    fix with nothing open is recorded as a fixed event."""
+    key=(Events.devid==devid,
+        Events.eventtype==eventtype,
+        Events.src==src,
+        Events.detail==detail,
         Events.level==level,
         Events.status==False)
-    if not event and not status:
-        event=Events(devid=devid, eventtype="config", detail=detail, level=level, src=src, status=status, comment=comment)
-        event.save()
-    elif event and status:
-        list(event)[0].update(status=status).execute()
+    if status:
+        if Events.update(status=True,fixtime=datetime.datetime.now()).where(*key).execute() or not record_fixed:
+            return
+        Events(devid=devid, eventtype=eventtype, detail=detail, level=level, src=src, status=status, comment=comment).save()
+        return
+    fields=[Events.devid,Events.eventtype,Events.detail,Events.level,Events.src,Events.status,Events.comment]
+    values=Select(columns=[Value(devid),Value(eventtype),Value(detail),Value(level),Value(src),Value(False),Value(comment)]).where(
+        ~fn.EXISTS(Events.select(SQL('1')).where(*key)))
+    if list(Events.insert_from(values,fields).returning(Events.id).execute()):
+        dashboard.count_events([level])
 
+def connection_event(devid,src,detail,level,status=0,comment=""):
+    _event("connection",devid,src,detail,level,status,comment)
 
+def config_event(devid,src,detail,level,status=0,comment=""):
+    _event("config",devid,src,detail,level,status,comment)
 
 def firmware_event(devid,src,detail,level,status=0,comment=""):
-    #check if we have same event for device before adding new one
-    event=Events.select().where(
-        Events.devid==devid, 
-        Events.eventtype=="firmware", 
-        Events.src==src, 
-        Events.detail==detail, 
-        Events.level==level,
-        Events.status==False)
-    if not event and not status:
-        event=Events(devid=devid, eventtype="firmware", detail=detail, level=level, src=src, status=status, comment=comment)
-        event.save()
-    elif event and status:
-        list(event)[0].update(status=status).execute()
+    _event("firmware",devid,src,detail,level,status,comment)
 
 def health_event(devid, src, detail, level, status=0, comment=""):
-    #check if we have same event for device before adding new one
-    event=Events.select().where(
-        Events.devid==devid,
-        Events.eventtype=="health",
-        Events.src==src,
-        Events.detail==detail,
-        Events.level==level,
-        Events.status==False)
-    if not event and not status:
-        event=Events(devid=devid, eventtype="health", detail=detail, level=level, src=src, status=status, comment=comment)
-        event.save()
-    elif event and status:
-        list(event)[0].update(status=status).execute()
+    _event("health",devid,src,detail,level,status,comment)
 
 def state_event(devid, src, detail, level, status=0, comment=""):
-    #check if we have same event for device before adding new one
-    event=Events.select().where(
-        Events.devid==devid,
+    _event("state",devid,src,detail,level,status,comment,record_fixed=True)
+
+def add_state_events(items):
+    """state_event for many (devid, src, detail, level, status, comment)
+    tuples with one select, one bulk insert and one update. A status 1 item
+    with comment None only fixes the matching open event."""
+    if not items:
+        return
+    devids=list(set(item[0] for item in items))
+    open_events={}
+    for event in Events.select(Events.id,Events.devid,Events.src,Events.detail,Events.level).where(
+        Events.devid << devids,
         Events.eventtype=="state",
-        Events.src==src,
-        Events.detail==detail,
-        Events.level==level,
-        Events.status==False)
-    if not event and not status:
-        event=Events(devid=devid, eventtype="state", detail=detail, level=level, src=src, status=status, comment=comment)
-        event.save()
-    elif event and status:
-        list(event)[0].update(status=status).execute()
-    elif not event and status:
-        event=Events(devid=devid, eventtype="state", detail=detail, level=level, src=src, status=status, comment=comment)
-        event.save()
+        Events.status==False).tuples():
+        open_events.setdefault(tuple(event[1:]),event[0])
+    inserts=[]
+    fixed=[]
+    now=datetime.datetime.now()
+    for devid, src, detail, level, status, comment in items:
+        key=(devid,src,detail,level)
+        if key in open_events:
+            if status:
+                opened=open_events.pop(key)
+                if type(opened) is dict:
+                    opened['status']=status
+                    opened['fixtime']=now
+                else:
+                    fixed.append(opened)
+            continue
+        if status and comment is None:
+            # nothing open to fix
+            continue
+        row={'devid':devid,'eventtype':"state",'detail':detail,'level':level,'src':src,'status':status,'comment':comment,'fixtime':None}
+        inserts.append(row)
+        if not status:
+            # opened by this batch, later items see it as open
+            open_events[key]=row
+    if inserts:
+        Events.insert_many(inserts).execute()
+        dashboard.count_events([row['level'] for row in inserts])
+    if fixed:
+        Events.update(status=True,fixtime=now).where(Events.id << fixed).execute()
+
+# --------------------------------------------------------------------------
+# open events of one src kept in memory, for the data puller which opens
+# and fixes events of every device on every poll
+
+class DeviceEvents(list):
+    """Open events (dicts) of one device as get_events_by_src_and_status
+    returned them, opening and fixing goes through the EventManager."""
+
+    def __init__(self, manager, devid, rows):
+        list.__init__(self, rows)
+        self.manager = manager
+        self.devid = devid
+
+    def open(self, eventtype, detail, level, comment=""):
+        self.manager.open(self.devid, eventtype, detail, level, comment)
+
+    def fix(self, row):
+        self.manager.fix(row)
+
+
+class EventManager(object):
+    """Events opened/fixed by open()/fix() are only kept in memory, flush()
+    writes them in one transaction. load() reads the open events again so
+    events fixed elsewhere (UI, other processes) are noticed."""
+
+    def __init__(self, src):
+        self.src = src
+        self.lock = threading.Lock()
+        # devid -> [open event dicts], rows not written yet have id None
+        self.rows = {}
+        self.inserts = []
+        self.fixes = []
+
+    def load(self):
+        found = list(Events.select().where(Events.src == self.src, Events.status == False).dicts())
+        rows = {}
+        with self.lock:
+            fixes = set(self.fixes)
+            for row in found:
+                if row['id'] not in fixes:
+                    rows.setdefault(row['devid'], []).append(row)
+            # keep what is opened but not flushed yet
+            for row in self.inserts:
+                if not row['status']:
+                    rows.setdefault(row['devid'], []).append(row)
+            self.rows = rows
+
+    def device(self, devid):
+        with self.lock:
+            return DeviceEvents(self, devid, self.rows.get(devid, []))
+
+    def open(self, devid, eventtype, detail, level, comment=""):
+        with self.lock:
+            rows = self.rows.setdefault(devid, [])
+            for row in rows:
+                if row['eventtype'] == eventtype and row['detail'] == detail and row['level'] == level:
+                    return False
+            row = {'id': None, 'devid': devid, 'eventtype': eventtype, 'detail': detail, 'level': level,
+                   'src': self.src, 'status': False, 'comment': str(comment), 'fixtime': None}
+            rows.append(row)
+            self.inserts.append(row)
+            return True
+
+    def fix(self, row):
+        with self.lock:
+            rows = self.rows.get(row['devid'], [])
+            if row in rows:
+                rows.remove(row)
+            if row['id']:
+                self.fixes.append(row['id'])
+            else:
+                # opened and fixed before it was written
+                row['status'] = True
+                row['fixtime'] = datetime.datetime.now()
+
+    def flush(self):
+        """Write pending opens and fixes, returns (opened, fixed)"""
+        with self.lock:
+            inserts, self.inserts = self.inserts, []
+            fixes, self.fixes = self.fixes, []
+        if not inserts and not fixes:
+            return 0, 0
+        data = ids = []
+        try:
+            with database.atomic():
+                if inserts:
+                    fields = ('devid', 'eventtype', 'detail', 'level', 'src', 'status', 'comment', 'fixtime')
+                    with self.lock:
+                        data = [{k: row[k] for k in fields} for row in inserts]
+                    ids = [res[0] for res in Events.insert_many(data).returning(Events.id).tuples().execute()]
+                if fixes:
+                    Events.update(status=True, fixtime=datetime.datetime.now()).where(Events.id << fixes).execute()
+        except Exception:
+            # try again with the next flush
+            with self.lock:
+                self.inserts = inserts + self.inserts
+                self.fixes = fixes + self.fixes
+            raise
+        if data:
+            dashboard.count_events([row['level'] for row in data])
+        with self.lock:
+            for row, written, id in zip(inserts, data, ids):
+                row['id'] = id
+                if row['status'] and not written['status']:
+                    # fixed while the insert was running
+                    self.fixes.append(id)
+        return len(inserts), len(fixes)
 
 # --------------------------------------------------------------------------
 
@@ -8,6 +8,7 @@
 from peewee import *
 
 from libs.db.db import BaseModel,get_object_or_none
+from libs import response_cache
 import logging
 log = logging.getLogger("db_firmware")
 
@@ -24,6 +25,11 @@ class Firmware(BaseModel):
         # whether the index is unique or not.
         db_table = 'firmware'
 
+    def save(self, *args, **kwargs):
+        res = super(Firmware, self).save(*args, **kwargs)
+        response_cache.invalidate('firmware')
+        return res
+
 def get_firm(id):
     return get_object_or_none(Firmware, id=id)
 
@@ -10,9 +10,16 @@ from peewee import *
 from libs.db.db import User,BaseModel,get_object_or_none
 import logging
 from libs.db.db_device import Devices
+from libs.db import db_device
+from libs import red
 log = logging.getLogger("db_groups")
 
 
+# bumped on every change of group members or user group permissions, part
+# of the key of the cached device scopes (db_user_group_perm)
+SCOPE_VERSION = "mikrowizard::scope::version"
+
+
 class DevGroups(BaseModel):
     name = TextField()
     owner = ForeignKeyField(db_column='owner', null=True,
@@ -64,6 +71,7 @@ def add_devices_to_group(group, devids):
     for devid in devids:
         data.append({'group_id': group, 'device_id': devid})
     res=DevGroupRel.insert_many(data).on_conflict_ignore().execute()
+    scope_changed()
     return res
 
 #Get groups of device
@@ -121,6 +129,13 @@ def get_devs_of_groups(group_ids):
         log.error(e)
         return []
         
+#Get group ids of every device as {devid: [group_id, ...]}
+def get_device_group_ids():
+    res={}
+    for rel in DevGroupRel.select(DevGroupRel.device_id,DevGroupRel.group_id).tuples():
+        res.setdefault(rel[0],[]).append(rel[1])
+    return res
+
 #get all groups including devices in each group
 def query_groups_api():
     t3=DevGroups.alias()
@@ -139,14 +154,23 @@ def get_groups_by_id(ids):
 
 def delete_from_group(devids):
     delete=DevGroupRel.delete().where(DevGroupRel.device_id << devids).execute()
+    scope_changed()
     return delete
 
+def scope_changed():
+    """Drop the cached device scopes of all users, never raises."""
+    try:
+        red.get_connection().incr(SCOPE_VERSION)
+    except Exception as e:
+        log.error(e)
+
 def delete_device(devid):
     try:
 
         delete_from_group([devid])
         dev = get_object_or_none(Devices, id=devid)
         dev.delete_instance(recursive=True)
+        db_device.devices_changed([devid])
         return True
     except Exception as e:
         log.error(e)
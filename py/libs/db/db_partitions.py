@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# db_partitions.py: monthly partitions of the log tables (auth, account,
+#   events), see migrations/022_log_partitions.py
+#   - partitions are named <table>_yYYYYmMM, rows outside of them land
+#     in <table>_default
+#   - expired months are dropped as a whole instead of deleting rows
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import datetime
+import re
+
+from libs.db.db import database
+import config
+
+import logging
+log = logging.getLogger("db_partitions")
+
+# partitioned table -> partition key
+TABLES = {
+    'auth': 'created',
+    'account': 'created',
+    'events': 'eventtime',
+}
+# months created in advance
+AHEAD = 2
+
+
+def month_start(day, months=0):
+    """First day of the month months away from the month of day."""
+    n = day.year * 12 + day.month - 1 + months
+    return datetime.date(n // 12, n % 12 + 1, 1)
+
+def partition_name(table, month):
+    return "{}_y{:04d}m{:02d}".format(table, month.year, month.month)
+
+def is_partitioned(table):
+    if config.IS_SQLITE:
+        return False
+    cursor = database.execute_sql("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return cursor.fetchone() is not None
+
+def get_partitions(table):
+    """{first day of month: partition name} of the monthly partitions of table."""
+    cursor = database.execute_sql("""SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)""", (table,))
+    pattern = re.compile(r"^{}_y(\d{{4}})m(\d{{2}})$".format(table))
+    res = {}
+    for (name,) in cursor.fetchall():
+        m = pattern.match(name)
+        if m:
+            res[datetime.date(int(m.group(1)), int(m.group(2)), 1)] = name
+    return res
+
+def create_partition(table, month):
+    """Partition of table for month, rows of that month already in the
+    default partition are moved into it."""
+    column = TABLES[table]
+    name = partition_name(table, month)
+    start, end = month, month_start(month, 1)
+    with database.atomic():
+        cursor = database.execute_sql("SELECT 1 FROM {}_default WHERE {} >= %s AND {} < %s LIMIT 1".format(table, column, column), (start, end))
+        if cursor.fetchone() is None:
+            database.execute_sql("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)".format(name, table), (start, end))
+            return name
+        # a new partition may not overlap rows of the default one
+        database.execute_sql("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(name, table))
+        database.execute_sql("""WITH moved AS (DELETE FROM {0}_default WHERE {1} >= %s AND {1} < %s RETURNING *)
+            INSERT INTO {2} SELECT * FROM moved""".format(table, column, name), (start, end))
+        database.execute_sql("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(table, name), (start, end))
+    log.info("moved the rows of {} out of {}_default".format(name, table))
+    return name
+
+def ensure_partitions(ahead=AHEAD):
+    """Partitions from the current month to ahead months from now for all
+    partitioned tables, returns the names of the created ones."""
+    created = []
+    today = datetime.date.today()
+    for table in TABLES:
+        if not is_partitioned(table):
+            continue
+        existing = get_partitions(table)
+        for i in range(ahead + 1):
+            month = month_start(today, i)
+            if month in existing:
+                continue
+            try:
+                created.append(create_partition(table, month))
+            except Exception as e:
+                log.error(e)
+    return created
+
+def drop_partitions(months):
+    """Keep the current and the last months months of every partitioned
+    table, older partitions (and default partition rows) are dropped.
+    Returns the names of the dropped partitions, months <= 0 keeps all."""
+    if months <= 0:
+        return []
+    dropped = []
+    cutoff = month_start(datetime.date.today(), -months)
+    for table in TABLES:
+        if not is_partitioned(table):
+            continue
+        for month, name in sorted(get_partitions(table).items()):
+            if month >= cutoff:
+                continue
+            try:
+                database.execute_sql("DROP TABLE {}".format(name))
+                dropped.append(name)
+            except Exception as e:
+                log.error(e)
+        try:
+            database.execute_sql("DELETE FROM {}_default WHERE {} < %s".format(table, TABLES[table]), (cutoff,))
+        except Exception as e:
+            log.error(e)
+    return dropped
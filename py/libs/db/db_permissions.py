@@ -9,6 +9,7 @@ from peewee import *
 
 import config
 from libs.db.db import BaseModel,get_object_or_none
+from libs.db import db_groups
 
 import logging
 log = logging.getLogger("db_permisions")
@@ -39,6 +40,8 @@ def delete_perm(id):
         return False
     perm = get_object_or_none(Perms, id=id)
     perm.delete_instance(recursive=True)
+    # the user group permissions using it are gone too
+    db_groups.scope_changed()
 
 def get_perm_by_name(name):
     if not name:
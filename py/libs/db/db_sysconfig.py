@@ -8,6 +8,12 @@
 from peewee import *
 
 from libs.db.db import User,BaseModel,get_object_or_404
+from libs import red
+from libs import response_cache
+import config
+import threading
+import time
+import os
 import logging
 log = logging.getLogger("db_sysconfig")
 
@@ -26,47 +32,91 @@ class Sysconfig(BaseModel):
     class Meta:
         db_table = 'sysconfig'
 
+# --------------------------------------------------------------------------
+# process local cache, dropped on the 'sysconfig' redis channel
+
+_cache = {}
+_cache_lock = threading.Lock()
+_subscribed_pid = None
+
+def _invalidate(keys=None):
+    """Drop keys (or everything) from the cache of this process."""
+    with _cache_lock:
+        if keys:
+            for key in keys:
+                _cache.pop(key, None)
+        else:
+            _cache.clear()
+
+# keys returned by /api/firmware/get_firms next to the firmware rows
+FIRMWARE_KEYS = ('old_firmware_action', 'latest_version', 'old_version')
+
+def _changed(keys=None):
+    _invalidate(keys)
+    red.publish('sysconfig', keys)
+    if not keys or any(key in FIRMWARE_KEYS for key in keys):
+        response_cache.invalidate('firmware')
+
+def get_cached(key):
+    """Sysconfig row of key, from the cache when fresh."""
+    global _subscribed_pid
+    if _subscribed_pid != os.getpid():
+        _subscribed_pid = os.getpid()
+        red.subscribe('sysconfig', _invalidate)
+    now = time.time()
+    hit = _cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+    row = get_object_or_404(Sysconfig, key=key)
+    with _cache_lock:
+        _cache[key] = (now + config.SYSCONFIG_CACHE_TTL, row)
+    return row
+
 def get_default_user():
-    return get_object_or_404(Sysconfig, key="default_user")
+    return get_cached("default_user")
 
 def get_all():
     return Sysconfig.select()
 
 def save_all(data):
-    Sysconfig.insert_many(data).on_conflict(conflict_target=['key'], preserve=(Sysconfig.value,Sysconfig.modified)).execute()
+    res=Sysconfig.insert_many(data).on_conflict(conflict_target=['key'], preserve=(Sysconfig.value,Sysconfig.modified)).execute()
+    _changed([item['key'] for item in data if 'key' in item])
+    return res
 
 def get_default_password():
-    return get_object_or_404(Sysconfig, key="default_password")
-def update_sysconfig(key,value):
-    return Sysconfig.update(value=value).where(Sysconfig.key == key).execute()
+    return get_cached("default_password")
 
 def get_scan_mode():
-    return get_object_or_404(Sysconfig, key="scan_mode")
+    return get_cached("scan_mode")
 
 def get_sysconfig(key):
-    return get_object_or_404(Sysconfig, key=key).value
+    return get_cached(key).value
 
 def get_firmware_latest():
-    return get_object_or_404(Sysconfig, key="latest_version")
+    return get_cached("latest_version")
 
 def get_firmware_action():
-    return get_object_or_404(Sysconfig, key="old_firmware_action")
+    return get_cached("old_firmware_action")
 
 def get_firmware_old():
-    return get_object_or_404(Sysconfig, key="old_version")
+    return get_cached("old_version")
 
 def get_mac_scan_interval():
-    return get_object_or_404(Sysconfig, key="mac_scan_interval")
+    return get_cached("mac_scan_interval")
 
 def get_ip_scan_interval():
     """Return Movie or throw."""
-    return get_object_or_404(Sysconfig, key="ip_scan_interval")
+    return get_cached("ip_scan_interval")
 
 def update_sysconfig(key,value):
-    return Sysconfig.insert(value=value,key=key).on_conflict(conflict_target=['key'], preserve=['key'], update={'value':value}).execute()                        # firm.version = version
+    res=Sysconfig.insert(value=value,key=key).on_conflict(conflict_target=['key'], preserve=['key'], update={'value':value}).execute()                        # firm.version = version
+    _changed([key])
+    return res
 
 def set_sysconfig(key,value):
-    return Sysconfig.insert(value=value, key=key).on_conflict(conflict_target=['key'], preserve=['key'], update={'value':value}).execute()                        # firm.version = version
+    res=Sysconfig.insert(value=value, key=key).on_conflict(conflict_target=['key'], preserve=['key'], update={'value':value}).execute()                        # firm.version = version
+    _changed([key])
+    return res
 
 
 # --------------------------------------------------------------------------
@@ -7,7 +7,11 @@
 
 
 from peewee import *
+import json
 
+import config
+from libs import red
+from libs.db import db_groups
 from libs.db.db_device import Devices
 from libs.db.db import User,BaseModel,get_object_or_none
 from libs.db.db_permissions import Perms
@@ -16,6 +20,9 @@ from libs.db.db_groups import DevGroups,DevGroupRel
 import logging
 log = logging.getLogger("db_user_group_perm")
 
+# cached device scope of a user: <prefix><scope version>::<uid>::<group id>
+SCOPE_PREFIX = "mikrowizard::scope::"
+
 
 class DevUserGroupPermRel(BaseModel):
     user_id = ForeignKeyField(User, related_name='user_id')
@@ -31,23 +38,56 @@ class DevUserGroupPermRel(BaseModel):
     def __repr__(self):
         return "DevUserGroupPermRel: user_id: %s, group_id: %s, perm_id: %s" % (self.user_id, self.group_id, self.perm_id)
 
+    def get_user_device_ids(uid,group_id=False):
+        """Ids of the devices uid may access (only those of group_id if set) as a
+        sorted list, None if uid may access all of them. Cached in redis until
+        group members or user group permissions change."""
+        try:
+            r = red.get_connection()
+            version = int(r.get(db_groups.SCOPE_VERSION) or 0)
+            key = "{}{}::{}::{}".format(SCOPE_PREFIX, version, uid, int(group_id or 0))
+            data = r.get(key)
+            if data is not None:
+                return json.loads(data)
+        except Exception as e:
+            log.error(e)
+            r = None
+        ids = DevUserGroupPermRel.resolve_user_device_ids(uid, group_id)
+        if r:
+            try:
+                r.set(key, json.dumps(ids), ex=config.DEVICE_SCOPE_TTL)
+            except Exception as e:
+                log.error(e)
+        return ids
+
+    def resolve_user_device_ids(uid,group_id=False):
+        """Uncached get_user_device_ids, two queries at most."""
+        groups = set(row[0] for row in DevUserGroupPermRel.select(DevUserGroupPermRel.group_id).where(DevUserGroupPermRel.user_id == uid).tuples())
+        # group 1 holds every device
+        if group_id and group_id != 1:
+            if 1 not in groups and group_id not in groups:
+                return []
+            groups = {group_id}
+        elif 1 in groups:
+            return None
+        if not groups:
+            return []
+        q = DevGroupRel.select(DevGroupRel.device_id).where(DevGroupRel.group_id << list(groups)).distinct()
+        return sorted(row[0] for row in q.tuples())
+
     def get_user_devices(uid,group_id=False):
-        perms=list(DevUserGroupPermRel.select().where(DevUserGroupPermRel.user_id == uid))
-        for perm in perms:
-            if group_id==1 or (perm.group_id.id == 1 and not group_id):
-                return Devices.select()
-            elif perm.group_id.id == 1 and group_id:
-                return Devices.select().join(DevGroupRel).where(DevGroupRel.group_id == group_id)
-        if group_id:
-            return Devices.select().join(DevGroupRel).join(DevUserGroupPermRel,on=(DevUserGroupPermRel.group_id == DevGroupRel.group_id)).where(DevUserGroupPermRel.user_id == uid, DevGroupRel.group_id == group_id)
-        return Devices.select().join(DevGroupRel).join(DevUserGroupPermRel,on=(DevUserGroupPermRel.group_id == DevGroupRel.group_id)).where(DevUserGroupPermRel.user_id == uid)
+        ids = DevUserGroupPermRel.get_user_device_ids(uid, group_id)
+        if ids is None:
+            return Devices.select()
+        return Devices.select().where(Devices.id << ids)
 
     def get_user_devices_by_ids(uid,ids):
-        perms=list(DevUserGroupPermRel.select().where(DevUserGroupPermRel.user_id == uid))
-        for perm in perms:
-            if perm.group_id.id == 1:
-                return Devices.select().where(Devices.id << ids)
-        return Devices.select().join(DevGroupRel).join(DevUserGroupPermRel,on=(DevUserGroupPermRel.group_id == DevGroupRel.group_id)).where(DevUserGroupPermRel.user_id == uid,Devices.id << ids)
+        ids = [int(id) for id in ids]
+        scope = DevUserGroupPermRel.get_user_device_ids(uid)
+        if scope is not None:
+            scope = set(scope)
+            ids = [id for id in ids if id in scope]
+        return Devices.select().where(Devices.id << ids)
     
     def delete_group(gid):
         #check if group exists
@@ -59,6 +99,7 @@ class DevUserGroupPermRel(BaseModel):
                 #delete group records from DevUserGroupPermRel
                 delete=DevUserGroupPermRel.delete().where(DevUserGroupPermRel.group_id == gid).execute()
                 delete=group.delete_instance(recursive=True)
+                db_groups.scope_changed()
                 return True
             except Exception as e:
                 return False
@@ -69,7 +110,9 @@ class DevUserGroupPermRel(BaseModel):
         return DevUserGroupPermRel.select().where(DevUserGroupPermRel.user_id == uid)
     
     def create_user_group_perm(user_id, group_id, perm_id):
-        return DevUserGroupPermRel.create(user_id=user_id, group_id=group_id, perm_id=perm_id)
+        rel = DevUserGroupPermRel.create(user_id=user_id, group_id=group_id, perm_id=perm_id)
+        db_groups.scope_changed()
+        return rel
     
     def query_permission_by_user_and_device_group(uid , devgrupid):
         q = DevUserGroupPermRel.select().where(DevUserGroupPermRel.group_id  << devgrupid,DevUserGroupPermRel.user_id == uid)
@@ -83,6 +126,8 @@ class DevUserGroupPermRel(BaseModel):
 
     def delete_user_group_perm(id):
         try:
-            return DevUserGroupPermRel.delete().where(DevUserGroupPermRel.id == id).execute()
+            delete = DevUserGroupPermRel.delete().where(DevUserGroupPermRel.id == id).execute()
+            db_groups.scope_changed()
+            return delete
         except:
             return False
\ No newline at end of file
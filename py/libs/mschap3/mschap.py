@@ -6,7 +6,38 @@ from . import des
 from . import md4
 import hashlib
 from . import utils
-from Crypto.Hash import MD4
+
+# DES and MD4 of pycryptodome, the pure python des/md4 modules are the
+# fallback (and the reference, see scripts/bench_mschap.py)
+try:
+    from Crypto.Cipher import DES as _DES
+    from Crypto.Hash import MD4 as _MD4
+    FAST = True
+except ImportError:
+    FAST = False
+
+
+def md4_digest(data):
+    """MD4 of data (bytes or str of chars < 256) as str of chars < 256,
+    what md4.new().digest() returns."""
+    if FAST:
+        try:
+            if isinstance(data, str):
+                data = data.encode('iso8859-1')
+            return _MD4.new(data).digest().decode('iso8859-1')
+        except UnicodeEncodeError:
+            pass
+    md4_context = md4.new()
+    md4_context.update(data)
+    return md4_context.digest()
+
+
+def des_encrypt(key_7, block):
+    """DES of 8 byte block with a 7 byte key (list of ints)"""
+    if FAST:
+        key = bytes(des.key56_to_key64(des.str_to_key56(key_7)))
+        return _DES.new(key, _DES.MODE_ECB).encrypt(block)
+    return des.DES(key_7).encrypt(block)
 
 
 def challenge_hash(peer_challenge, authenticator_challenge, username):
@@ -21,19 +52,12 @@ def challenge_hash(peer_challenge, authenticator_challenge, username):
 def nt_password_hash(passwd):
     """NtPasswordHash"""
     pw = utils.str2unicode(passwd)
-
-    md4_context = md4.new()
-    md4_context.update(pw)
-    # hashObject = MD4.new(passwd.encode('utf-8'))
-    # digest = hashObject.digest().decode()
-    return md4_context.digest()
+    return md4_digest(pw)
 
 
 def hash_nt_password_hash(password_hash):
     """HashNtPasswordHash"""
-    md4_context = md4.new()
-    md4_context.update(password_hash)
-    return md4_context.digest()
+    return md4_digest(password_hash)
 
 
 def generate_nt_response_mschap(challenge, password):
@@ -58,15 +82,9 @@ def challenge_response(challenge, password_hash):
     zpassword_hash = [ord(x) for x in zpassword_hash]
 
    
-    response = b""
-    des_obj = des.DES(zpassword_hash[0:7])
-    response += des_obj.encrypt(challenge)
-
-    des_obj = des.DES(zpassword_hash[7:14])
-    response += des_obj.encrypt(challenge)
-
-    des_obj = des.DES(zpassword_hash[14:21])
-    response += des_obj.encrypt(challenge)
+    response = des_encrypt(zpassword_hash[0:7], challenge)
+    response += des_encrypt(zpassword_hash[7:14], challenge)
+    response += des_encrypt(zpassword_hash[14:21], challenge)
     return response
 
 
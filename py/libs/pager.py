@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# pager.py: keyset pagination and streaming export of large list queries
+#   - pages are keyed on id DESC, the cursor is the last id of a page
+#   - optional row count estimate from the planner instead of COUNT(*)
+#   - ndjson/csv export streamed from a server side cursor
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import csv
+import datetime
+import io
+import json
+
+from flask import Response, stream_with_context
+from libs.webutil import buildResponse
+import config
+
+import logging
+log = logging.getLogger("pager")
+
+EXPORT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# rows per server side cursor round trip / per streamed chunk
+FETCH_SIZE = 1000
+
+
+def params(input):
+    """(limit, cursor, count, export) of a list request, limit is capped at
+    config.LOGS_PAGE_MAX, cursor is False for the first page."""
+    try:
+        limit = int(input.get('limit') or config.LOGS_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = config.LOGS_PAGE_SIZE
+    limit = max(1, min(limit, config.LOGS_PAGE_MAX))
+    try:
+        cursor = int(input.get('cursor') or 0)
+    except (TypeError, ValueError):
+        cursor = 0
+    export = input.get('export', False)
+    if export not in EXPORT_TYPES:
+        export = False
+    return limit, cursor or False, bool(input.get('count', False)), export
+
+def is_paged(input):
+    """Request asked for the paged response (old clients get a plain list)."""
+    return any(input.get(k) for k in ('limit', 'cursor', 'count'))
+
+def estimate_count(query):
+    """Planner estimate of the rows matched by query, exact count on sqlite."""
+    query = query.order_by()
+    if config.IS_SQLITE:
+        return query.count()
+    sql, args = query.sql()
+    cursor = query._database.execute_sql("EXPLAIN (FORMAT JSON) " + sql, args)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def page(query, idfield, input):
+    """One page of query (a .dicts() select including idfield) as
+    {'rows', 'next_cursor', 'count'}, newest first."""
+    limit, cursor, count, export = params(input)
+    res = {}
+    if count:
+        try:
+            res['count'] = estimate_count(query)
+        except Exception as e:
+            log.error(e)
+            res['count'] = None
+    if cursor:
+        query = query.where(idfield < cursor)
+    rows = list(query.order_by(idfield.desc()).limit(limit + 1))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    res['rows'] = rows
+    res['next_cursor'] = rows[-1][idfield.name] if more else None
+    return res
+
+def iterate(query):
+    """Rows of query fetched FETCH_SIZE at a time, a named (server side)
+    cursor on postgres so the result set is never held in memory."""
+    if config.IS_SQLITE:
+        return query.iterator()
+    from playhouse.postgres_ext import ServerSide
+    return ServerSide(query, array_size=FETCH_SIZE)
+
+def _value(v):
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    return v
+
+def export(query, idfield, input, columns, name):
+    """Stream every row of query as ndjson or csv, columns are the keys of
+    the row dicts in output order."""
+    limit, cursor, count, fmt = params(input)
+    if cursor:
+        query = query.where(idfield < cursor)
+    query = query.order_by(idfield.desc())
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == 'csv':
+            writer.writerow(columns)
+        n = 0
+        try:
+            for row in iterate(query):
+                if fmt == 'csv':
+                    writer.writerow([_value(row.get(c)) for c in columns])
+                else:
+                    buf.write(json.dumps({c: _value(row.get(c)) for c in columns}))
+                    buf.write("\n")
+                n += 1
+                if n % FETCH_SIZE == 0:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+        except Exception as e:
+            # headers are gone already, all we can do is end the stream
+            log.error(e)
+        yield buf.getvalue()
+
+    filename = "{}-{}.{}".format(name, datetime.datetime.now().strftime("%Y%m%d%H%M%S"), fmt)
+    return Response(stream_with_context(generate()), mimetype=EXPORT_TYPES[fmt],
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
+def respond(query, idfield, input, name):
+    """Response of a log list endpoint: export stream, a page with cursor,
+    or for old clients the plain list of all rows as before."""
+    limit, cursor, count, fmt = params(input)
+    if fmt:
+        columns = [s._alias if hasattr(s, '_alias') else s.name for s in query._returning]
+        return export(query, idfield, input, columns, name)
+    if is_paged(input):
+        return buildResponse(page(query, idfield, input), 200)
+    return buildResponse(list(query.order_by(idfield.desc())), 200)
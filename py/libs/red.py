@@ -16,12 +16,180 @@
 import redis
 import datetime
 import time
+import json
+import math
+import re
+import threading
+import os
 from collections import defaultdict
 
 
 import logging
 log = logging.getLogger("RedisDB")
 
+STATS_PREFIX = "mikrowizard::stats::"
+
+# chart queries return at most this many points per series
+MAX_POINTS = 1000
+# bucket of the avg rule series per delta, raw series have no bucket
+NATIVE_BUCKET = {'5m': 300000, '1h': 3600000, 'daily': 86400000}
+SENSOR_KINDS = ('rxp', 'txp', 'rx', 'tx')
+_LABEL_RE = re.compile(r'[^A-Za-z0-9_.:/@-]')
+
+def label_value(text):
+    """Series label values are used in MRANGE filters, keep them filter safe."""
+    return _LABEL_RE.sub('_', str(text)) or '_'
+
+def sensor_kind(sensor):
+    """rx-ether1 -> ('rx', 'ether1'), cpu-load -> ('sensor', None)"""
+    kind, _, iface = sensor.partition('-')
+    if kind in SENSOR_KINDS and iface:
+        return kind, iface
+    return 'sensor', None
+
+def sensor_labels(dev_id, sensor, res, groups=()):
+    kind, iface = sensor_kind(sensor)
+    labels = {'dev': label_value(dev_id), 'metric': label_value(sensor), 'kind': kind, 'res': res}
+    if iface:
+        labels['iface'] = label_value(iface)
+    # a device can be in many groups, one grp_<id> label per group
+    for group in groups:
+        labels['grp_{}'.format(group)] = '1'
+    return labels
+
+def bucket_size(start, end, native, max_points=MAX_POINTS):
+    """Smallest multiple of the native bucket keeping (end-start) under max_points buckets."""
+    unit = native or 1
+    return unit * max(1, math.ceil((end - start) / (unit * max_points)))
+
+# --------------------------------------------------------------------------
+# connections, one pool per process (redis-py resets it after fork)
+
+_pool = None
+
+def get_connection():
+    """Redis client on the shared connection pool."""
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool(host='localhost', port=6379, db=0)
+    return redis.Redis(connection_pool=_pool)
+
+
+# --------------------------------------------------------------------------
+# change notifications between processes (pub/sub)
+#   one listener thread per process, callbacks get the message or None
+#   after the listener (re)connected and may have missed messages
+
+EVENTS_PREFIX = "mikrowizard::events::"
+
+_subscribers = {}
+_sub_lock = threading.Lock()
+_listener_pid = None
+
+def publish(channel, message=""):
+    """Notify all processes subscribed to channel, never raises."""
+    try:
+        get_connection().publish(EVENTS_PREFIX + channel, json.dumps(message))
+    except Exception as e:
+        log.error(e)
+
+def subscribe(channel, callback):
+    """Call callback(message) in the listener thread of this process for
+    every message published on channel. Safe to call repeatedly, also
+    (re)starts the listener in forked children."""
+    global _listener_pid
+    with _sub_lock:
+        callbacks = _subscribers.setdefault(channel, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+        if _listener_pid != os.getpid():
+            _listener_pid = os.getpid()
+            t = threading.Thread(target=_listen, name="redis-events", daemon=True)
+            t.start()
+
+def _dispatch(channel, message):
+    for callback in list(_subscribers.get(channel, [])):
+        try:
+            callback(message)
+        except Exception as e:
+            log.error(e)
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_connection().pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(EVENTS_PREFIX + "*")
+            for channel in list(_subscribers):
+                _dispatch(channel, None)
+            for item in pubsub.listen():
+                if item.get('type') != 'pmessage':
+                    continue
+                channel = item['channel'].decode()[len(EVENTS_PREFIX):]
+                _dispatch(channel, json.loads(item['data']))
+        except Exception as e:
+            log.error(e)
+            time.sleep(1)
+
+
+# --------------------------------------------------------------------------
+# local users of devices, written by the poller and read by syslog/radius
+
+LOCAL_USERS_PREFIX = "mikrowizard::local_users::"
+
+def set_local_users(devid, users, ttl=3600):
+    get_connection().set(LOCAL_USERS_PREFIX + str(devid), json.dumps(users), ex=ttl)
+
+def get_local_users(devid):
+    """Cached user names of device or None if not cached."""
+    data = get_connection().get(LOCAL_USERS_PREFIX + str(devid))
+    return json.loads(data) if data is not None else None
+
+def drop_local_users(devid):
+    get_connection().delete(LOCAL_USERS_PREFIX + str(devid))
+
+
+# --------------------------------------------------------------------------
+# permission groups last applied to devices by radius logins
+
+PERM_SYNC_PREFIX = "mikrowizard::perm_sync::"
+
+def set_perm_synced(devid, group, digest, ttl=3600):
+    get_connection().set("{}{}::{}".format(PERM_SYNC_PREFIX, devid, group), digest, ex=ttl)
+
+def get_perm_synced(devid, group):
+    data = get_connection().get("{}{}::{}".format(PERM_SYNC_PREFIX, devid, group))
+    return data.decode() if data is not None else None
+
+def drop_perm_synced(devid):
+    r = get_connection()
+    keys = list(r.scan_iter(match="{}{}::*".format(PERM_SYNC_PREFIX, devid)))
+    if keys:
+        r.delete(*keys)
+
+
+# --------------------------------------------------------------------------
+# runtime stats of workers and mules
+
+def _stats_redis():
+    return get_connection()
+
+def set_stats(name, data, ttl=300):
+    """Store a stats snapshot (dict) under name, expires if not refreshed."""
+    _stats_redis().set(STATS_PREFIX + name, json.dumps(data), ex=ttl)
+
+def get_stats(name=None):
+    """Return one stats snapshot or all of them as {name: snapshot}."""
+    r = _stats_redis()
+    if name:
+        data = r.get(STATS_PREFIX + name)
+        return json.loads(data) if data else None
+    res = {}
+    for key in r.scan_iter(match=STATS_PREFIX + "*"):
+        data = r.get(key)
+        if data:
+            res[key.decode()[len(STATS_PREFIX):]] = json.loads(data)
+    return res
+
 
 # --------------------------------------------------------------------------
 # key values
@@ -33,65 +201,69 @@ class RedisDB(object):
         self.start_time = options.get('start_time',self.current_time + datetime.timedelta(days=-30))
         self.end_time =  options.get('end_time',self.current_time)
         self.retention = options.get('retention',2629800000)
-        self.r = redis.Redis(host='localhost', port=6379, db=0)
+        self.r = get_connection()
         self.delta = options.get('delta','')
+        self.groups = options.get('groups',())
 
 
-    def create_sensor_rts(self,sensor):
+    def sensor_rts_keys(self,sensor):
+        """master key and its 5m/1h/daily avg rule keys with retention (create, alter), bucket and resolution"""
         retention=self.retention
         if "rx" in sensor or "tx" in sensor:
             retention=3600000
+        #5m avg store for 24h
+        #1h avg store for 2weeks
+        #daily avg store for 3month
+        return [
+            ("sensor::{}::{}".format(self.dev_id,sensor), retention, retention, None, 'raw'),
+            ("sensor5m::{}::{}".format(self.dev_id,sensor), 3600000*24, 3600000*24, 300000, '5m'),
+            ("sensor1h::{}::{}".format(self.dev_id,sensor), 3600000*336, 3600000*336, 3600000, '1h'),
+            ("sensordaily::{}::{}".format(self.dev_id,sensor), retention*2160, 3600000*2160, 86400000, 'daily'),
+        ]
+
+    def create_sensor_rts(self,sensor):
         if self.dev_id==False:
             return
-        master_key="sensor::{}::{}".format(self.dev_id,sensor)
-        rule5m_key="sensor5m::{}::{}".format(self.dev_id,sensor)
-        rule1h_key="sensor1h::{}::{}".format(self.dev_id,sensor)
-        ruledaily_key="sensordaily::{}::{}".format(self.dev_id,sensor)
-        #Create master key for sensor data or change retention time
-        try:
-            self.r.ts().create(master_key,retention_msecs=retention,duplicate_policy="last")
-        except Exception as e:
-            self.r.ts().alter(master_key,retention_msecs=retention)
-            pass
-        #Create ryle keys for sensor avg data or change retention time
-        try:
-            #5m avg store for 24h
-            #1h avg store for 2weeks
-            #daily avg store for 3month
-            self.r.ts().create(rule5m_key,retention_msecs=3600000*24,duplicate_policy="last")
-            self.r.ts().create(rule1h_key,retention_msecs=3600000*336,duplicate_policy="last")
-            self.r.ts().create(ruledaily_key,retention_msecs=retention*2160,duplicate_policy="last")
-        except Exception as e:
-            self.r.ts().alter(rule5m_key,retention_msecs=3600000*24)
-            self.r.ts().alter(rule1h_key,retention_msecs=3600000*336)
-            self.r.ts().alter(ruledaily_key,retention_msecs=3600000*2160)
-            pass
-        #Create rule for 5m avg data or change retention time
-        try:
-            self.r.ts().createrule(master_key, rule5m_key, "avg" ,bucket_size_msec=300000)
-        except Exception as e:
-            pass
-        #Create rule for 1hour avg data or change retention time
-        try:
-            self.r.ts().createrule(master_key, rule1h_key, "avg" ,bucket_size_msec=3600000)
-        except Exception as e:
-            pass
-        #Create rule for daily avg data or change retention time
-        try:
-            self.r.ts().createrule(master_key, ruledaily_key, "avg" ,bucket_size_msec=86400000)
-        except Exception as e:
-            pass
+        return self.create_rts([sensor])
+
+    def create_rts(self,sensors):
+        """Create master and avg rule series of sensors, or change their
+        retention if they exist. Two round trips for any number of sensors."""
+        series=[]
+        for sensor in sensors:
+            series.extend((sensor,)+keys for keys in self.sensor_rts_keys(sensor))
+        pipe=self.r.ts().pipeline(transaction=False)
+        for _,key,_,_,_,_ in series:
+            pipe.exists(key)
+        exists=pipe.execute()
+        pipe=self.r.ts().pipeline(transaction=False)
+        for (sensor,key,create_ret,alter_ret,bucket,res),found in zip(series,exists):
+            labels=sensor_labels(self.dev_id,sensor,res,self.groups)
+            if found:
+                # also labels series created before they had labels
+                pipe.alter(key,retention_msecs=alter_ret,labels=labels)
+            else:
+                pipe.create(key,retention_msecs=create_ret,duplicate_policy="last",labels=labels)
+        master_key=None
+        for _,key,_,_,bucket,_ in series:
+            if bucket is None:
+                master_key=key
+            else:
+                pipe.createrule(master_key, key, "avg" ,bucket_size_msec=bucket)
+        for res in pipe.execute(raise_on_error=False):
+            # existing rules answer with an error, same as before
+            if isinstance(res,Exception) and 'rule' not in str(res):
+                log.error(res)
         return True
 
     def dev_create_keys(self):
         if self.dev_id==False:
             return
-        for key in self.keys:
-            try:
-                self.create_sensor_rts(key)
-            except Exception as e:
-                log.error(e)
-                pass
+        try:
+            self.create_rts(self.keys)
+        except Exception as e:
+            log.error(e)
+            pass
         return True
 
 
@@ -125,11 +297,44 @@ class RedisDB(object):
         master_key="sensor::{}::{}".format(self.dev_id,sensor)
         return self.r.ts().get(master_key)
 
-    def get_dev_data_keys(self):
+    def get_dev_data_keys(self,max_points=MAX_POINTS):
+        """{sensor: [(ts, value), ...]} of all self.keys with a single
+        TS.MRANGE on the series labels, at most max_points per series
+        (live: last 30). Series without labels yet are read one by one."""
         if self.dev_id==False:
             return
+        keys=set(self.keys)
+        live=self.delta=='live'
+        res='raw' if live or not self.delta else self.delta
+        prefix="sensor{}::{}::".format('' if live else self.delta,self.dev_id)
+        filters=['dev={}'.format(label_value(self.dev_id)),'res={}'.format(res)]
+        ifaces={sensor_kind(key)[1] for key in keys}
+        if len(ifaces)==1 and None not in ifaces:
+            filters.append('iface={}'.format(label_value(ifaces.pop())))
+        start=int(time.mktime(self.start_time.timetuple())* 1000)
+        end=int(time.mktime(self.end_time.timetuple())* 1000)
+        reply=[]
+        try:
+            if live:
+                reply=self.r.ts().mrevrange(start,end,filters,count=30)
+            else:
+                native=NATIVE_BUCKET.get(self.delta,0)
+                bucket=bucket_size(start,end,native,max_points)
+                if bucket>native:
+                    reply=self.r.ts().mrange(start,end,filters,aggregation_type='avg',bucket_size_msec=bucket)
+                else:
+                    reply=self.r.ts().mrange(start,end,filters)
+        except Exception as e:
+            log.error(e)
         data = defaultdict(list)
+        for item in reply:
+            for key,(labels,points) in item.items():
+                sensor=key[len(prefix):] if key.startswith(prefix) else None
+                if sensor in keys:
+                    data[sensor]=list(reversed(points)) if live else points
         for key in self.keys:
+            if key in data:
+                continue
             try:
                 data[key]=self.get_dev_data(key)
             except Exception as e:
@@ -137,3 +342,96 @@ class RedisDB(object):
                 pass
         return data
 
+
+
+# --------------------------------------------------------------------------
+# fleet/group aggregates, summed inside redis
+
+def get_fleet_data(metrics, delta, start_time, end_time, group=None, interval=60, max_points=MAX_POINTS):
+    """{metric: [(ts, value), ...]} of metrics (like rx-total) summed over
+    all devices, or over the devices of group. Per device series are
+    averaged into aligned buckets first so REDUCE sum adds up samples of
+    the same bucket."""
+    live = delta == 'live'
+    res = 'raw' if live or not delta else delta
+    end = int(time.mktime(end_time.timetuple()) * 1000)
+    if live:
+        bucket = interval * 1000
+        start = end - bucket * 31
+    else:
+        start = int(time.mktime(start_time.timetuple()) * 1000)
+        bucket = bucket_size(start, end, NATIVE_BUCKET.get(delta, interval * 1000), max_points)
+    filters = [
+        'metric=({})'.format(','.join(label_value(m) for m in metrics)),
+        'res={}'.format(res),
+        'dev!=all',
+    ]
+    if group and int(group) != 1:
+        # group 1 holds every device
+        filters.append('grp_{}=1'.format(int(group)))
+    reply = get_connection().ts().mrange(start, end, filters,
+        aggregation_type='avg', bucket_size_msec=bucket, groupby='metric', reduce='sum')
+    data = defaultdict(list)
+    for item in reply:
+        for key, (labels, points) in item.items():
+            # key of a group is "metric=<value>"
+            data[key.partition('=')[2]] = points
+    if live:
+        # the newest bucket is still being filled by the grabber
+        for metric in data:
+            if data[metric] and data[metric][-1][0] + bucket > end:
+                data[metric] = data[metric][:-1]
+            data[metric] = data[metric][-30:]
+    return data
+# --------------------------------------------------------------------------
+# batched time series writes
+
+class TSBatcher(object):
+    """Collects sensor samples of many devices (thread safe), flush()
+    writes all of them with a single TS.MADD per chunk."""
+
+    def __init__(self, chunk=10000):
+        self.chunk = chunk
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def add(self, dev_id, info, ts=None):
+        ts = ts or int(time.time() * 1000)
+        samples = [("sensor::{}::{}".format(dev_id, key), ts, val) for key, val in info.items()]
+        with self.lock:
+            self.samples.extend(samples)
+
+    def pending(self):
+        return len(self.samples)
+
+    def flush(self):
+        """Write collected samples, returns (written, failed) numbers of
+        samples counted from the reply of every TS.MADD."""
+        with self.lock:
+            samples, self.samples = self.samples, []
+        if not samples:
+            return 0, 0
+        r = get_connection()
+        pipe = r.ts().pipeline(transaction=False)
+        chunks = [samples[i:i + self.chunk] for i in range(0, len(samples), self.chunk)]
+        for chunk in chunks:
+            pipe.madd(chunk)
+        written = failed = 0
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception as e:
+            # connection lost, we can't tell which chunks got through
+            log.error(e)
+            return 0, len(samples)
+        for chunk, res in zip(chunks, results):
+            if isinstance(res, Exception):
+                # the whole command was rejected
+                log.error(res)
+                failed += len(chunk)
+                continue
+            errors = [x for x in res if isinstance(x, Exception)]
+            if errors:
+                log.error("{} samples not written: {}".format(len(errors), errors[0]))
+            failed += len(errors)
+            written += len(chunk) - len(errors)
+        return written, failed
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# response_cache.py: redis cache of read-only API responses
+#   - key: endpoint, permission scope of the caller, normalized request
+#     (json body + query args) and the versions of the tags it depends on
+#   - invalidate(tag) bumps the tag version, entries keyed on the old
+#     version are never read again and expire by their ttl
+#   - ETag on every cached response, If-None-Match is answered with 304
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import functools
+import hashlib
+import json
+
+from flask import request, session, make_response
+from libs import red
+import config
+
+import logging
+log = logging.getLogger("response_cache")
+
+PREFIX = "mikrowizard::response::"
+TAG_PREFIX = PREFIX + "tag::"
+TAGS = ('devices', 'groups', 'firmware', 'perms', 'snippets')
+
+
+def invalidate(*tags):
+    """Drop every cached response depending on one of tags, never raises."""
+    try:
+        pipe = red.get_connection().pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(TAG_PREFIX + tag)
+        pipe.execute()
+    except Exception as e:
+        log.error(e)
+
+def _scope(scope):
+    if scope == 'user':
+        return str(session.get("userid"))
+    # same role and admin perms see the same data
+    return "{}:{}".format(session.get("role"), json.dumps(session.get("perms") or {}, sort_keys=True))
+
+def _key(r, tags, scope):
+    versions = r.mget([TAG_PREFIX + tag for tag in tags]) if tags else []
+    data = json.dumps([
+        request.path,
+        _scope(scope),
+        request.get_json(silent=True),
+        request.args.to_dict(flat=False),
+        [v.decode() if v else "0" for v in versions],
+    ], sort_keys=True, default=str)
+    return PREFIX + hashlib.sha1(data.encode()).hexdigest()
+
+def _cacheable(response):
+    """200 json replies which are not an error reported in the body."""
+    if response.status_code != 200 or response.mimetype != 'application/json':
+        return False
+    result = (response.get_json(silent=True) or {}).get('result')
+    if isinstance(result, dict):
+        return 'err' not in result and result.get('status') != 'failed' and result.get('result') != 'failed'
+    return True
+
+def _reply(body, etag, hit):
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        response = make_response(body, 200)
+        response.mimetype = 'application/json'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+def cached(*tags, ttl=None, scope='perms'):
+    """Decorator: cache the response of a read-only endpoint until one of
+    tags is invalidated or ttl seconds passed. Insert after login_required
+    so access is checked before the cache is read:
+       @app.route('/api/dev/list', methods = ['POST'])
+       @login_required(role='admin',perm={'device':'read'})
+       @cached('devices', 'groups', scope='user')
+    scope 'user': the reply depends on who asks (its device set),
+    'perms': only on the role and admin permissions of the caller."""
+    for tag in tags:
+        assert tag in TAGS, tag
+    ttl = ttl or config.RESPONSE_CACHE_TTL
+
+    def decorator(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            try:
+                r = red.get_connection()
+                key = _key(r, tags, scope)
+                data = r.get(key)
+            except Exception as e:
+                log.error(e)
+                return func(*args, **kwargs)
+            if data:
+                entry = json.loads(data)
+                return _reply(entry['body'], entry['etag'], True)
+            response = make_response(func(*args, **kwargs))
+            if not _cacheable(response):
+                return response
+            body = response.get_data(as_text=True)
+            etag = hashlib.sha1(body.encode()).hexdigest()
+            try:
+                r.set(key, json.dumps({'etag': etag, 'body': body}), ex=ttl)
+            except Exception as e:
+                log.error(e)
+            return _reply(body, etag, False)
+        return inner
+    return decorator
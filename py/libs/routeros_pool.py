@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# routeros_pool.py: per process pool of logged in RouterOS API connections
+#   - keyed by device id, one connection per device
+#   - idle timeout, max age, health check of idle connections
+#   - dropped when the device credentials/address change
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import hashlib
+import json
+import threading
+import time
+
+import logging
+log = logging.getLogger("routeros_pool")
+
+
+class _Entry(object):
+    __slots__ = ('router', 'key', 'created', 'last_used', 'busy')
+
+    def __init__(self, router, key):
+        self.router = router
+        self.key = key
+        self.created = time.time()
+        self.last_used = self.created
+        self.busy = True
+
+
+class RouterPool(object):
+    """Pool of RouterOSCheckResource objects created by factory(options).
+    A connection is lent to one caller at a time, a second concurrent
+    caller for the same device gets a private connection which is closed
+    on release."""
+
+    def __init__(self, factory, max_size=1000, idle_timeout=180, max_age=3600, health_interval=120):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.health_interval = health_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last_reap = 0
+
+    @staticmethod
+    def credential_key(options):
+        raw = json.dumps([options.get(k) for k in ('host', 'port', 'username', 'password', 'ssl')], default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def close(router):
+        api = getattr(router, '_api', None)
+        if api is None:
+            return
+        try:
+            api.close()
+        except Exception as e:
+            log.debug(e)
+
+    @staticmethod
+    def is_closed(router):
+        """True when the connection is known dead (asyncio client notices
+        resets/EOF as they arrive), costs no round trip."""
+        api = getattr(router, '_api', None)
+        if api is None:
+            return True
+        aapi = getattr(api, 'aapi', None)
+        return aapi is not None and aapi.closed
+
+    def healthy(self, router):
+        if self.is_closed(router):
+            return False
+        api = router._api
+        try:
+            tuple(api('/system/identity/print'))
+            return True
+        except Exception:
+            return False
+
+    def _reap(self, now):
+        """Pop expired idle entries, caller holds the lock."""
+        expired = []
+        if now - self.last_reap < 10 and len(self.entries) < self.max_size:
+            return expired
+        self.last_reap = now
+        for devid, entry in list(self.entries.items()):
+            if entry.busy:
+                continue
+            if now - entry.last_used > self.idle_timeout or now - entry.created > self.max_age:
+                expired.append(self.entries.pop(devid))
+        overflow = len(self.entries) - self.max_size + 1
+        if overflow > 0:
+            idle = sorted((e.last_used, devid) for devid, e in self.entries.items() if not e.busy)
+            for _, devid in idle[:overflow]:
+                expired.append(self.entries.pop(devid))
+        return expired
+
+    def acquire(self, devid, options):
+        """Return a connected router for device, raise on connect failure."""
+        key = self.credential_key(options)
+        now = time.time()
+        entry = None
+        private = False
+        with self.lock:
+            stale = self._reap(now)
+            current = self.entries.get(devid)
+            if current is not None:
+                if current.busy:
+                    private = True
+                elif current.key != key or now - current.created > self.max_age:
+                    stale.append(self.entries.pop(devid))
+                else:
+                    current.busy = True
+                    entry = current
+        for old in stale:
+            self.close(old.router)
+        if entry is not None:
+            if now - entry.last_used < self.health_interval:
+                if not self.is_closed(entry.router):
+                    return entry.router
+            elif self.healthy(entry.router):
+                return entry.router
+            self.release(devid, entry.router, broken=True)
+        router = self.factory(options)
+        # connect now so failures surface here and not at first use
+        router.api
+        if not private:
+            with self.lock:
+                if devid not in self.entries:
+                    self.entries[devid] = _Entry(router, key)
+        return router
+
+    def release(self, devid, router, broken=False):
+        """Give router back, broken connections are closed and forgotten."""
+        if router is None:
+            return
+        with self.lock:
+            entry = self.entries.get(devid)
+            if entry is None or entry.router is not router:
+                entry = None
+            elif broken:
+                self.entries.pop(devid, None)
+            else:
+                entry.busy = False
+                entry.last_used = time.time()
+                return
+        self.close(router)
+
+    def invalidate(self, devid):
+        with self.lock:
+            entry = self.entries.pop(devid, None)
+        if entry is not None and not entry.busy:
+            self.close(entry.router)
+
+    def size(self):
+        return len(self.entries)
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# stats.py: in-process runtime metrics for mules and workers
+#   - counters, gauges and latency histograms (milliseconds)
+#   - snapshots are published to redis so the API can expose them
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import threading
+import time
+from libs import red
+
+import logging
+log = logging.getLogger("stats")
+
+# histogram bucket upper bounds in ms, last bucket is everything above
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Stats(object):
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.last_flush = 0
+
+    def incr(self, key, value=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, key, value):
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, key, value):
+        """Add one sample (ms) to the histogram named key."""
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(self.buckets) + 1)}
+                self.histograms[key] = h
+            h["count"] += 1
+            h["sum"] += value
+            if value > h["max"]:
+                h["max"] = value
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h["buckets"][idx] += 1
+                    break
+            else:
+                h["buckets"][-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for key, h in self.histograms.items():
+                histograms[key] = {
+                    "count": h["count"],
+                    "avg": round(h["sum"] / h["count"], 2) if h["count"] else 0,
+                    "max": round(h["max"], 2),
+                    "buckets": dict(zip([str(b) for b in self.buckets] + ["inf"], h["buckets"])),
+                }
+            return {
+                "name": self.name,
+                "uptime": int(time.time() - self.started),
+                "updated": int(time.time()),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": histograms,
+            }
+
+    def flush(self, interval=0):
+        """Publish snapshot to redis, at most once per interval seconds."""
+        now = time.time()
+        if now - self.last_flush < interval:
+            return False
+        self.last_flush = now
+        try:
+            red.set_stats(self.name, self.snapshot())
+        except Exception as e:
+            log.error(e)
+            return False
+        return True
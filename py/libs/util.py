@@ -10,21 +10,29 @@ import datetime
 import time
 import uuid
 import socket
+import ssl
+import asyncio
+import concurrent.futures
 import config
-from libs.db import db_sysconfig,db_firmware,db_backups,db_events
+from libs.db import db_sysconfig,db_firmware,db_backups,db_events,db_device
 from cryptography.fernet import Fernet 
 from libs.check_routeros.routeros_check.resource import RouterOSCheckResource
+from libs.aiorouteros import AsyncRouterOSCheckResource
+from libs.routeros_pool import RouterPool
+from librouteros.exceptions import ConnectionClosed, TrapError, MultiTrapError
 from libs.check_routeros.routeros_check.helper import  RouterOSVersion
 from typing import  Dict
 import re
 import json 
 import logging
 from libs.red import RedisDB
+from libs import red
 from libs.ssh_helper import SSH_Helper
 import os
 from bs4 import BeautifulSoup
 import urllib.request
 import hashlib
+import threading
 import netifaces
 log = logging.getLogger("util")
 try:
@@ -105,7 +113,39 @@ def get_default_user_pass():
         default_pass=""
     return default_user,default_pass
 
+# devid -> (expires, credential columns, options) of build_api_options, polls
+# and syslog/radius lookups would decrypt the same credentials over and over
+_api_options={}
+_api_options_lock=threading.Lock()
+_api_options_pid=None
+
+def _api_options_changed(devids=None):
+    """Drop the cached options of devids (or all devices)."""
+    with _api_options_lock:
+        if devids:
+            for devid in devids:
+                _api_options.pop(int(devid),None)
+        else:
+            _api_options.clear()
+
 def build_api_options(dev):
+    global _api_options_pid
+    if _api_options_pid!=os.getpid():
+        _api_options_pid=os.getpid()
+        red.subscribe('devices',_api_options_changed)
+        # the default user/password may have changed
+        red.subscribe('sysconfig',lambda keys: _api_options_changed())
+    now=time.time()
+    columns=(dev.ip,dev.port,dev.user_name,dev.password)
+    hit=_api_options.get(dev.id)
+    if hit and hit[0]>now and hit[1]==columns:
+        return dict(hit[2])
+    options=_build_api_options(dev)
+    with _api_options_lock:
+        _api_options[dev.id]=(now+config.API_OPTIONS_TTL,columns,options)
+    return dict(options)
+
+def _build_api_options(dev):
     default_user,default_pass= get_default_user_pass()
     username=decrypt_data(dev.user_name ) or default_user
     password=decrypt_data(dev.password ) or default_pass
@@ -120,23 +160,91 @@ def build_api_options(dev):
     }
     return options
 
-def check_device_firmware_update(dev,q):
-    port=dev.port or 8728
-    if check_port(dev.ip,port):
-        options=build_api_options(dev)
+def connect_router(options):
+    """RouterOS resource for options, on the asyncio client unless
+    PYSRV_ROUTEROS_API_BACKEND (or options api_backend) says librouteros"""
+    backend=options.get('api_backend',config.ROUTEROS_API_BACKEND)
+    if backend=='asyncio':
+        return AsyncRouterOSCheckResource(options)
+    return RouterOSCheckResource(options)
+
+router_pool=RouterPool(connect_router,
+    max_size=config.ROUTEROS_POOL_SIZE,
+    idle_timeout=config.ROUTEROS_POOL_IDLE,
+    max_age=config.ROUTEROS_POOL_MAX_AGE,
+    health_interval=config.ROUTEROS_POOL_HEALTH)
+
+# connection failures which mean the device can't be reached at all
+UNREACHABLE_ERRORS=('refused','timeout','unreachable','closed')
+
+def classify_api_error(e,connecting=False):
+    """Kind of a RouterOS API failure: refused, timeout, unreachable,
+    closed, tls, auth (login rejected) or api (command failed)"""
+    if isinstance(e,(TimeoutError,socket.timeout,asyncio.TimeoutError,concurrent.futures.TimeoutError)):
+        return 'timeout'
+    if isinstance(e,ConnectionRefusedError):
+        return 'refused'
+    if isinstance(e,ssl.SSLError):
+        return 'tls'
+    if isinstance(e,(ConnectionClosed,ConnectionResetError,BrokenPipeError,asyncio.IncompleteReadError)):
+        return 'closed'
+    if isinstance(e,OSError):
+        return 'unreachable'
+    if isinstance(e,(TrapError,MultiTrapError)):
+        return 'auth' if connecting else 'api'
+    return 'api'
+
+def api_error_detail(kind):
+    """connection event detail for an error kind"""
+    return "Unreachable" if kind in UNREACHABLE_ERRORS else "API Connection"
+
+# /system/resource columns used by the poll and check_update
+POLL_RESOURCE_PROPS=('uptime','version','architecture-name','board-name','free-memory','cpu-load','free-hdd-space')
+
+def proplist(*props):
+    return '=.proplist={}'.format(','.join(props))
+
+def api_pipeline(router,commands):
+    """Run [(cmd, word, ...), ...] on router, all in flight at once when the
+    client supports it. Returns rows per command or the exception it raised"""
+    api=router.api
+    if hasattr(api,'pipeline'):
+        return api.pipeline(commands)
+    results=[]
+    for cmd in commands:
         try:
-            is_availbe , current , arch , upgrade_availble = check_update(options)
+            results.append(list(api.rawCmd(*cmd)))
         except Exception as e:
-            q.put({"id": dev.id,"update_availble":False,"reason":"Unknoown Reason"})
-        if is_availbe:
-                q.put({"id": dev.id,"update_availble":is_availbe,"current_firmware":current,"arch":arch,"upgrade_availble":upgrade_availble})
+            results.append(e)
+    return results
+
+def check_device_firmware_update(dev,q):
+    options=build_api_options(dev)
+    router=None
+    try:
+        # no port probe, a failing connect tells the same
+        router=router_pool.acquire(dev.id,options)
+    except Exception as e:
+        kind=classify_api_error(e,connecting=True)
+        log.warning("{} port {}: {} ({})".format(dev.ip,options['port'],kind,e))
+        if kind=='auth':
+            q.put({"id": dev.id,"reason":"Wrong user or password"})
         else:
-            if current:
-                q.put({"id": dev.id,"update_availble":is_availbe,"current_firmware":current,"arch":arch,"upgrade_availble":upgrade_availble})
-            else:
-                q.put({"id": dev.id,"reason":"Wrong user or password"})
+            q.put({"id": dev.id,"update_availble":False,"reason":"Connection problem"})
+        return
+    current=False
+    try:
+        is_availbe , current , arch , upgrade_availble = check_update(options,router)
+    finally:
+        # check_update logs its errors, a failed read leaves current empty
+        router_pool.release(dev.id,router,broken=not current)
+    if is_availbe:
+            q.put({"id": dev.id,"update_availble":is_availbe,"current_firmware":current,"arch":arch,"upgrade_availble":upgrade_availble})
     else:
-         q.put({"id": dev.id,"update_availble":False,"reason":"Connection problem"})
+        if current:
+            q.put({"id": dev.id,"update_availble":is_availbe,"current_firmware":current,"arch":arch,"upgrade_availble":upgrade_availble})
+        else:
+            q.put({"id": dev.id,"update_availble":False,"reason":"Unknoown Reason"})
 
 def get_interfaces_counters(router):
    result = {}
@@ -190,8 +298,9 @@ def mergeDictionary(dict_1, dict_2):
                 dict_3[key] = {**dict_2[key]}
     return dict_3
 
-def get_network_data(router):
-   interfaces=get_interfaces_counters(router)
+def get_network_data(router,interfaces=None):
+   if interfaces is None:
+       interfaces=get_interfaces_counters(router)
    interfaces_list=get_interface_list(interfaces)
    traffic=get_traffic(router,interfaces_list)
    return mergeDictionary(interfaces,traffic)
@@ -202,68 +311,81 @@ def check_or_fix_event(events,eventtype,detail,comment=False):
     else:
         found_event_id=next((item for item in events if item["eventtype"] == eventtype and item["detail"] == detail), False)        
     if found_event_id:
-        db_events.fix_event(found_event_id['id'])
+        if hasattr(events,'fix'):
+            # DeviceEvents of an EventManager, written with its next flush
+            events.fix(found_event_id)
+        else:
+            db_events.fix_event(found_event_id['id'])
         return True
     else:
         return False
 
-def grab_device_data(dev, q):
-    max_attempts = 3
-    attempts = 0
+def open_event(events,devid,eventtype,src,detail,level,comment=""):
+    """Open event of type eventtype unless it is open already."""
+    if hasattr(events,'open'):
+        events.open(eventtype,detail,level,comment)
+    else:
+        getattr(db_events,"{}_event".format(eventtype))(devid,src,detail,level,0,comment)
+
+# devid -> groups the device's sensor series were labelled with by this process
+rts_labelled={}
+
+def grab_device_data(dev, q, batcher=None, groups=(), event_manager=None, device_batcher=None):
     port=dev.port or 8728
-    success = False
-    time_to_wait=0.1
-    while attempts < max_attempts:
-        if check_port(dev.ip,port):
-            success = True
-            break
-        attempts += 1
-        time.sleep(time_to_wait)
-        time_to_wait += 0.1
-    if success:
-        # get all device events which src is "Data Puller" and status is 0
+    # columns as loaded, device_batcher only writes the ones this poll changed
+    before=dict(dev.__data__)
+    # get all device events which src is "Data Puller" and status is 0
+    if event_manager is not None:
+        events=event_manager.device(dev.id)
+    else:
         events=list(db_events.get_events_by_src_and_status("Data Puller", 0,dev.id).dicts())
+    options=build_api_options(dev)
+    router=None
+    broken=False
+    try:
+        try:
+            router=router_pool.acquire(dev.id,options)
+        except Exception as e:
+            kind=classify_api_error(e,connecting=True)
+            log.warning("{} port {}: {} ({})".format(dev.ip,port,kind,e))
+            if kind in UNREACHABLE_ERRORS:
+                reason="device not reachable with port {} ({})".format(port,kind)
+            else:
+                reason="{} ({})".format(e,kind)
+            q.put({"id": dev.id,"detail":api_error_detail(kind),"kind":kind,"reason":reason,"done":False})
+            return True
         check_or_fix_event(events,"connection","Unreachable")
-        options=build_api_options(dev)
         try:
-            router=RouterOSCheckResource(options)
-            _installed_version=router._get_routeros_version()
-            call = router.api.path(
-              "/system/resource"
-            )
-            results = tuple(call)
-            result: Dict[str, str] = results[0]
-            try:
-                call = router.api.path(
-                "/system/routerboard"
-                )
-                routerboard = tuple(call)
-                routerboard: Dict[str, str] = routerboard[0]
-                result.update(routerboard)
-            except Exception as e:
-                if 'no such command' not in str(e):
-                    log.error(e)
-                pass
-            call = router.api.path(
-              "/system/health"
-            )
-            health = tuple(call)
-            
-            call = router.api.path(
-                    "/system/identity"
-                )
-            name = tuple(call)
+            _installed_version=router.routeros_version
+            # every read of this poll goes out at once, restricted to the columns we use
+            resource,routerboard,health,name,wifi_results,iface_stats,users=api_pipeline(router,[
+                ('/system/resource/print',proplist(*POLL_RESOURCE_PROPS)),
+                ('/system/routerboard/print',proplist('current-firmware','upgrade-firmware','model')),
+                ('/system/health/print',),
+                ('/system/identity/print',proplist('name')),
+                ('/interface/wireless/print',),
+                ('/interface/print','=stats=yes',proplist('name','default-name')),
+                ('/user/print',proplist('name')),
+            ])
+            for res in (resource,health,name):
+                if isinstance(res,Exception):
+                    raise res
+            if not isinstance(users,Exception):
+                cache_local_users(dev.id,users)
+            result: Dict[str, str] = resource[0]
+            if isinstance(routerboard,Exception):
+                if 'no such command' not in str(routerboard):
+                    log.error(routerboard)
+            elif routerboard:
+                result.update(routerboard[0])
             name: Dict[str, str] = name[0]
             result.update(name)
             wireless_keys,wireless_data=[],[]
             if ISPRO:
                 wireless_keys,wireless_data=utilpro.wireless_actions(router,dev,events)
             try:
-                
-                call = router.api.path(
-                    "/interface/wireless"
-                )
-                wifi_results = tuple(call)
+                if isinstance(wifi_results,Exception):
+                    raise wifi_results
                 wifi_result: Dict[str, str] = wifi_results[0]
                 device_type='router'
                 if wifi_result['mode'] in ['ap-bridge','bridge','wds-slave']:
@@ -279,7 +401,9 @@ def grab_device_data(dev, q):
         except Exception as e:
             log.error(e)
             log.warning(dev.ip)
-            q.put({"id": dev.id,"detail":"API Connection","reason":e,"done":False})
+            broken=True
+            kind=classify_api_error(e)
+            q.put({"id": dev.id,"detail":api_error_detail(kind),"kind":kind,"reason":e,"done":False})
             return True
         check_or_fix_event(events,"connection","API Connection")
         try:
@@ -292,7 +416,7 @@ def grab_device_data(dev, q):
                     for d in health:
                         if 'state' in d['name']:
                             if d['value'] == 'fail':
-                                db_events.health_event(dev.id,'Data Puller',d['name'],'Critical',0,"{} is Failed".format(d['name']))
+                                open_event(events,dev.id,'health','Data Puller',d['name'],'Critical',"{} is Failed".format(d['name']))
                             else:
                                 check_or_fix_event(events,"health",d['name'])
                             continue
@@ -318,7 +442,7 @@ def grab_device_data(dev, q):
         try:
             # arch=result['architecture-name']
             try:
-                is_availbe , current , arch , upgrade_availble = check_update(options)
+                is_availbe , current , arch , upgrade_availble = check_update(options,router,result)
                 dev.update_availble=is_availbe
                 dev.upgrade_availble=upgrade_availble
                 dev.current_firmware=current
@@ -333,7 +457,7 @@ def grab_device_data(dev, q):
                     res = configure_radius(router, peer_ip,secret)
                     check_or_fix_event(events,"config","radius configuration")
                 except:
-                    db_events.config_event(dev.id,'Data Puller','radius configuration','Error',0,"Force radius Failed")
+                    open_event(events,dev.id,'config','Data Puller','radius configuration','Error',"Force radius Failed")
                     pass
             try:
                 syslog_configured=check_syslog_config(dev,router,force_syslog)
@@ -341,8 +465,9 @@ def grab_device_data(dev, q):
                     dev.syslog_configured=syslog_configured
                 check_or_fix_event(events,"config","syslog configuration")
             except:
-                db_events.config_event(dev.id,'Data Puller','syslog configuration','Error',0,"Force SysLog Failed")
+                open_event(events,dev.id,'config','Data Puller','syslog configuration','Error',"Force SysLog Failed")
                 pass
+            firmware_changed=str(dev.current_firmware)!=str(_installed_version)
             dev.current_firmware=_installed_version
             dev.uptime=result['uptime']
             dev.router_type=device_type
@@ -351,7 +476,10 @@ def grab_device_data(dev, q):
             if device_type!='router':
                 dev.wifi_config=json.dumps(wifi_result)
 
-            interfaces=get_network_data(router)
+            counters=None
+            if not isinstance(iface_stats,Exception):
+                counters={iface['name']:iface for iface in iface_stats}
+            interfaces=get_network_data(router,counters)
             interfaces_keys=interfaces.keys()
             data={}
             for key in keys:
@@ -369,35 +497,58 @@ def grab_device_data(dev, q):
             if len(wireless_keys)>0:
                 keys.extend(wireless_keys)
             data.update(wireless_data)
+            groups=sorted(groups)
             redopts={
             "dev_id":dev.id,
-            "keys":keys
+            "keys":keys,
+            "groups":groups
             }
             reddb=RedisDB(redopts)
             if not dev.sensors or (len(json.loads(dev.sensors))<len(keys) and dev.sensors!=json.dumps(keys)):
                 log.info("updating keys for device {}".format(dev.id))
                 dev.sensors=json.dumps(keys)
                 reddb.dev_create_keys()
-            dev.save()
-            reddb.add_dev_data(data)
+            elif rts_labelled.get(dev.id)!=groups:
+                # first poll of this process (series of older versions have
+                # no labels) or the device moved between groups
+                reddb.dev_create_keys()
+            rts_labelled[dev.id]=groups
+            if device_batcher is not None:
+                # written by the grabber with the other devices of this round
+                device_batcher.add(dev,before)
+            else:
+                dev.save()
+                if firmware_changed:
+                    db_device.devices_changed([dev.id])
+            if batcher is not None:
+                # written by the grabber with the other devices of this round
+                batcher.add(dev.id,data)
+            else:
+                reddb.add_dev_data(data)
             check_or_fix_event(events,"connection","DB Write")
         except Exception as e:
             log.error(e)
             log.warning(dev.ip)
             q.put({"id": dev.id,"reason":"Unable to store data in DB","detail":"DB Write","done":False})
             return True
-    else:
-        q.put({"id": dev.id, "reason":"device not reachable with port {}".format(port),"detail":"Unreachable", "done":False})
-        return True
-    q.put({"id": dev.id,"done":True,'data':data})
+        q.put({"id": dev.id,"done":True,'data':data})
+    finally:
+        router_pool.release(dev.id,router,broken)
     return True
 
 
 def check_syslog_config(dev,router,apply=False):
+    if not router:
+        try:
+            router=router_pool.acquire(dev.id,build_api_options(dev))
+        except Exception as e:
+            log.error(e)
+            return False
+        try:
+            return check_syslog_config(dev,router,apply)
+        finally:
+            router_pool.release(dev.id,router)
     try:
-        if not router:
-            options=build_api_options(dev)
-            router=RouterOSCheckResource(options)
         peer_ip=dev.peer_ip if dev.peer_ip else db_sysconfig.get_sysconfig('default_ip')
         devid=dev.id
         call = router.api.path(
@@ -531,18 +682,47 @@ def configure_radius(router,ip,secret):
         log.error(e)
         return False
 
+def perm_sync_digest(dev,group,perms,peer_ip,secret):
+    """Hash of everything FourcePermToRouter puts on the device."""
+    raw=json.dumps([dev.id,group,perms,str(dev.current_firmware),peer_ip,secret])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def drop_perm_synced(devid):
+    """Next radius login of device applies its permission group again."""
+    try:
+        red.drop_perm_synced(devid)
+    except Exception as e:
+        log.error(e)
+
 def FourcePermToRouter(dev,perm):
+    peer_ip=dev.peer_ip if dev.peer_ip else db_sysconfig.get_sysconfig('default_ip')
+    secret = db_sysconfig.get_sysconfig('rad_secret')
+    group=perm[0].perm_id.name
+    digest=perm_sync_digest(dev,group,perm[0].perm_id.perms,peer_ip,secret)
+    try:
+        if red.get_perm_synced(dev.id,group)==digest:
+            return True
+    except Exception as e:
+        log.error(e)
+    res2=_force_perm_to_router(dev,perm,peer_ip,secret)
+    if res2:
+        try:
+            red.set_perm_synced(dev.id,group,digest,config.PERM_SYNC_TTL)
+        except Exception as e:
+            log.error(e)
+    return res2
+
+def _force_perm_to_router(dev,perm,peer_ip,secret):
+    router=None
     try:
         options=build_api_options(dev)
-        router=RouterOSCheckResource(options)
-        peer_ip=dev.peer_ip if dev.peer_ip else db_sysconfig.get_sysconfig('default_ip')
-        secret = db_sysconfig.get_sysconfig('rad_secret')
+        router=router_pool.acquire(dev.id,options)
         res = configure_radius(router, peer_ip,secret)
         try:
             pl=json.loads(perm[0].perm_id.perms)
             perms=[p if pl[p] else '!{}'.format(p) for p in pl]
             perms.sort()
-            _installed_version=router._get_routeros_version()
+            _installed_version=router.routeros_version
             if _installed_version > RouterOSVersion('7.6'):
                 if "!dude" in perms:
                     perms.remove("!dude")
@@ -567,14 +747,16 @@ def FourcePermToRouter(dev,perm):
     except Exception as e:
         log.error(e)
         return False
+    finally:
+        router_pool.release(dev.id,router)
 
-def check_update(options,router=False):
+def check_update(options,router=False,resource=None):
     ofa=db_sysconfig.get_firmware_action().value
     #is_availbe , current , arch , data
     try:
         if not router:
-            router=RouterOSCheckResource(options)
-        _installed_version=router._get_routeros_version()
+            router=connect_router(options)
+        _installed_version=router.routeros_version
         try:
             if ofa=="keep" and _installed_version < RouterOSVersion('6.99.99'):
                 _latest_version=RouterOSVersion(db_sysconfig.get_firmware_old().value)
@@ -582,24 +764,28 @@ def check_update(options,router=False):
                 _latest_version=RouterOSVersion(db_sysconfig.get_firmware_latest().value)
         except:
             _latest_version=False
-        call = router.api.path(
-            "/system/resource"
-        )
-        results = tuple(call)
-        result: Dict[str, str] = results[0]
-        arch=result['architecture-name']
-        try:
+        if resource is not None:
+            # resource + routerboard already read by the caller
+            result=resource
+        else:
             call = router.api.path(
-                "/system/routerboard"
+                "/system/resource"
             )
-            
-            routerboard = tuple(call)
-            routerboard: Dict[str, str] = routerboard[0]
-            result.update(routerboard)
-        except Exception as e:
-            if 'no such command' not in str(e):
-                log.error(e)
-            pass
+            results = tuple(call)
+            result: Dict[str, str] = results[0]
+            try:
+                call = router.api.path(
+                    "/system/routerboard"
+                )
+
+                routerboard = tuple(call)
+                routerboard: Dict[str, str] = routerboard[0]
+                result.update(routerboard)
+            except Exception as e:
+                if 'no such command' not in str(e):
+                    log.error(e)
+                pass
+        arch=result['architecture-name']
         upgrade=False
         if result['board-name']!='x86' and result['current-firmware']!= result['upgrade-firmware'] and result['board-name']!='x86':
             upgrade=True
@@ -1122,6 +1308,63 @@ def get_local_users(opts,router=False,full=False):
         log.error(e)
         return False
 
+# striped locks (devid % LOCAL_USERS_LOCKS) so concurrent cache misses of a
+# device share one fetch, and the time of the last failed fetch so an
+# unreachable device is not retried per message
+LOCAL_USERS_LOCKS=64
+_local_users_locks=[threading.Lock() for n in range(LOCAL_USERS_LOCKS)]
+_local_users_failed={}
+LOCAL_USERS_RETRY=30
+
+def cache_local_users(devid,rows):
+    try:
+        red.set_local_users(devid,[row['name'] for row in rows if 'name' in row],config.LOCAL_USERS_TTL)
+    except Exception as e:
+        log.error(e)
+
+def drop_local_users(devid):
+    """Forget cached users of device, next lookup fetches them again."""
+    try:
+        red.drop_local_users(devid)
+    except Exception as e:
+        log.error(e)
+    _local_users_failed.pop(devid,None)
+
+def cached_local_users(dev):
+    """Local user names of dev without asking the device when the poller
+    already cached them. Returns [] if they can't be fetched."""
+    try:
+        users=red.get_local_users(dev.id)
+    except Exception as e:
+        log.error(e)
+        users=None
+    if users is not None:
+        return users
+    with _local_users_locks[dev.id % LOCAL_USERS_LOCKS]:
+        try:
+            users=red.get_local_users(dev.id)
+        except Exception:
+            users=None
+        if users is not None:
+            # fetched by the thread we waited for
+            return users
+        if time.time()-_local_users_failed.get(dev.id,0)<LOCAL_USERS_RETRY:
+            return []
+        router=None
+        broken=False
+        try:
+            router=router_pool.acquire(dev.id,build_api_options(dev))
+            rows=list(router.api.rawCmd('/user/print',proplist('name')))
+        except Exception as e:
+            log.error(e)
+            broken=router is not None
+            _local_users_failed[dev.id]=time.time()
+            return []
+        finally:
+            router_pool.release(dev.id,router,broken)
+        cache_local_users(dev.id,rows)
+        return [row['name'] for row in rows if 'name' in row]
+
 def ispro():
     return ISPRO
 
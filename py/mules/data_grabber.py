@@ -6,10 +6,16 @@
 # Author: sepehr.ha@gmail.com
 
 import time
+import heapq
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
 from libs import util
-from libs.db import db_device,db_sysconfig,db_events
-from threading import Thread
-from libs.red import RedisDB
+from libs.db import db,db_device,db_sysconfig,db_events,db_groups
+from libs.db.db_device import DeviceBatcher
+from libs.red import TSBatcher
+from libs.stats import Stats
 import netifaces
 import json
 import queue
@@ -20,60 +26,248 @@ import logging
 log = logging.getLogger("Data_grabber")
 
 
+class PollScheduler(object):
+    """Continuous device poll scheduler.
+    Every device has its own jittered next due time, due devices are handed
+    to a bounded pool of workers as soon as one is free."""
 
-def grab_device_data(timer=2):
-    all_devices=list(db_device.get_all_device())
-    num_threads = len(all_devices)
-    q = queue.Queue()
-    threads = []
-    log.info("Data grabber started")
-    for dev in all_devices:
-        time.sleep(0.2)
-        t = Thread(target=util.grab_device_data, args=(dev, q))
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-    res=[]
-    totals={
-     'rx-total':0,
-     'tx-total':0
-    }
-    data=False
-    for _ in range(num_threads):
-        qres=q.get()
-        if not qres.get("reason",False):
-            data=qres.get("data", None)
-            if data:
-                if data.get("rx-total", False):
-                    totals['rx-total']+=data["rx-total"]
-                if data.get("tx-total", False):
-                    totals["tx-total"]+=data["tx-total"]
-            res.append(qres)
+    def __init__(self, workers=config.GRABBER_WORKERS, interval=config.GRABBER_INTERVAL, jitter=config.GRABBER_JITTER, max_backoff=config.GRABBER_MAX_BACKOFF):
+        self.workers = workers
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grabber")
+        self.q = queue.Queue()
+        self.batcher = TSBatcher()
+        self.device_batcher = DeviceBatcher()
+        self.last_write = time.time()
+        self.devices = {}
+        self.groups = {}
+        # devid -> next due time, heap holds (due, devid) and may contain stale entries
+        self.due = {}
+        self.heap = []
+        # devid -> (dispatch time, due time)
+        self.running = {}
+        # devid -> consecutive connection failures, devid -> connection settings
+        self.failures = {}
+        self.conn = {}
+        self.last_refresh = 0
+        self.sweep_start = time.time()
+        self.swept = set()
+        self.events = db_events.EventManager("Data Puller")
+        self.stats = Stats("data_grabber")
+        self.stats.gauge("workers", workers)
+        self.stats.gauge("interval", interval)
+
+    def next_due(self, due):
+        now = time.time()
+        jitter = random.uniform(-self.jitter, self.jitter) * self.interval
+        nxt = due + self.interval + jitter
+        if nxt < now:
+            # we are behind schedule, don't try to catch up in a burst
+            nxt = now + abs(jitter)
+        return nxt
+
+    def backoff_due(self, failures):
+        """Next due time of a device which failed to connect failures times in a row."""
+        delay = min(self.interval * 2 ** (failures - 1), max(self.max_backoff, self.interval))
+        return time.time() + delay * (1 + random.uniform(0, self.jitter))
+
+    def refresh_devices(self):
+        # reloaded rows must not miss changes still queued
+        self.write_devices()
+        now = time.time()
+        devs = {dev.id: dev for dev in db_device.get_all_device()}
+        for devid, dev in devs.items():
+            conn = (dev.ip, dev.port, dev.user_name, dev.password)
+            if devid not in self.due:
+                # spread new devices over one interval so start up is not a burst
+                due = now + random.uniform(0, self.interval)
+                self.due[devid] = due
+                heapq.heappush(self.heap, (due, devid))
+            elif self.failures.get(devid) and self.conn.get(devid) != conn:
+                # device was edited while backing off, try the new settings soon
+                del self.failures[devid]
+                due = now + random.uniform(0, self.interval * self.jitter)
+                if due < self.due[devid]:
+                    self.due[devid] = due
+                    heapq.heappush(self.heap, (due, devid))
+            self.conn[devid] = conn
+        for devid in list(self.due):
+            if devid not in devs:
+                del self.due[devid]
+                self.failures.pop(devid, None)
+                self.conn.pop(devid, None)
+                self.swept.discard(devid)
+        self.devices = devs
+        self.groups = db_groups.get_device_group_ids()
+        # pick up events fixed from the UI
+        self.write_events()
+        self.events.load()
+        self.last_refresh = now
+        self.stats.gauge("devices", len(devs))
+
+    def queue_depth(self):
+        """Number of devices which are due but waiting for a free worker."""
+        now = time.time()
+        return sum(1 for due, devid in self.heap if due <= now and self.due.get(devid) == due and devid not in self.running)
+
+    def dispatch(self):
+        now = time.time()
+        while self.heap and len(self.running) < self.workers:
+            due, devid = self.heap[0]
+            if due > now:
+                break
+            heapq.heappop(self.heap)
+            if self.due.get(devid) != due or devid in self.running:
+                continue
+            dev = self.devices.get(devid)
+            if not dev:
+                continue
+            self.stats.observe("lag", (now - due) * 1000)
+            self.running[devid] = (now, due)
+            self.pool.submit(self.poll, dev)
+
+    def poll(self, dev):
+        try:
+            util.grab_device_data(dev, self.q, self.batcher, self.groups.get(dev.id, []), self.events, self.device_batcher)
+        except Exception as e:
+            log.error(e)
+            self.q.put({"id": dev.id, "reason": str(e), "done": False})
+        finally:
+            # every worker thread keeps its db connection between polls, one
+            # the server dropped is forgotten so the next query reconnects
+            conn = db.database._state.conn
+            if conn is not None and getattr(conn, 'closed', 0):
+                db.database.close()
+
+    def close(self):
+        """Stop the workers and close their db connections."""
+        barrier = threading.Barrier(self.workers)
+        def close_connection():
+            # one task per worker thread: each one waits for the others
+            try:
+                barrier.wait(timeout=30)
+            except threading.BrokenBarrierError:
+                pass
+            if not db.database.is_closed():
+                db.database.close()
+        for n in range(self.workers):
+            self.pool.submit(close_connection)
+        self.pool.shutdown(wait=True)
+        if not db.database.is_closed():
+            db.database.close()
+
+    def collect(self, timeout=0.5):
+        try:
+            qres = self.q.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            self.handle_result(qres)
+            try:
+                qres = self.q.get_nowait()
+            except queue.Empty:
+                break
+
+    def handle_result(self, qres):
+        devid = qres['id']
+        now = time.time()
+        started, due = self.running.pop(devid, (now, now))
+        self.stats.observe("poll", (now - started) * 1000)
+        if qres.get("detail") in ("Unreachable", "API Connection"):
+            failures = self.failures[devid] = self.failures.get(devid, 0) + 1
+            nxt = self.backoff_due(failures)
+            self.stats.incr("connect_failed_{}".format(qres.get("kind", "other")))
         else:
-            db_events.connection_event(qres['id'],'Data Puller',qres.get("detail","connection"),"Critical",0,qres.get("reason","problem in data puller"))
-    keys=["rx-total","tx-total"]
-    redopts={
-            "dev_id":'all',
-            "keys":keys
-    }
-    try:
-        if data:
-            reddb=RedisDB(redopts)
-            reddb.dev_create_keys()
-            reddb.add_dev_data(data)
-    except Exception as e:
-        log.error(e)
+            self.failures.pop(devid, None)
+            nxt = self.next_due(due)
+        if devid in self.due:
+            self.due[devid] = nxt
+            heapq.heappush(self.heap, (nxt, devid))
+        if not qres.get("reason", False):
+            self.stats.incr("polled")
+        else:
+            self.stats.incr("failed")
+            self.events.open(devid, "connection", qres.get("detail", "connection"), "Critical", qres.get("reason", "problem in data puller"))
+        self.swept.add(devid)
+        # devices backing off are not expected back within this sweep
+        backing_off = sum(1 for d, n in self.failures.items() if n > 1 and d not in self.swept)
+        if len(self.swept) + backing_off >= len(self.due):
+            self.stats.gauge("cycle_duration", round(now - self.sweep_start, 2))
+            self.sweep_start = now
+            self.swept = set()
+
+    def write_events(self):
+        start = time.time()
+        try:
+            opened, fixed = self.events.flush()
+        except Exception as e:
+            log.error(e)
+            return
+        if opened or fixed:
+            self.stats.observe("event_write", (time.time() - start) * 1000)
+            self.stats.incr("events_opened", opened)
+            self.stats.incr("events_fixed", fixed)
+
+    def write_devices(self):
+        start = time.time()
+        try:
+            devices, statements = self.device_batcher.flush()
+        except Exception as e:
+            log.error(e)
+            return
+        if devices:
+            self.stats.observe("device_write", (time.time() - start) * 1000)
+            self.stats.incr("device_updates", devices)
+            self.stats.incr("device_statements", statements)
+
+    def write_samples(self):
+        now = time.time()
+        if now - self.last_write < config.GRABBER_FLUSH_INTERVAL:
+            return
+        self.last_write = now
+        self.write_devices()
+        self.write_events()
+        try:
+            written, failed = self.batcher.flush()
+            if written or failed:
+                self.stats.observe("ts_write", (time.time() - now) * 1000)
+                self.stats.incr("samples", written)
+                self.stats.incr("samples_failed", failed)
+        except Exception as e:
+            log.error(e)
+
+    def run(self):
+        log.info("Data grabber started")
+        while True:
+            try:
+                if time.time() - self.last_refresh >= self.interval:
+                    get_all_ipv4_addresses()
+                    self.refresh_devices()
+                self.dispatch()
+                self.collect()
+                self.write_samples()
+                if self.stats.last_flush + 10 < time.time():
+                    self.stats.gauge("running", len(self.running))
+                    self.stats.gauge("queue_depth", self.queue_depth())
+                    self.stats.gauge("pooled_connections", util.router_pool.size())
+                    self.stats.gauge("backing_off", sum(1 for n in self.failures.values() if n > 1))
+                    self.stats.flush()
+            except Exception as e:
+                log.error(e)
+                time.sleep(1)
+
 
 def get_all_ipv4_addresses():
     ips=db_sysconfig.get_sysconfig('all_ip')
     ipv4_addresses = []
-    
+
     # Iterate over all network interfaces
     for interface in netifaces.interfaces():
         # Get all IPv4 addresses associated with the interface
         addresses = netifaces.ifaddresses(interface).get(netifaces.AF_INET, [])
-        
+
         # Append IPv4 addresses to the list
         for link in addresses:
             if '127.0.0.1' in link['addr']:
@@ -86,14 +280,12 @@ def get_all_ipv4_addresses():
 
 
 def main():
-    while True:
-        config=db_sysconfig.get_scan_mode().value
-        get_all_ipv4_addresses()
-        grab_device_data()      
-        time.sleep(60)
-        log.info("data grabbing end")
-
-    
+    scheduler = PollScheduler()
+    try:
+        scheduler.run()
+    finally:
+        scheduler.close()
+
+
 if __name__ == '__main__':
     main()
-
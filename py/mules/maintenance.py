@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# maintenance.py: independent worker process for database housekeeping
+#   - creates the coming monthly partitions of the log tables
+#   - drops partitions older than config.LOGS_RETENTION_MONTHS
+#   - refreshes the dashboard snapshot (libs/dashboard.py)
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import time
+import config
+from libs import dashboard
+from libs.db import db,db_partitions
+from libs.stats import Stats
+
+import logging
+log = logging.getLogger("Maintenance")
+
+
+def maintain(stats):
+    start = time.time()
+    created = db_partitions.ensure_partitions()
+    dropped = db_partitions.drop_partitions(config.LOGS_RETENTION_MONTHS)
+    for name in created:
+        log.info("created partition {}".format(name))
+    for name in dropped:
+        log.info("dropped expired partition {}".format(name))
+    stats.incr("partitions_created", len(created))
+    stats.incr("partitions_dropped", len(dropped))
+    stats.observe("run", (time.time() - start) * 1000)
+
+
+def refresh_dashboard(refresher, stats):
+    start = time.time()
+    refresher.run()
+    stats.observe("dashboard", (time.time() - start) * 1000)
+
+
+def main():
+    stats = Stats("maintenance")
+    refresher = dashboard.Refresher()
+    last_maintain = 0
+    while True:
+        try:
+            refresh_dashboard(refresher, stats)
+        except Exception as e:
+            log.error(e)
+        if time.time() - last_maintain >= config.MAINTENANCE_INTERVAL:
+            try:
+                maintain(stats)
+                last_maintain = time.time()
+            except Exception as e:
+                log.error(e)
+        if not db.database.is_closed():
+            db.database.close()
+        stats.flush()
+        time.sleep(config.DASHBOARD_REFRESH)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,12 @@ from libs.db import db_sysconfig
 import logging
 import time
 import asyncio
+import functools
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import config
 
 import logging
 import traceback
@@ -20,6 +26,8 @@ from pyrad.server import RemoteHost
 from libs.mschap3 import mschap,mppe
 from libs.db import db,db_user_group_perm,db_device,db_groups,db_device,db_AA,db_sysconfig
 from libs.util import FourcePermToRouter
+from libs.stats import Stats
+from libs import auth_correlator
 
 try:
     import uvloop
@@ -40,10 +48,32 @@ logging.basicConfig(filename="pyrad.log", level="DEBUG",
 
 class RadServer(ServerAsync):
 
-    def __init__(self, loop, dictionary):
+    def __init__(self, loop, dictionary, name="radius"):
 
         ServerAsync.__init__(self, loop=loop, dictionary=dictionary,
                               debug=True)
+        # database and router work, the loop only parses, verifies and replies
+        self.executor = ThreadPoolExecutor(max_workers=config.RADIUS_THREADS, thread_name_prefix="radius")
+        self.stats = Stats(name)
+        self.loop.call_later(10, self.flush_stats)
+
+    def flush_stats(self):
+        self.loop.run_in_executor(self.executor, self.stats.flush)
+        self.loop.call_later(10, self.flush_stats)
+
+    def in_executor(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def add_log(self, *args, **kwargs):
+        # the reply never waits for the log row
+        self.in_executor(self.write_log, *args, **kwargs)
+
+    def write_log(self, *args, **kwargs):
+        try:
+            auth_correlator.publish(db_AA.Auth.add_log(*args, **kwargs))
+        except Exception as e:
+            log.error(e)
+
     def verifyMsChapV2(self,pkt,userpwd,group,nthash):
 
         ms_chap_response = pkt['MS-CHAP2-Response'][0]
@@ -96,83 +126,91 @@ class RadServer(ServerAsync):
         #log failed attempts
         protocol.send_response(reply, addr)
 
+    def lookup(self, devip, username, userip):
+        """Blocking part of an Access-Request, runs in the executor.
+        Returns (dev, user, mikrotik group or False, perms, nthash, failure message)"""
+        dev=db_device.get_indexed_device(devip)
+        if not dev:
+            return dev, None, False, None, None, "Device Not Exist"
+        u = db.get_user_by_username(username)
+        if not u or u.role=='disabled':
+            return dev, None, False, None, None, "User Not Exist"
+        group=False
+        perm=None
+        force_perms=True if db_sysconfig.get_sysconfig('force_perms')=="True" else False
+        if force_perms:
+            #get user permision related to device
+            dev_groups_ids=[g.id for g in db_groups.devgroups(dev.id)]
+            dev_groups_ids.append(1)
+            perm=list(db_user_group_perm.DevUserGroupPermRel.query_permission_by_user_and_device_group(u.id,dev_groups_ids))
+            if not perm:
+                return dev, u, False, None, None, "Unable to verify group"
+            group=perm[0].perm_id.name
+        nthash=u.hash
+        if(ISPRO):
+            nthash = utilpro.GetNThash(u)
+            if not utilpro.verfyRadius(u,userip):
+                return dev, u, group, perm, nthash, "IP not allowed: {}".format(userip)
+        return dev, u, group, perm, nthash, None
+
     def handle_auth_packet(self, protocol, pkt, addr):
+        asyncio.ensure_future(self.auth(protocol, pkt, addr), loop=self.loop)
+
+    async def auth(self, protocol, pkt, addr):
         # log.error("Attributes: ")
         # for attr in pkt.keys():
         #     log.error("%s: %s" % (attr, pkt[attr]))
+        start=time.time()
+        result="error"
         try:
             tz=int(time.time())
             username = pkt['User-Name'][0]
             userip=pkt['Calling-Station-Id'][0]
             devip=pkt['NAS-IP-Address'][0]
-            dev=db_device.query_device_by_ip(devip)
-            if not dev:
+            dev, u, group, perm, nthash, failed = await self.in_executor(self.lookup, devip, username, userip)
+            self.stats.observe("lookup", (time.time()-start)*1000)
+            if failed:
                 self.send_auth_reject(protocol,pkt,addr)
+                result="rejected"
+                if dev:
+                    self.add_log(dev.id, 'failed',  u.username if u else username , userip , by=None,sessionid=None,timestamp=tz,message=failed)
                 return
-      
-            u = db.get_user_by_username(username)
-            if not u or u.role=='disabled':
+            reply=self.verifyMsChapV2(pkt,"password",group,nthash)
+            if not reply:
+                self.add_log(dev.id, 'failed',  u.username , userip , by=None,sessionid=None,timestamp=tz,message="Wrong Password")
+                self.send_auth_reject(protocol,pkt,addr)
+                result="rejected"
+                return
+            if perm:
+                # the group we answer with has to exist on the router first
+                sync_start=time.time()
+                synced=await self.in_executor(FourcePermToRouter, dev, perm)
+                self.stats.observe("perm_sync", (time.time()-sync_start)*1000)
+                if not synced:
                     self.send_auth_reject(protocol,pkt,addr)
-                    db_AA.Auth.add_log(dev.id, 'failed',  username , userip , by=None,sessionid=None,timestamp=tz,message="User Not Exist")
-                    return
-            else:
-                #get user permision related to device
-                if not dev:
-                    self.send_auth_reject(protocol, pkt, addr)
-                    db_AA.Auth.add_log(dev.id, 'failed', u.username, userip, by=None, sessionid=None, timestamp=tz, message="Device Not Exist")
-                    return
-                force_perms=True if db_sysconfig.get_sysconfig('force_perms')=="True" else False
-                if force_perms:
-                    dev_groups=db_groups.devgroups(dev.id)
-                    dev_groups_ids=[group.id for group in dev_groups]
-                    dev_groups_ids.append(1)
-                    res=False
-                    if dev and len(dev_groups_ids)>0:
-                        perm=db_user_group_perm.DevUserGroupPermRel.query_permission_by_user_and_device_group(u.id,dev_groups_ids)
-                        res2=False
-                        if len(list(perm))>0:
-                            res2=FourcePermToRouter(dev,perm)
-                        if not res2:
-                            self.send_auth_reject(protocol,pkt,addr)
-                            db_AA.Auth.add_log(dev.id, 'failed',  u.username , userip , by=None,sessionid=None,timestamp=tz,message="Unable to verify group")
-                            return
-                nthash=u.hash
-                if(ISPRO):
-                    nthash = utilpro.GetNThash(u)
-                    respro=utilpro.verfyRadius(u,userip)
-                    if not respro:
-                        db_AA.Auth.add_log(dev.id, 'failed',  u.username , userip , by=None,sessionid=None,timestamp=tz,message="IP not allowed: {}".format(userip))
-                        self.send_auth_reject(protocol, pkt, addr)
-                        return
-                if force_perms:
-                    reply=self.verifyMsChapV2(pkt,"password",perm[0].perm_id.name,nthash)
-                else:
-                    reply=self.verifyMsChapV2(pkt,"password",False,nthash)
-                if reply:
-                    protocol.send_response(reply, addr)
+                    result="rejected"
+                    self.add_log(dev.id, 'failed',  u.username , userip , by=None,sessionid=None,timestamp=tz,message="Unable to verify group")
                     return
-                db_AA.Auth.add_log(dev.id, 'failed',  u.username , userip , by=None,sessionid=None,timestamp=tz,message="Wrong Password")
-                self.send_auth_reject(protocol,pkt,addr)
+            protocol.send_response(reply, addr)
+            result="accepted"
         except Exception as e:
-            print(e)
+            log.error(e)
             self.send_auth_reject(protocol,pkt,addr)
             #log failed attempts
-
-        
+        finally:
+            self.stats.incr(result)
+            self.stats.observe("auth", (time.time()-start)*1000)
 
     def handle_acct_packet(self, protocol, pkt, addr):
+        ts = int(time.time())
         try:
-            ts = int(time.time())
             dev_ip=pkt['NAS-IP-Address'][0]
-            dev=db_device.query_device_by_ip(dev_ip)
             type=pkt['Acct-Status-Type'][0]
             user=pkt['User-Name'][0]
             userip=pkt['Calling-Station-Id'][0]
             sessionid=pkt['Acct-Session-Id'][0]
-            if type == 'Start':
-                db_AA.Auth.add_log(dev.id, 'loggedin', user , userip , None,timestamp=ts,sessionid=sessionid)
-            elif type == 'Stop':
-                db_AA.Auth.add_log(dev.id, 'loggedout', user , userip , None,timestamp=ts,sessionid=sessionid)
+            if type in ('Start', 'Stop'):
+                self.in_executor(self.account, dev_ip, type, user, userip, sessionid, ts)
         except Exception as e:
             log.error("Error in accounting: ")
             log.error(e)
@@ -183,6 +221,18 @@ class RadServer(ServerAsync):
         #     log.error("%s: %s" % (attr, pkt[attr]))
         reply = self.CreateReplyPacket(pkt)
         protocol.send_response(reply, addr)
+        self.stats.incr("accounting")
+
+    def account(self, dev_ip, type, user, userip, sessionid, ts):
+        try:
+            dev=db_device.get_indexed_device(dev_ip)
+            if type == 'Start':
+                auth_correlator.publish(db_AA.Auth.add_log(dev.id, 'loggedin', user , userip , None,timestamp=ts,sessionid=sessionid))
+            elif type == 'Stop':
+                db_AA.Auth.add_log(dev.id, 'loggedout', user , userip , None,timestamp=ts,sessionid=sessionid)
+        except Exception as e:
+            log.error("Error in accounting: ")
+            log.error(e)
 
     def handle_coa_packet(self, protocol, pkt, addr):
 
@@ -208,18 +258,23 @@ class RadServer(ServerAsync):
 
 
 
-def main():
+def serve(name="radius", parent=None):
+    """Run one radius server until stopped, parent: pid of the supervisor"""
     # create server and read dictionary
-    loop = asyncio.get_event_loop()
-    server = RadServer(loop=loop, dictionary=Dictionary('py/libs/raddic/dictionary'))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = RadServer(loop=loop, dictionary=Dictionary('py/libs/raddic/dictionary'), name=name)
     secret = db_sysconfig.get_sysconfig('rad_secret')
     server.hosts["0.0.0.0"] = RemoteHost("0.0.0.0",
                                            secret.encode(),
                                            "localhost")
+    if parent:
+        loop.call_later(5, watch_parent, loop, parent)
 
     try:
 
-        # Initialize transports
+        # Initialize transports, ports are bound with SO_REUSEPORT so every
+        # worker process gets its share of the requests
         loop.run_until_complete(
             asyncio.ensure_future(
                 server.initialize_transports(enable_auth=True,
@@ -245,6 +300,59 @@ def main():
 
     loop.close()
 
+def watch_parent(loop, parent):
+    # supervisor is gone (mule restarted), a new one starts its own workers
+    if os.getppid() != parent:
+        loop.stop()
+        return
+    loop.call_later(5, watch_parent, loop, parent)
+
+def supervise(workers):
+    """Fork workers radius processes and restart the ones which die."""
+    parent = os.getpid()
+    children = {}
+
+    def spawn(n):
+        # children must not share the db connection of this process
+        if not database.is_closed():
+            database.close()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve("radius-{}".format(n), parent)
+            finally:
+                os._exit(0)
+        children[pid] = n
+
+    def stop(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for n in range(workers):
+        spawn(n)
+    while True:
+        pid, status = os.wait()
+        n = children.pop(pid, None)
+        if n is None:
+            continue
+        log.error("radius worker {} exited with status {}, restarting".format(n, status))
+        time.sleep(1)
+        spawn(n)
+
+def main():
+    if config.RADIUS_WORKERS > 1:
+        supervise(config.RADIUS_WORKERS)
+    else:
+        serve()
+
     
 if __name__ == '__main__':
     main()
@@ -2,17 +2,25 @@
 # -*- coding: utf-8 -*-
 
 # syslog.py: independent worker process as a syslog server
+#   receiver: drains the udp socket in batches into the parse queue
+#   parsers: match messages to devices (db_device ip index) and turn them
+#     into db rows
+#   writer: bulk inserts the collected rows every SYSLOG_FLUSH_MS
 # MikroWizard.com , Mikrotik router management solution
 # Author: sepehr.ha@gmail.com
 
-from math import e
-import socketserver
+import socket
 import re
 import time
+import queue
+import threading
 
-from libs.db import db_device
+import config
+from libs.db import db,db_device
 import logging
 from libs.db import db_AA,db_events
+from libs.stats import Stats
+from libs.auth_correlator import AuthCorrelator
 log = logging.getLogger("SYSLOG")
 from libs import util
 try:
@@ -22,144 +30,274 @@ except ImportError:
     ISPRO=False
     pass
 
-import socketserver
+# datagrams read from the socket before handing them to the parsers
+BATCH = 256
 
-class SyslogUDPHandler(socketserver.BaseRequestHandler):
-    def extract_data_from_regex(self,regex,line):
-        try:
-            matches = re.finditer(regex, line, re.MULTILINE)
-            sgroups=[]   
-            for matchNum, match in enumerate(matches, start=1):
-                for groupNum in range(0, len(match.groups())):
-                    groupNum = groupNum + 1
-                    sgroups.append(match.group(groupNum))
-            return sgroups
-        except:
-            return None
-    def handle(self):
-        data = bytes.decode(self.request[0].strip(), encoding="utf-8")
-        message = str(data)
-        #get current timestamp
-        ts = int(time.time())
-        socket = self.request[1]
-        dev=db_device.query_device_by_ip(self.client_address[0])
-        regex=r'(.*),?(info.*|warning|critical) mikrowizard(\d+):.*'
+RE_HEADER = re.compile(r'(.*),?(info.*|warning|critical) mikrowizard(\d+):.*', re.MULTILINE)
+RE_LOGIN = re.compile(r"user (.*) logged (in|out) from (..*)via.(.*)", re.MULTILINE)
+RE_LOGIN_FAILURE = re.compile(r"login failure for user (.*) from (..*)via.(.*)", re.MULTILINE)
+RE_CRITICAL = re.compile(r'system,error,critical mikrowizard\d+: (.*)', re.MULTILINE)
+RE_ACCOUNT = re.compile(r"system,info mikrowizard\d+: (.*) (changed|added|removed|unscheduled) by (winbox-\d.{1,3}\d\/.*\(winbox\)|mac-msg\(winbox\)|tcp-msg\(winbox\)|ssh|telnet|api|api-ssl|.*\/web|ftp|www-ssl).*:(.*)@(.*) \((.*)\)", re.MULTILINE)
+RE_ACCOUNT_OTHER = re.compile(r"system,info mikrowizard\d+: (.*) (changed|added|removed|unscheduled) by (.*)", re.MULTILINE)
+RE_LINK = re.compile(r"interface,info mikrowizard\d+: (.*) link (down|up).*", re.MULTILINE)
+RE_DHCP = re.compile(r'dhcp,info mikrowizard\d+: (dhcp-client|.*) (deassigned|assigned|.*) (\d+\.\d+\.\d+\.\d+|on.*address)\s*(from|to|$)\s*(.*)', re.MULTILINE)
+RE_WIRELESS = re.compile(r'wireless,info mikrowizard\d+: ([0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2})@(.*): (connected|disconnected), (signal strength|.*)? (-?\d{2})?.*', re.MULTILINE)
+
+
+def extract_data_from_regex(regex,line):
+    try:
+        sgroups=[]
+        for match in regex.finditer(line):
+            sgroups.extend(match.groups())
+        return sgroups
+    except:
+        return None
+
+
+class SyslogServer(object):
+    def __init__(self, host="0.0.0.0", port=5014):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.SYSLOG_RCVBUF)
+        self.sock.bind((host, port))
+        # one queue per parse worker, messages of an ip always go to the same
+        # one so a link down is never handled after the link up following it
+        self.parse_qs = [queue.Queue() for n in range(max(1, config.SYSLOG_WORKERS))]
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.account_rows = []
+        self.auth_rows = []
+        self.state_events = []
+        self.stats = Stats("syslog")
+        # radius logins are matched with the rows of the radius mule
+        self.correlator = AuthCorrelator(stats=self.stats)
+        self.stats.gauge("rcvbuf", self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+    # ------------------------------------------------------------------
+    # receive stage
+
+    def receive(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+                ts = int(time.time())
+                batch = [(data, addr[0], ts)]
+                # whatever else is already queued in the kernel, without blocking
+                while len(batch) < BATCH:
+                    try:
+                        data, addr = self.sock.recvfrom(65535, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    batch.append((data, addr[0], ts))
+                self.stats.incr("received", len(batch))
+                if self.waiting + len(batch) > config.SYSLOG_QUEUE:
+                    self.stats.incr("dropped", len(batch))
+                    continue
+                with self.lock:
+                    self.waiting += len(batch)
+                batches = {}
+                for item in batch:
+                    batches.setdefault(hash(item[1]) % len(self.parse_qs), []).append(item)
+                for n, items in batches.items():
+                    self.parse_qs[n].put(items)
+            except Exception as e:
+                log.error(e)
+
+    # ------------------------------------------------------------------
+    # parse stage
+
+    def parse_worker(self, parse_q):
+        while True:
+            batch = parse_q.get()
+            with self.lock:
+                self.waiting -= len(batch)
+            for data, ip, ts in batch:
+                try:
+                    self.handle(data, ip, ts)
+                    self.stats.incr("parsed")
+                except Exception as e:
+                    self.stats.incr("parse_failed")
+                    log.error(e)
+
+    def auth_log(self, devid, type, username, ip, by, timestamp=False, message=None):
+        row = db_AA.Auth.log_row(devid, type, username, ip, by, timestamp=timestamp, message=message)
+        if row is None:
+            self.correlator.syslog_record(devid, type, username, ip, by, timestamp=timestamp, message=message)
+            return
+        with self.lock:
+            self.auth_rows.append(row)
+
+    def account_log(self, *args):
+        row = db_AA.Account.log_row(*args)
+        with self.lock:
+            self.account_rows.append(row)
+
+    def users_changed(self, dev, section):
+        section = section.strip()
+        # a local user was added/removed/renamed, cached list is stale
+        if section.startswith("user "):
+            util.drop_local_users(dev.id)
+        # someone touched the groups or radius client we configure
+        if section.startswith("group ") or section.startswith("radius"):
+            util.drop_perm_synced(dev.id)
+
+    def state_event(self, devid, src, detail, level, status=0, comment=""):
+        with self.lock:
+            self.state_events.append((devid, src, detail, level, status, comment))
+
+    def handle(self, data, ip, ts):
+        message = str(bytes.decode(data.strip(), encoding="utf-8"))
+        dev = db_device.get_indexed_device(ip)
+        info = None
         if dev:
-            info=self.extract_data_from_regex(regex,message)
-            opts=util.build_api_options(dev)
+            info = extract_data_from_regex(RE_HEADER, message)
         try:
             int(info[2])
             if dev and dev.id != int(info[2]):
-                log.error("Device id mismatch ignoring syslog for ip : {}".format(self.client_address[0]))
+                log.error("Device id mismatch ignoring syslog for ip : {}".format(ip))
         except:
             log.error("**device id mismatch")
             log.error(message)
-            log.error(self.client_address[0])
+            log.error(ip)
             log.error("device id mismatch**")
-            dev=False
-            pass
-        if dev and dev.id == int(info[2]) and 'mikrowizard' in message and 'via api' not in message:
-            if 'system,info,account' in message:
-                regex = r"user (.*) logged (in|out) from (..*)via.(.*)"
-                info=self.extract_data_from_regex(regex,message)
-                users=util.get_local_users(opts)
-                try:
-                    if info[0] in users:
-                        msg='local'
-                    else:
-                        msg='radius'
-                    if 'logged in' in message:
-                        if 'via api' not in message:
-                            db_AA.Auth.add_log(dev.id, 'loggedin', info[0] , info[2] , info[3],timestamp=ts,message=msg)
-                    elif 'logged out' in message:
-                        if info[0] in users:
-                            db_AA.Auth.add_log(dev.id, 'loggedout', info[0] , info[2] , info[3],timestamp=ts,message=msg)
-                except Exception as e:
-                    log.error(e)
-                    log.error(message)
-            elif 'system,error,critical' in message:
-                if "login failure" in message:
-                    users=util.get_local_users(opts)    
-                    regex = r"login failure for user (.*) from (..*)via.(.*)"
-                    info=self.extract_data_from_regex(regex,message)
-                    ts = int(time.time())
-                    if info[0] in users:
-                        msg='local'
-                    else:
-                        msg='radius'
-                    db_AA.Auth.add_log(dev.id, 'failed', info[0]  , info[1] , info[2],timestamp=ts,message=msg)
-                elif "rebooted" in message:
-                    regex=r'system,error,critical mikrowizard\d+: (.*)'
-                    info=self.extract_data_from_regex(regex,message)
-                    db_events.state_event(dev.id, "syslog", "Unexpected Reboot","Critical",1,info[0])
-                    
-            elif 'system,info mikrowizard' in message:
-                regex= r"system,info mikrowizard\d+: (.*) (changed|added|removed|unscheduled) by (winbox-\d.{1,3}\d\/.*\(winbox\)|mac-msg\(winbox\)|tcp-msg\(winbox\)|ssh|telnet|api|api-ssl|.*\/web|ftp|www-ssl).*:(.*)@(.*) \((.*)\)"
-                if re.match(regex, message):
-                    info=self.extract_data_from_regex(regex, message)
-                    address=info[4].split('/')
-                    ctype=''
-                    if 'winbox' in info[2]:
-                        ctype='winbox'
-                        if 'tcp' in info[2]:
-                            ctype='winbox-tcp'
-                        elif 'mac' in info[2]:
-                            ctype='winbox-mac'
-                        if 'terminal' in address:
-                            ctype+='/terminal'
-                    elif 'ssh' in info[2]:
-                        ctype='ssh'
-                    elif 'telnet' in info[2]:
-                        ctype='telnet'
-                    elif '/web' in info[2]:
-                        ctype=info[2].split('/')[1] + " " + "({})".format(info[2].split('/')[0])
-                    elif 'api' in info[2]:
-                        ctype='api'
-                    db_AA.Account.add_log(dev.id,  info[0], info[1], info[3],message,ctype, address[0], info[5])
-                elif "rebooted" in message:
-                    db_events.state_event(dev.id, "syslog", "Router Rebooted","info",1,info[0])
-                elif "resetting system configuration" in message:
-                    db_events.state_event(dev.id, "syslog", "Router reset","info",1,info[0])
+            self.stats.incr("ignored")
+            return
+        if not (dev.id == int(info[2]) and 'mikrowizard' in message and 'via api' not in message):
+            self.stats.incr("ignored")
+            return
+        if 'system,info,account' in message:
+            info = extract_data_from_regex(RE_LOGIN, message)
+            users = util.cached_local_users(dev)
+            try:
+                if info[0] in users:
+                    msg = 'local'
                 else:
-                    regex = r"system,info mikrowizard\d+: (.*) (changed|added|removed|unscheduled) by (.*)"
-                    info=self.extract_data_from_regex(regex,message)
-                    db_AA.Account.add_log(dev.id, info[0], info[1], info[2],message)
-            elif 'interface,info mikrowizard' in message:
-                link_regex = r"interface,info mikrowizard\d+: (.*) link (down|up).*"
-                events=list(db_events.get_events_by_src_and_status("syslog", 0,dev.id).dicts())
-                if "link down" in message:
-                    info=self.extract_data_from_regex(link_regex,message)
-                    db_events.state_event(dev.id, "syslog", "Link Down: " + info[0],"Warning",0,"Link is down for {}".format(info[0]))
-                elif "link up" in message:
-                    info=self.extract_data_from_regex(link_regex,message)
-                    util.check_or_fix_event(events,'state',"Link Down: " + info[0])
-            elif "dhcp,info mikrowizard" in message:
-                dhcp_regex=r'dhcp,info mikrowizard\d+: (dhcp-client|.*) (deassigned|assigned|.*) (\d+\.\d+\.\d+\.\d+|on.*address)\s*(from|to|$)\s*(.*)'
-                info=self.extract_data_from_regex(dhcp_regex,message)
-                if info and "assigned" in message:
-                    db_events.state_event(dev.id, "syslog", "dhcp assigned","info",1,"server {} assigned {} to {}".format(info[0],info[2],info[4]))
-                elif info and "deassigned" in message:
-                    db_events.state_event(dev.id, "syslog", "dhcp deassigned","info",1,"server {} deassigned {} from {}".format(info[0],info[2],info[4]))
-                elif info and "dhcp-client" in message:
-                    db_events.state_event(dev.id, "syslog", "dhcp client","info",1,"{} {}".format(info[1],info[2]))
-            elif "wireless,info mikrowizard" in message:
-                if ISPRO:
-                    utilpro.wireless_syslog_event(dev ,message)
+                    msg = 'radius'
+                if 'logged in' in message:
+                    if 'via api' not in message:
+                        self.auth_log(dev.id, 'loggedin', info[0], info[2], info[3], timestamp=ts, message=msg)
+                elif 'logged out' in message:
+                    if info[0] in users:
+                        self.auth_log(dev.id, 'loggedout', info[0], info[2], info[3], timestamp=ts, message=msg)
+            except Exception as e:
+                log.error(e)
+                log.error(message)
+        elif 'system,error,critical' in message:
+            if "login failure" in message:
+                users = util.cached_local_users(dev)
+                info = extract_data_from_regex(RE_LOGIN_FAILURE, message)
+                if info[0] in users:
+                    msg = 'local'
                 else:
-                    regex=r'wireless,info mikrowizard\d+: ([0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2})@(.*): (connected|disconnected), (signal strength|.*)? (-?\d{2})?.*'
-                    info=self.extract_data_from_regex(regex,message)
-                    if info:
-                        strength=""
-                        if len(info)>4:
-                            strength=info[4]
-                        db_events.state_event(dev.id, "syslog", "wireless client", "info", 1, "{} {} {} {} {}".format(info[0], info[1], info[2], info[3],strength))
-                        log.error(len(info))
-                        log.error(message)
+                    msg = 'radius'
+                self.auth_log(dev.id, 'failed', info[0], info[1], info[2], timestamp=ts, message=msg)
+            elif "rebooted" in message:
+                info = extract_data_from_regex(RE_CRITICAL, message)
+                self.state_event(dev.id, "syslog", "Unexpected Reboot", "Critical", 1, info[0])
+        elif 'system,info mikrowizard' in message:
+            if RE_ACCOUNT.match(message):
+                info = extract_data_from_regex(RE_ACCOUNT, message)
+                address = info[4].split('/')
+                ctype = ''
+                if 'winbox' in info[2]:
+                    ctype = 'winbox'
+                    if 'tcp' in info[2]:
+                        ctype = 'winbox-tcp'
+                    elif 'mac' in info[2]:
+                        ctype = 'winbox-mac'
+                    if 'terminal' in address:
+                        ctype += '/terminal'
+                elif 'ssh' in info[2]:
+                    ctype = 'ssh'
+                elif 'telnet' in info[2]:
+                    ctype = 'telnet'
+                elif '/web' in info[2]:
+                    ctype = info[2].split('/')[1] + " " + "({})".format(info[2].split('/')[0])
+                elif 'api' in info[2]:
+                    ctype = 'api'
+                self.account_log(dev.id, info[0], info[1], info[3], message, ctype, address[0], info[5])
+                self.users_changed(dev, info[0])
+            elif "rebooted" in message:
+                self.state_event(dev.id, "syslog", "Router Rebooted", "info", 1, info[0])
+            elif "resetting system configuration" in message:
+                self.state_event(dev.id, "syslog", "Router reset", "info", 1, info[0])
+                util.drop_local_users(dev.id)
+                util.drop_perm_synced(dev.id)
             else:
-                log.error(message)
+                info = extract_data_from_regex(RE_ACCOUNT_OTHER, message)
+                self.account_log(dev.id, info[0], info[1], info[2], message)
+                self.users_changed(dev, info[0])
+        elif 'interface,info mikrowizard' in message:
+            if "link down" in message:
+                info = extract_data_from_regex(RE_LINK, message)
+                self.state_event(dev.id, "syslog", "Link Down: " + info[0], "Warning", 0, "Link is down for {}".format(info[0]))
+            elif "link up" in message:
+                info = extract_data_from_regex(RE_LINK, message)
+                # fixed by the writer, also when the link down is still queued
+                self.state_event(dev.id, "syslog", "Link Down: " + info[0], "Warning", 1, None)
+        elif "dhcp,info mikrowizard" in message:
+            info = extract_data_from_regex(RE_DHCP, message)
+            if info and "assigned" in message:
+                self.state_event(dev.id, "syslog", "dhcp assigned", "info", 1, "server {} assigned {} to {}".format(info[0], info[2], info[4]))
+            elif info and "deassigned" in message:
+                self.state_event(dev.id, "syslog", "dhcp deassigned", "info", 1, "server {} deassigned {} from {}".format(info[0], info[2], info[4]))
+            elif info and "dhcp-client" in message:
+                self.state_event(dev.id, "syslog", "dhcp client", "info", 1, "{} {}".format(info[1], info[2]))
+        elif "wireless,info mikrowizard" in message:
+            if ISPRO:
+                # pro handlers get the full device row
+                utilpro.wireless_syslog_event(db_device.Devices.get_by_id(dev.id), message)
+            else:
+                info = extract_data_from_regex(RE_WIRELESS, message)
+                if info:
+                    strength = ""
+                    if len(info) > 4:
+                        strength = info[4]
+                    self.state_event(dev.id, "syslog", "wireless client", "info", 1, "{} {} {} {} {}".format(info[0], info[1], info[2], info[3], strength))
+        else:
+            log.error(message)
+
+    # ------------------------------------------------------------------
+    # write stage
+
+    def flush(self):
+        with self.lock:
+            account_rows, self.account_rows = self.account_rows, []
+            auth_rows, self.auth_rows = self.auth_rows, []
+            state_events, self.state_events = self.state_events, []
+        if not (account_rows or auth_rows or state_events):
+            return
+        start = time.time()
+        try:
+            with db.database.atomic():
+                db_AA.Account.add_logs(account_rows)
+                db_AA.Auth.add_logs(auth_rows)
+                db_events.add_state_events(state_events)
+            self.stats.incr("written_account", len(account_rows))
+            self.stats.incr("written_auth", len(auth_rows))
+            self.stats.incr("written_events", len(state_events))
+        except Exception as e:
+            log.error(e)
+            self.stats.incr("write_failed", len(account_rows) + len(auth_rows) + len(state_events))
+        self.stats.observe("write", (time.time() - start) * 1000)
+
+    def writer(self):
+        while True:
+            time.sleep(config.SYSLOG_FLUSH_MS / 1000)
+            self.flush()
+            self.stats.gauge("queued", self.waiting)
+            self.stats.flush(10)
+
+    def serve_forever(self):
+        self.correlator.start()
+        for n, parse_q in enumerate(self.parse_qs):
+            threading.Thread(target=self.parse_worker, args=(parse_q,), name="syslog-parse-{}".format(n), daemon=True).start()
+        threading.Thread(target=self.writer, name="syslog-writer", daemon=True).start()
+        self.receive()
+
+
 if __name__ == "__main__":
     try:
-        server = socketserver.UDPServer(("0.0.0.0",5014), SyslogUDPHandler)
-        server.serve_forever(poll_interval=0.5)
+        server = SyslogServer("0.0.0.0", 5014)
+        server.serve_forever()
     except (IOError, SystemExit):
         raise
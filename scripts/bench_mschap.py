@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# bench_mschap.py: per authentication CPU cost of the radius MS-CHAPv2 path
+#   - pycryptodome DES/MD4 vs the pure python fallback of libs/mschap3
+#   - checks both paths give the same responses and keys
+#   - run from the repo root: PYTHONPATH=py python scripts/bench_mschap.py
+#
+# MikroWizard.com , Mikrotik router management solution
+# Author: sepehr.ha@gmail.com
+
+import os
+import sys
+import time
+
+from libs.mschap3 import mschap, mppe
+
+
+def make_requests(count):
+    requests = []
+    for i in range(count):
+        nthash = os.urandom(16).hex() if i % 2 else False
+        requests.append((os.urandom(16), os.urandom(16), b"user%d" % i, "password%d" % i, nthash))
+    return requests
+
+def authenticate(request):
+    """What RadServer.verifyMsChapV2 computes for one Access-Request."""
+    authenticator_challenge, peer_challenge, username, password, nthash = request
+    nt_response = mschap.generate_nt_response_mschap2(authenticator_challenge, peer_challenge, username, password, nthash)
+    auth_resp = mschap.generate_authenticator_response(password, nt_response, peer_challenge, authenticator_challenge, username, nthash)
+    keys = mppe.mppe_chap2_gen_keys(password, nt_response, nthash)
+    return nt_response, auth_resp, keys
+
+def run(requests, fast):
+    mschap.FAST = fast
+    results = []
+    start = time.process_time()
+    for request in requests:
+        results.append(authenticate(request))
+    return time.process_time() - start, results
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    if not mschap.FAST:
+        print("pycryptodome not installed, only the pure python path is available")
+        return 1
+    requests = make_requests(count)
+    fast_time, fast_results = run(requests, True)
+    slow_time, slow_results = run(requests, False)
+    mschap.FAST = True
+    if fast_results != slow_results:
+        print("MISMATCH between pycryptodome and pure python results")
+        return 1
+    print("{} authentications, results identical".format(count))
+    print("pycryptodome: {:8.3f} ms/auth".format(fast_time / count * 1000))
+    print("pure python:  {:8.3f} ms/auth".format(slow_time / count * 1000))
+    print("speedup:      {:8.1f}x".format(slow_time / fast_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())